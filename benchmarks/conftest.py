@@ -0,0 +1,62 @@
+"""
+Benchmark fixtures.
+
+Sizes (turns) are set with `SENTINEL_BENCHMARK_ROWS`, comma separated, e.g.
+`SENTINEL_BENCHMARK_ROWS=10000,1000000,10000000`. Defaults to 10k.
+"""
+import os
+import sys
+import tracemalloc
+from typing import Any, Callable
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+from synthetic import write_calls_csv  # noqa: E402
+
+
+DEFAULT_ROWS = "10000"
+
+
+def pytest_generate_tests(metafunc):
+    if "rows" in metafunc.fixturenames:
+        sizes = os.environ.get("SENTINEL_BENCHMARK_ROWS", DEFAULT_ROWS)
+        rows = [int(size) for size in sizes.split(",") if size.strip()]
+        metafunc.parametrize("rows", rows, ids=[f"{size}rows" for size in rows], scope="session")
+
+
+@pytest.fixture(scope="session")
+def calls_csv(tmp_path_factory, rows) -> str:
+    """
+    Path to a synthetic call/turn CSV with `rows` turns.
+    """
+    path = tmp_path_factory.mktemp("data") / f"calls-{rows}.csv"
+    write_calls_csv(str(path), rows)
+    return str(path)
+
+
+@pytest.fixture(scope="session")
+def calls_df(calls_csv):
+    """
+    Synthetic call/turn dataframe as read by `CSVReader`.
+    """
+    from sentinel.dataframes.reader import CSVReader
+
+    return CSVReader(calls_csv).read()
+
+
+def record_peak_memory(benchmark, func: Callable, *args, **kwargs) -> Any:
+    """
+    Run `func` once under tracemalloc and record its peak traced memory in
+    the benchmark's extra info.
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    benchmark.extra_info["peak_memory_mb"] = round(peak / 2 ** 20, 2)
+    return result
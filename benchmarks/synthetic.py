@@ -0,0 +1,123 @@
+"""
+Synthetic call/turn dataframes shaped like the production dumps.
+"""
+import json
+import uuid
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+STATES = ["COF", "ASK_BOOKING_SOURCE", "BOOKING_CANCELLATION", "INDO_FAQ_GENERIC",
+          "FOLLOW_UP", "REPROMPT_INTENT", "CONFIRM_DATE", "ASK_PHONE_NUMBER"]
+END_STATES = ["AGENT_TRANSFER", "HANGUP", "NA"]
+INTENTS = ["_greeting_", "_confirm_", "_cancel_", "_what_", "inform_date", "_oos_"]
+WORDS = ["halo", "hello", "ya", "tidak", "booking", "cancel", "besok", "kamar", "tolong",
+         "agen", "operator", "terima", "kasih", "salon", "depan", "nomor", "tanggal"]
+
+MIN_TURNS = 2
+MAX_TURNS = 14
+
+# Distinct payloads per column, real dumps repeat a lot of them too
+MAX_UNIQUE_PAYLOADS = 20_000
+
+# Fraction of turns without alternatives and prediction
+MISSING_FRACTION = 0.1
+
+
+def _alternatives(rng: np.random.Generator) -> str:
+    alternatives = []
+    for _ in range(rng.integers(1, 8)):
+        transcript = " ".join(rng.choice(WORDS, size=rng.integers(1, 6)))
+        alternatives.append({"confidence": round(float(rng.random()), 8), "transcript": transcript})
+    return json.dumps([alternatives])
+
+
+def _prediction(rng: np.random.Generator) -> str:
+    return json.dumps({"name": str(rng.choice(INTENTS)), "score": float(rng.random()), "slot": []})
+
+
+def _state_sequence(rng: np.random.Generator, length: int) -> List[str]:
+    states = [str(rng.choice(STATES))]
+    while len(states) < length - 1:
+        # calls tend to stay in (and come back to) a few states
+        if rng.random() < 0.4:
+            states.append(states[-1])
+        elif rng.random() < 0.3:
+            states.append(str(rng.choice(states)))
+        else:
+            states.append(str(rng.choice(STATES)))
+    return states + [str(rng.choice(END_STATES))]
+
+
+def generate_calls(rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate a raw (JSON encoded, as in CSV dumps) call/turn dataframe.
+
+    Parameters:
+        rows (int): number of turns.
+        seed (int): random seed, the same seed gives the same dataframe.
+
+    Returns:
+        pd.DataFrame: dataframe with the columns of the production dumps.
+    """
+    rng = np.random.default_rng(seed)
+
+    lengths = rng.integers(MIN_TURNS, MAX_TURNS + 1, size=rows // MIN_TURNS + 1)
+    lengths = lengths[:np.searchsorted(np.cumsum(lengths), rows) + 1]
+    lengths[-1] -= lengths.sum() - rows
+    calls = len(lengths)
+
+    turn_call = np.repeat(np.arange(calls), lengths)
+    call_start = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    turn_position = np.arange(rows) - call_start[turn_call]
+
+    # state transitions of a call are repeated on all its turns
+    variants = 64
+    sequences = [_state_sequence(rng, length) for length in range(1, MAX_TURNS + 1) for _ in range(variants)]
+    sequence_strings = np.array([" -> ".join(sequence) for sequence in sequences], dtype=object)
+    sequence_states = np.array([state for sequence in sequences for state in sequence], dtype=object)
+    sequence_offsets = np.concatenate([[0], np.cumsum([len(sequence) for sequence in sequences])[:-1]])
+    call_sequence = (lengths - 1) * variants + rng.integers(0, variants, size=calls)
+    turn_sequence = call_sequence[turn_call]
+
+    unique_payloads = min(rows, MAX_UNIQUE_PAYLOADS)
+    alternatives = np.array([_alternatives(rng) for _ in range(unique_payloads)], dtype=object)
+    predictions = np.array([_prediction(rng) for _ in range(unique_payloads)], dtype=object)
+    alternatives = alternatives[rng.integers(0, unique_payloads, size=rows)]
+    predictions = predictions[rng.integers(0, unique_payloads, size=rows)]
+    missing = rng.random(rows) < MISSING_FRACTION
+    alternatives[missing] = np.nan
+    predictions[missing] = np.nan
+
+    call_uuids = np.array([str(uuid.UUID(bytes=rng.bytes(16))) for _ in range(calls)], dtype=object)
+    call_uuid = pd.Series(call_uuids[turn_call])
+    conversation_uuid = call_uuid + "-" + pd.Series(turn_position).astype(str)
+
+    return pd.DataFrame({
+        "call_uuid": call_uuid,
+        "conversation_uuid": conversation_uuid,
+        "alternatives": alternatives,
+        "audio_url": "https://sample/" + conversation_uuid + ".flac",
+        "reftime": "2021-09-15 11:02:44.097368 +0000 UTC",
+        "prediction": predictions,
+        "state": sequence_states[sequence_offsets[turn_sequence] + turn_position],
+        "call_duration": np.nan,
+        "state_transitions": sequence_strings[turn_sequence],
+    })
+
+
+def write_calls_csv(path: str, rows: int, seed: int = 0, chunksize: int = 1_000_000):
+    """
+    Write a synthetic call/turn CSV, generated in chunks to bound memory.
+
+    Parameters:
+        path (str): CSV path.
+        rows (int): number of turns.
+        seed (int): random seed.
+        chunksize (int): turns generated at a time.
+    """
+    for chunk, start in enumerate(range(0, rows, chunksize)):
+        df = generate_calls(min(chunksize, rows - start), seed=seed + chunk)
+        df.to_csv(path, mode="w" if chunk == 0 else "a", header=chunk == 0, index=False)
@@ -0,0 +1,72 @@
+"""
+Benchmarks of the hot paths: reading, every registered filter and the
+exporters (with network stubbed out).
+
+Run with `pytest benchmarks`, needs pytest-benchmark.
+"""
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from conftest import record_peak_memory  # noqa: E402
+from sentinel.dataframes.reader import CSVReader  # noqa: E402
+from sentinel.filters.base import FilterFactory  # noqa: E402
+from sentinel.exporters.csv import CSVExporter  # noqa: E402
+
+
+# kwargs for filters which need them to flag anything
+FILTER_KWARGS = {
+    "filter_words": {"word_list": ["agen", "operator", "cancel"]},
+    "call_end_state": {"end_state": ["AGENT_TRANSFER"]},
+}
+
+
+def _run_filter(name, df):
+    filter = FilterFactory.create_executor(name, **FILTER_KWARGS.get(name, {}))
+    return filter.run(df)
+
+
+def _get_results(df):
+    names = list(FilterFactory.registry)
+    return [_run_filter(name, df) for name in names], names
+
+
+def test_csv_reader(benchmark, calls_csv):
+    df = record_peak_memory(benchmark, lambda: CSVReader(calls_csv).read())
+    benchmark.extra_info["rows"] = len(df)
+
+    benchmark.pedantic(lambda: CSVReader(calls_csv).read(), rounds=3)
+
+
+@pytest.mark.parametrize("name", list(FilterFactory.registry))
+def test_filter(benchmark, calls_df, name):
+    # the first run builds the shared `df.sentinel` structures
+    df = calls_df.sentinel.view()
+    result = record_peak_memory(benchmark, _run_filter, name, df)
+    benchmark.extra_info["flagged"] = len(result)
+
+    benchmark(_run_filter, name, df)
+
+
+def test_csv_exporter(benchmark, calls_df):
+    df_list, categories = _get_results(calls_df)
+    exporter = CSVExporter()
+    record_peak_memory(benchmark, exporter.export_report, df_list, categories)
+
+    benchmark(exporter.export_report, df_list, categories)
+
+
+def test_slack_exporter(benchmark, calls_df, monkeypatch):
+    import sentinel.util as util
+    from sentinel.exporters.slack import SlackExporter
+
+    monkeypatch.setenv("SENTINEL_CONSOLE_HOST", "https://console/")
+    monkeypatch.setattr(util, "upload_dfs_to_s3",
+                        lambda dfs, *args, **kwargs: {object_name: True for object_name in dfs})
+
+    df_list, categories = _get_results(calls_df)
+    exporter = SlackExporter(config={"export": {"slack": {"channel_name": "benchmark"}}})
+    monkeypatch.setattr(exporter.delivery, "deliver", lambda threads: [None] * len(threads))
+    record_peak_memory(benchmark, exporter.export_report, df_list, categories)
+
+    benchmark(exporter.export_report, df_list, categories)
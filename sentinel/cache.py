@@ -0,0 +1,143 @@
+"""
+Local on-disk cache of parsed dataframes.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import tempfile
+from typing import Any, Optional
+
+import pandas as pd
+
+import sentinel.dataframes.accessor  # noqa: F401, registers `df.sentinel`
+
+
+# Default cache directory, under `$XDG_CACHE_HOME` if set.
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "sentinel")
+
+# Default size limit of the cache in megabytes.
+DEFAULT_MAX_SIZE_MB = 10 * 1024
+
+CACHE_SUFFIX = ".pkl"
+
+
+class DataFrameCache:
+    """
+    Content addressed cache of parsed dataframes.
+
+    Entries are keyed by the S3 object (bucket, key and ETag, so a changed
+    object is never served stale) and the options it was read with. The
+    dataframe is stored pickled together with its derived `df.sentinel`
+    structures, so a hit skips downloading, parsing and JSON decoding.
+    Least recently used entries are evicted once the cache grows over
+    `max_size_mb`.
+
+    Parameters:
+        directory (str): cache directory, created if missing.
+        max_size_mb (int): size limit of the cache in megabytes.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR,
+                 max_size_mb: float = DEFAULT_MAX_SIZE_MB):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = int(max_size_mb * 1024 * 1024)
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(s3_path: str, etag: str, **options: Any) -> str:
+        """
+        Get cache key of an S3 object read with given options.
+
+        Parameters:
+            s3_path (str): S3 path of the object.
+            etag (str): ETag of the object.
+            options: reader options affecting the parsed dataframe.
+
+        Returns:
+            str: sha256 hex digest.
+        """
+        payload = json.dumps([s3_path, etag, options], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    def get(self, key: str) -> Optional[pd.DataFrame]:
+        """
+        Get cached dataframe.
+
+        Parameters:
+            key (str): cache key.
+
+        Returns:
+            pd.DataFrame: cached dataframe, None if not cached.
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Dropping unreadable cache entry {path}: {e}")
+            self._remove(path)
+            return None
+
+        # mark as recently used
+        os.utime(path)
+
+        df = entry["df"]
+        df.sentinel._cache = entry["sentinel"]
+        return df
+
+    def put(self, key: str, df: pd.DataFrame):
+        """
+        Cache a dataframe, evicting least recently used entries if needed.
+
+        Parameters:
+            key (str): cache key.
+            df (pd.DataFrame): parsed dataframe.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump({"df": df, "sentinel": df.sentinel._cache}, f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._get_path(key))
+        except Exception:
+            self._remove(tmp_path)
+            raise
+
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits `max_size`.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            self._remove(os.path.join(self.directory, name))
+            size -= entry_size
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
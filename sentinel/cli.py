@@ -2,77 +2,529 @@
 sentinel: anomalous call monitoring framework.
 
 Usage:
-  sentinel run --config-yml=<config-yml>
+  sentinel run --config-yml=<config-yml> [--executor=<executor>] [--no-cache] [--metrics]
+               [--profile=<profiler>] [--profile-output=<path>] [--sample-rows=<rows>]
+  sentinel run-batch <config-yml>... [--max-workers=<max-workers>] [--no-cache]
+  sentinel stream --config-yml=<config-yml>
   sentinel list filters [--verbose]
   sentinel list exporters
 
 Options:
   --config-yml=<config-yml>      Path to file with sentinel configs.
+  --executor=<executor>          How to run the filters: sequential or process.
+                                 Overrides `executor` from the config.
+  --max-workers=<max-workers>    Number of worker processes running configs
+                                 sharing a dataframe. Defaults to one per config.
+  --no-cache                     Don't use the local dataframe cache.
+  --metrics                      Print time, memory and rows of every stage of the run.
+  --profile=<profiler>           Profile the run with `cprofile` (the default
+                                 with a bare `--profile`) or `sampling`, and
+                                 print the hotspots of every filter class.
+                                 Filters run sequentially while profiling.
+  --profile-output=<path>        Profile file: pstats for cprofile (defaults to
+                                 sentinel.prof), speedscope for sampling
+                                 (defaults to sentinel.speedscope.json).
+  --sample-rows=<rows>           Run on a deterministic subset of whole calls
+                                 with at most these many rows.
   --verbose                      Print verbose description of filters.
 """
-import io
-from docopt import docopt
+import json
+import logging
+import multiprocessing
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Dict, Iterator, List, Optional
 
+import pandas as pd
 import yaml
+from docopt import docopt
 from tabulate import tabulate
 
 import sentinel.util as util
-from sentinel.filters.base import FilterFactory
-from sentinel.exporters.base import ExporterFactory
-from sentinel.dataframes.reader import CSVReader
+from sentinel.filters.base import FilterBase, FilterFactory
+from sentinel.exporters.base import ExportError, Exporter, ExporterDispatcher, ExporterFactory
+from sentinel.dataframes.reader import ProtobufReader, Reader, get_reader_class
+from sentinel.cache import DataFrameCache
+from sentinel.incremental import Checkpoint, get_incremental_options, list_partitions, run_incremental
+from sentinel.instrumentation import instrumentation, stage
+from sentinel.profiling import profile, sample_calls
+from sentinel.stream import SOURCES, StreamProcessor
 from sentinel import __version__
 
 
-def main():
-    args = docopt(__doc__, version=__version__)
+# Dataframe shared with worker processes forked by `run_batch`
+_batch_df = None
+
+
+def load_config(config_file: str) -> Dict[str, Any]:
+    """
+    Load a sentinel config.
+
+    Parameters:
+        config_file (str): path to the config yaml.
+    """
+    with open(config_file, "r") as f:
+        return yaml.load(f, Loader=yaml.FullLoader)
+
+
+def build_filter_chain(config: Dict[str, Any]) -> Optional[FilterBase]:
+    """
+    Instantiate the configured filters chained to each other.
+
+    Parameters:
+        config (dict): sentinel config.
+
+    Returns:
+        FilterBase: first filter of the chain, None if no filters are configured.
+    """
+    filters = list(config.get("filters", {}).keys())
+
+    if not filters:
+        return None
+
+    # Instantiate first filter
+    filter = FilterFactory.create_executor(
+        filters[0], **config["filters"][filters[0]].get("kwargs", {}))
+    current_filter = filter
+
+    # Chain other filters to each other
+    for category in filters[1:]:
+        current_filter.successor = FilterFactory.create_executor(
+            category, **config["filters"][category].get("kwargs", {}))
+        current_filter = current_filter.successor
+
+    return filter
+
+
+def build_exporters(config: Dict[str, Any]) -> List[Exporter]:
+    """
+    Instantiate the configured exporters.
+
+    Parameters:
+        config (dict): sentinel config.
+
+    Returns:
+        list: exporters.
+    """
+    exporters = [ExporterFactory.create_executor(category, config=config)
+                 for category in config.get("export", {})]
+
+    return [exporter for exporter in exporters if exporter is not None]
+
+
+def export(config: Dict[str, Any], df_list: List[Any]):
+    """
+    Run the configured exporters concurrently on the filter results and
+    print their timing.
+
+    Parameters:
+        config (dict): sentinel config.
+        df_list (list): filter results.
+
+    Raises:
+        ExportError: if any exporter failed or timed out.
+    """
+    timeouts = {name: options["timeout"] for name, options in config.get("export", {}).items()
+                if isinstance(options, dict) and "timeout" in options}
+    dispatcher = ExporterDispatcher(build_exporters(config), timeout=config.get("export_timeout"),
+                                    timeouts=timeouts)
+
+    results = dispatcher.dispatch(df_list, list(config["filters"]))
+    print(dispatcher.summarize(results))
+
+    failed = [result.name for result in results if not result.ok]
+    if failed:
+        raise ExportError(f"Exporters failed: {', '.join(failed)}")
+
+
+def get_reader_kwargs(config: Dict[str, Any], columns: Optional[List[str]]) -> Dict[str, Any]:
+    """
+    Get reader options for a config.
+
+    Parameters:
+        config (dict): sentinel config.
+        columns (list): columns to read, all columns if None.
+    """
+    reader_kwargs = {
+        "columns": columns,
+        "filters": config.get("data_filters"),
+        "json_columns": config.get("json_columns"),
+    }
+    if get_reader_class(config["data_url"]) is ProtobufReader:
+        reader_kwargs["message_type"] = config.get("message_type")
+
+    return reader_kwargs
+
+
+def get_columns(config: Dict[str, Any], filter: FilterBase) -> Optional[List[str]]:
+    """
+    Get columns to read for a config: the configured `columns` and the ones
+    its filters read. All columns (None) if `columns` isn't set.
+
+    Parameters:
+        config (dict): sentinel config.
+        filter (FilterBase): first filter of the config's chain.
+    """
+    columns = config.get("columns")
+    filter_columns = filter.get_columns()
+    if columns and filter_columns is not None:
+        return columns + filter_columns
+
+    return None
+
+
+def get_reader(config: Dict[str, Any], reader_kwargs: Dict[str, Any],
+               head: Optional[Dict[str, Any]] = None) -> Reader:
+    """
+    Download the dataframe of a config and get a reader for it. The reader is
+    picked from the `data_url` extension (compression suffixes aside). With
+    `chunksize`, the download is spooled to disk unless configured otherwise.
+
+    Parameters:
+        config (dict): sentinel config.
+        reader_kwargs (dict): reader options.
+        head (dict): `head_object` response of `data_url`, if already fetched.
+                     The download is pinned to its ETag.
+    """
+    data_url = config["data_url"]
+    chunksize = config.get("chunksize")
+
+    download_options = {"spool": bool(chunksize), **(config.get("download") or {})}
+    body = util.download_fileobj(data_url, head=head, **download_options)
+
+    return get_reader_class(data_url)(body, chunksize=chunksize, **reader_kwargs)
+
+
+def load_dataframe(config: Dict[str, Any], reader_kwargs: Dict[str, Any],
+                   use_cache: bool = True) -> pd.DataFrame:
+    """
+    Download and read the dataframe of a config. Parsed dataframes are
+    cached locally if `cache` is configured.
+
+    Parameters:
+        config (dict): sentinel config.
+        reader_kwargs (dict): reader options.
+        use_cache (bool): use the cache if it is configured.
+    """
+    data_url = config["data_url"]
+
+    if "cache" not in config or not use_cache:
+        return read_dataframe(config, reader_kwargs)
+
+    head = util.head_object(data_url)
+    cache = DataFrameCache(**(config["cache"] or {}))
+    cache_key = cache.get_key(data_url, head["ETag"],
+                              reader=get_reader_class(data_url).__name__, **reader_kwargs)
+    df = cache.get(cache_key)
+    if df is None:
+        # download exactly the version the cache key was made for
+        df = read_dataframe(config, reader_kwargs, head)
+        cache.put(cache_key, df)
+
+    return df
 
-    if args["run"]:
-        config_file = args["--config-yml"]
-        config = yaml.load(open(config_file, "r"), Loader=yaml.FullLoader)
 
-        # Download dataframe and get pandas.DataFrame
-        s3_obj = util.download_file(config.get("data_url"))
-        csv_reader = CSVReader(io.BytesIO(s3_obj['Body'].read()))
-        df = csv_reader.read()
+def read_partition(config: Dict[str, Any], columns: Optional[List[str]],
+                   s3_path: str) -> Iterator[pd.DataFrame]:
+    """
+    Read an object of a partitioned `data_url`, in chunks if `chunksize`
+    is configured.
 
-        # Get set of filters to run
-        filters = list(config.get("filters", {}).keys())
+    Parameters:
+        config (dict): sentinel config.
+        columns (list): columns to read, all columns if None.
+        s3_path (str): S3 path of the object.
+    """
+    partition_config = {**config, "data_url": s3_path}
+    reader = get_reader(partition_config, get_reader_kwargs(partition_config, columns))
 
-        if not filters:
-            return None
+    if config.get("chunksize"):
+        yield from reader.read_chunks()
+    else:
+        yield reader.read()
 
-        # Collect filters from factory to run
-        # TODO: make instantiation and chaining more readable
 
-        # Instantiate first filter
-        filter = FilterFactory.create_executor(
-            filters[0], **config["filters"][filters[0]].get("kwargs", {}))
-        current_filter = filter
+def read_dataframe(config: Dict[str, Any], reader_kwargs: Dict[str, Any],
+                   head: Optional[Dict[str, Any]] = None) -> pd.DataFrame:
+    """
+    Download and read the whole dataframe of a config.
 
-        # Chain other filters to each other
-        for category in filters[1:]:
-            current_filter.successor = FilterFactory.create_executor(
-                category, **config["filters"][category].get("kwargs", {}))
-            current_filter = current_filter.successor
+    Parameters:
+        config (dict): sentinel config.
+        reader_kwargs (dict): reader options.
+        head (dict): `head_object` response of `data_url`, if already fetched.
+    """
+    reader = get_reader(config, reader_kwargs, head)
+    with stage("read") as record:
+        df = reader.read()
+        record.rows_out = len(df)
 
-        # Start execution of analysis functions
-        df_list = filter.handle(df, [])
+    return df
 
-        exporters = list(config.get("export", {}).keys())
 
-        # Collect exporters from factory to run
-        # TODO: make instantiation and chaining more readable
+def report_metrics(config: Dict[str, Any], print_summary: bool = False):
+    """
+    Report the stage metrics of a run: print them and write them to the
+    files configured under `metrics`.
+
+    Parameters:
+        config (dict): sentinel config.
+        print_summary (bool): print a table of the metrics.
+    """
+    if print_summary:
+        print(instrumentation.summary())
+
+    metrics_config = config.get("metrics") or {}
+    if metrics_config.get("json"):
+        instrumentation.write_json(metrics_config["json"])
+    if metrics_config.get("prometheus"):
+        labels = {"config": config["name"]} if config.get("name") else None
+        instrumentation.write_prometheus(metrics_config["prometheus"], labels)
+
+
+def run_config(config: Dict[str, Any], executor: Optional[str] = None, use_cache: bool = True,
+               print_metrics: bool = False, sample_rows: Optional[int] = None):
+    """
+    Run the filters of a config on its dataframe and export their results.
+
+    Parameters:
+        config (dict): sentinel config.
+        executor (str): how to run the filters, overrides `executor` from the config.
+        use_cache (bool): use the dataframe cache if it is configured.
+        print_metrics (bool): print time, memory and rows of every stage.
+        sample_rows (int): run on a subset of whole calls with at most these
+                           many rows. The dataframe is read whole, ignoring
+                           `chunksize`.
+    """
+    filter = build_filter_chain(config)
+    if filter is None:
+        return None
+
+    instrumentation.reset()
+
+    columns = get_columns(config, filter)
+    reader_kwargs = get_reader_kwargs(config, columns)
+    checkpoint = None
+
+    # Start execution of analysis functions
+    executor = executor or config.get("executor", "sequential")
+    if config.get("incremental"):
+        options = get_incremental_options(config)
+        checkpoint = Checkpoint.load(options["checkpoint"])
+        partitions = list_partitions(config["data_url"], checkpoint)
+        df_list = run_incremental(filter, partitions, partial(read_partition, config, columns),
+                                  checkpoint, options["settle_partitions"])
+    elif config.get("chunksize") and not sample_rows:
+        df_list = filter.handle_chunks(get_reader(config, reader_kwargs).read_chunks())
+    else:
+        df = load_dataframe(config, reader_kwargs, use_cache)
+        if sample_rows:
+            df = sample_calls(df, sample_rows)
+
+        if executor == "process":
+            df_list = filter.handle_parallel(df, config.get("max_workers"))
+        else:
+            df_list = filter.handle(df, [])
+
+    try:
+        if checkpoint is not None and not partitions and not any(len(result) for result in df_list):
+            logging.info("No new partitions and no settled calls, skipping the export")
+            return
+
+        export(config, df_list)
+        # only record progress once the results are exported
+        if checkpoint is not None:
+            checkpoint.save()
+    finally:
+        report_metrics(config, print_metrics)
+
+
+def run_stream(config: Dict[str, Any]):
+    """
+    Run the filters of a config on turn events streamed from the source
+    configured under `stream`, sending flagged rows to the exporters as
+    they come in. Runs till interrupted.
+
+    Parameters:
+        config (dict): sentinel config.
+    """
+    filter = build_filter_chain(config)
+    if filter is None:
+        return None
+
+    options = dict(config.get("stream") or {})
+    source_name = options.pop("source", "file")
+    if source_name not in SOURCES or source_name == "queue":
+        raise ValueError(f"Unknown stream source {source_name}, use file or socket")
+
+    source_kwargs = {"path": options.pop("path")}
+    if source_name == "file":
+        source_kwargs["from_start"] = options.pop("from_start", False)
+    run_kwargs = {key: options.pop(key) for key in ("batch_interval", "max_batch") if key in options}
+
+    processor = StreamProcessor(filter, build_exporters(config), export_timeout=config.get("export_timeout"),
+                                json_columns=config.get("json_columns"), **options)
+    source = SOURCES[source_name](**source_kwargs)
+    try:
+        processor.run(source, **run_kwargs)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+
+
+def _run_shared_config(config: Dict[str, Any]):
+    """
+    Run the filters of a config on the dataframe shared by `run_batch` and
+    export their results. Runs in a forked worker process.
+    """
+    instrumentation.reset()
+    filter = build_filter_chain(config)
+    df_list = filter.handle(_batch_df, [])
+    try:
+        export(config, df_list)
+    finally:
+        report_metrics(config)
+
+
+def _get_dataset_key(config: Dict[str, Any]) -> str:
+    """
+    Key of the dataset a config reads: its data url and the reader options
+    which change the rows or their decoding.
+    """
+    return json.dumps([config.get("data_url"), config.get("data_filters"),
+                       config.get("json_columns"), config.get("message_type")],
+                      sort_keys=True, default=str)
+
+
+def run_batch(config_files: List[str], max_workers: Optional[int] = None,
+              use_cache: bool = True) -> List[str]:
+    """
+    Run many configs, loading every dataset only once.
+
+    Configs are grouped by dataset (`data_url` and reader options). Every
+    dataset is read once, with the columns needed by all of its configs,
+    and the configs' filter chains and exporters run concurrently in forked
+    worker processes sharing it. Configs with `chunksize` or
+    `incremental` run on their own.
+
+    Parameters:
+        config_files (list): paths to the config yamls.
+        max_workers (int): number of worker processes. Defaults to one per config.
+        use_cache (bool): use the dataframe cache if it is configured.
+
+    Returns:
+        list: config files which failed.
+    """
+    global _batch_df
+
+    failed = []
+    datasets = {}
+    for config_file in config_files:
+        config = load_config(config_file)
+        if not config.get("filters"):
+            continue
+        if config.get("chunksize") or config.get("incremental"):
+            datasets[config_file] = [(config_file, config)]
+        else:
+            datasets.setdefault(_get_dataset_key(config), []).append((config_file, config))
+
+    can_fork = "fork" in multiprocessing.get_all_start_methods()
+
+    for dataset_configs in datasets.values():
+        config_files, configs = zip(*dataset_configs)
+
+        if configs[0].get("chunksize") or configs[0].get("incremental"):
+            try:
+                run_config(configs[0], use_cache=use_cache)
+            except Exception:
+                logging.exception(f"Failed to run {config_files[0]}")
+                failed.append(config_files[0])
+            continue
+
+        # read the columns needed by any of the configs
+        columns = [get_columns(config, build_filter_chain(config)) for config in configs]
+        if any(config_columns is None for config_columns in columns):
+            columns = None
+        else:
+            columns = list(dict.fromkeys(column for config_columns in columns for column in config_columns))
+
+        try:
+            df = load_dataframe(configs[0], get_reader_kwargs(configs[0], columns), use_cache)
+        except Exception:
+            logging.exception(f"Failed to load {configs[0]['data_url']}")
+            failed.extend(config_files)
+            continue
+
+        _batch_df = df
+        try:
+            if can_fork and len(configs) > 1:
+                with ProcessPoolExecutor(max_workers=min(max_workers or len(configs), len(configs)),
+                                         mp_context=multiprocessing.get_context("fork"),
+                                         initializer=util.reset_s3_clients) as executor:
+                    futures = [executor.submit(_run_shared_config, config) for config in configs]
+                    results = [future.exception() for future in futures]
+            else:
+                results = []
+                for config in configs:
+                    try:
+                        _run_shared_config(config)
+                        results.append(None)
+                    except Exception as e:
+                        results.append(e)
+        finally:
+            _batch_df = None
+
+        for config_file, error in zip(config_files, results):
+            if error is not None:
+                logging.error(f"Failed to run {config_file}", exc_info=error)
+                failed.append(config_file)
+
+    return failed
+
+
+def _default_profiler(argv: List[str]) -> List[str]:
+    """
+    Give a bare `--profile` the default profiler, as docopt has no options
+    with optional values. `--profile sampling` is left as it is.
+    """
+    argv = list(argv)
+    for idx, arg in enumerate(argv):
+        if arg == "--profile" and (idx + 1 == len(argv) or argv[idx + 1].startswith("-")):
+            argv[idx] = "--profile=cprofile"
+
+    return argv
+
+
+def main():
+    args = docopt(__doc__, argv=_default_profiler(sys.argv[1:]), version=__version__)
+
+    if args["run"]:
+        config = load_config(args["--config-yml"])
+        sample_rows = int(args["--sample-rows"]) if args["--sample-rows"] else None
+        run_kwargs = {"use_cache": not args["--no-cache"], "print_metrics": args["--metrics"],
+                      "sample_rows": sample_rows}
 
-        # Instantiate first exporter
-        exporter = ExporterFactory.create_executor(exporters[0], config=config)
-        current_exporter = exporter
+        if args["--profile"]:
+            # forked filter workers wouldn't be profiled
+            with profile(args["--profile"], args["--profile-output"]) as profiler:
+                run_config(config, "sequential", **run_kwargs)
+            print(profiler.report())
+            print(f"Profile written to {profiler.output}")
+        else:
+            run_config(config, args["--executor"], **run_kwargs)
 
-        # Chain other exporters to each other
-        for category in exporters[1:]:
-            current_exporter.successor = ExporterFactory.create_executor(category, config=config)
-            current_exporter = current_exporter.successor
+    elif args["stream"]:
+        run_stream(load_config(args["--config-yml"]))
 
-        df_list = exporter.handle(df_list, filters)
+    elif args["run-batch"]:
+        max_workers = args["--max-workers"]
+        failed = run_batch(args["<config-yml>"], int(max_workers) if max_workers else None,
+                           use_cache=not args["--no-cache"])
+        if failed:
+            print("Failed configs:\n" + "\n".join(failed))
+            sys.exit(1)
 
     elif args["list"] and args["filters"]:
         is_verbose = args.get("--verbose")
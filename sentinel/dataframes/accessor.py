@@ -0,0 +1,56 @@
+"""
+`df.sentinel` accessor holding derived structures of a call/turn dataframe.
+
+pandas caches an accessor on the dataframe it was created for, so everything
+here is computed at most once per dataframe and shared by all the filters.
+"""
+import pandas as pd
+
+from sentinel.dataframes.columnar import AlternativesArray, CallIndex, StateTransitions
+
+
+@pd.api.extensions.register_dataframe_accessor("sentinel")
+class SentinelAccessor:
+    """
+    Derived, read only structures of a call/turn dataframe.
+
+    Attributes:
+        alternatives (AlternativesArray): flat representation of the `alternatives` column.
+        calls (CallIndex): positions of the turns of every call.
+        state_transitions (StateTransitions): parsed `state_transitions` column.
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self._df = df
+        self._cache = {}
+
+    def view(self) -> pd.DataFrame:
+        """
+        Shallow copy of the dataframe sharing its data and derived structures.
+        Columns added to the copy don't show up in the original dataframe.
+
+        Returns:
+            pd.DataFrame: shallow copy of the dataframe.
+        """
+        view = self._df.copy(deep=False)
+        view.sentinel._cache = self._cache
+
+        return view
+
+    @property
+    def alternatives(self) -> AlternativesArray:
+        if "alternatives" not in self._cache:
+            self._cache["alternatives"] = AlternativesArray.from_series(self._df.alternatives)
+        return self._cache["alternatives"]
+
+    @property
+    def calls(self) -> CallIndex:
+        if "calls" not in self._cache:
+            self._cache["calls"] = CallIndex.from_series(self._df.call_uuid)
+        return self._cache["calls"]
+
+    @property
+    def state_transitions(self) -> StateTransitions:
+        if "state_transitions" not in self._cache:
+            self._cache["state_transitions"] = StateTransitions.from_series(self._df.state_transitions)
+        return self._cache["state_transitions"]
@@ -0,0 +1,326 @@
+"""
+Compact, array backed representations of nested call/turn columns.
+"""
+from typing import Any, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class AlternativesArray:
+    """
+    Flat representation of the ASR `alternatives` column.
+
+    Only the first utterance of every turn is kept, which is what the filters
+    look at. Alternatives of the turn at position `i` live in the slice
+    `offsets[i]:offsets[i + 1]` of the flat arrays.
+
+    Attributes:
+        index (pd.Index): index of the dataframe these alternatives belong to.
+        offsets (np.ndarray): start offset of every turn's alternatives, `len(index) + 1` items.
+        turn (np.ndarray): turn position of every alternative.
+        rank (np.ndarray): position of every alternative within its turn.
+        confidence (np.ndarray): confidence of every alternative.
+        transcript_ids (np.ndarray): position of every alternative's transcript in `transcripts`.
+        transcripts (np.ndarray): table of unique transcripts.
+        missing (np.ndarray): mask of turns with missing or empty `alternatives`.
+    """
+
+    def __init__(self, index: pd.Index, offsets: np.ndarray, confidence: np.ndarray,
+                 transcript_ids: np.ndarray, transcripts: np.ndarray,
+                 missing: Optional[np.ndarray] = None):
+        self.index = index
+        self.offsets = offsets
+        self.confidence = confidence
+        self.transcript_ids = transcript_ids
+        self.transcripts = transcripts
+        self.missing = np.diff(offsets) == 0 if missing is None else missing
+
+        lengths = np.diff(offsets)
+        self.turn = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        self.rank = np.arange(len(self.turn), dtype=np.int64) - offsets[self.turn]
+
+        self._best = None
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @classmethod
+    def from_series(cls, series: pd.Series) -> "AlternativesArray":
+        """
+        Build the flat arrays from a series of decoded alternatives.
+
+        Parameters:
+            series (pd.Series): decoded alternatives, list of utterances per turn.
+
+        Returns:
+            AlternativesArray: flat alternatives.
+        """
+        offsets = np.zeros(len(series) + 1, dtype=np.int64)
+        missing = np.zeros(len(series), dtype=bool)
+        confidence: List[float] = []
+        transcript_ids: List[int] = []
+        transcript_table = {}
+
+        for idx, item in enumerate(series.values):
+            missing[idx] = not item
+            alternatives = cls._first_utterance(item)
+            for alternative in alternatives:
+                confidence.append(alternative.get("confidence", np.nan))
+                transcript = alternative.get("transcript", "")
+                transcript_ids.append(
+                    transcript_table.setdefault(transcript, len(transcript_table)))
+            offsets[idx + 1] = offsets[idx] + len(alternatives)
+
+        transcripts = np.empty(len(transcript_table), dtype=object)
+        transcripts[:] = list(transcript_table)
+
+        return cls(series.index, offsets,
+                   np.asarray(confidence, dtype=np.float64),
+                   np.asarray(transcript_ids, dtype=np.int32),
+                   transcripts, missing)
+
+    @staticmethod
+    def _first_utterance(item: Any) -> List:
+        if not item or not isinstance(item, list):
+            return []
+        return item[0] or []
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Number of alternatives of every turn.
+        """
+        return np.diff(self.offsets)
+
+    def is_empty(self) -> np.ndarray:
+        """
+        Mask of turns with missing or empty `alternatives`. Turns with only
+        empty utterances (`[[]]`) have no alternatives to rank but aren't
+        empty.
+        """
+        return self.missing
+
+    def best(self) -> np.ndarray:
+        """
+        Flat position of the highest confidence alternative of every turn, -1
+        for turns without alternatives. Ties go to the alternative ranked first.
+        """
+        if self._best is None:
+            best = np.full(len(self), -1, dtype=np.int64)
+            if len(self.turn):
+                order = np.lexsort((self.rank, -self.confidence, self.turn))
+                turns = self.turn[order]
+                first = np.ones(len(order), dtype=bool)
+                first[1:] = turns[1:] != turns[:-1]
+                best[turns[first]] = order[first]
+            self._best = best
+        return self._best
+
+    def best_confidence(self) -> np.ndarray:
+        """
+        Confidence of the best alternative of every turn, NaN for turns without alternatives.
+        """
+        best = self.best()
+        confidence = np.full(len(self), np.nan, dtype=np.float64)
+        has_best = best >= 0
+        confidence[has_best] = self.confidence[best[has_best]]
+        return confidence
+
+    def best_transcript(self) -> np.ndarray:
+        """
+        Transcript of the best alternative of every turn, None for turns without alternatives.
+        """
+        best = self.best()
+        transcript = np.full(len(self), None, dtype=object)
+        has_best = best >= 0
+        transcript[has_best] = self.transcripts[self.transcript_ids[best[has_best]]]
+        return transcript
+
+
+class CallIndex:
+    """
+    Positions of the turns of every call in a dataframe.
+
+    Calls are numbered in order of their first turn. Turns of the call
+    numbered `i` are at row positions `order[offsets[i]:offsets[i + 1]]`, in
+    the order they appear in the dataframe. Rows without a call uuid don't
+    belong to any call.
+
+    Attributes:
+        calls (np.ndarray): call uuids.
+        codes (np.ndarray): call number of every row, -1 for rows without a call uuid.
+        order (np.ndarray): row positions sorted by call.
+        offsets (np.ndarray): start offset of every call's turns in `order`, `len(calls) + 1` items.
+        first (np.ndarray): row position of the first turn of every call.
+        last (np.ndarray): row position of the last turn of every call.
+    """
+
+    def __init__(self, calls: np.ndarray, codes: np.ndarray):
+        self.calls = calls
+        self.codes = codes
+
+        rows = np.flatnonzero(codes >= 0)
+        self.order = rows[np.argsort(codes[rows], kind="stable")]
+
+        self.offsets = np.zeros(len(calls) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(codes[rows], minlength=len(calls)), out=self.offsets[1:])
+
+        self.first = self.order[self.offsets[:-1]]
+        self.last = self.order[self.offsets[1:] - 1]
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    @classmethod
+    def from_series(cls, series: pd.Series) -> "CallIndex":
+        """
+        Build the index from the call uuid column.
+
+        Parameters:
+            series (pd.Series): call uuid of every turn.
+
+        Returns:
+            CallIndex: call index.
+        """
+        codes, calls = pd.factorize(series)
+
+        return cls(np.asarray(calls), codes.astype(np.int64))
+
+    @property
+    def lengths(self) -> np.ndarray:
+        """
+        Number of turns of every call.
+        """
+        return np.diff(self.offsets)
+
+    def turns(self, call: int) -> np.ndarray:
+        """
+        Row positions of the turns of a call.
+
+        Parameters:
+            call (int): call number.
+        """
+        return self.order[self.offsets[call]:self.offsets[call + 1]]
+
+    def last_turns(self) -> np.ndarray:
+        """
+        Row positions of the last turn of every call, in dataframe order.
+        """
+        return np.sort(self.last)
+
+
+class StateTransitions:
+    """
+    Integer coded representation of the `state_transitions` column.
+
+    Every distinct transition string (`"COF -> COF -> NA"`) is parsed only
+    once into a sequence of state ids. States of the sequence numbered `i`
+    are `codes[offsets[i]:offsets[i + 1]]`.
+
+    Attributes:
+        sequences (pd.Index): distinct transition strings.
+        states (np.ndarray): state vocabulary, state id -> state name.
+        codes (np.ndarray): state ids of all the sequences, flattened.
+        offsets (np.ndarray): start offset of every sequence in `codes`, `len(sequences) + 1` items.
+    """
+
+    def __init__(self, sequences: pd.Index, states: np.ndarray,
+                 codes: np.ndarray, offsets: np.ndarray):
+        self.sequences = sequences
+        self.states = states
+        self.codes = codes
+        self.offsets = offsets
+
+        lengths = np.diff(offsets)
+        self.sequence = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+
+        self._max_state_count = None
+        self._max_visit_count = None
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    @classmethod
+    def from_series(cls, series: pd.Series, separator: str = "->") -> "StateTransitions":
+        """
+        Parse distinct transition strings of a column.
+
+        Parameters:
+            series (pd.Series): state transitions of every turn.
+            separator (str): separator between states.
+
+        Returns:
+            StateTransitions: parsed state transitions.
+        """
+        sequences = pd.Index(pd.unique(series.dropna()))
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        codes: List[int] = []
+        vocabulary = {}
+
+        for idx, sequence in enumerate(sequences):
+            states = [state.strip() for state in str(sequence).split(separator)]
+            codes.extend(vocabulary.setdefault(state, len(vocabulary)) for state in states)
+            offsets[idx + 1] = offsets[idx] + len(states)
+
+        states = np.empty(len(vocabulary), dtype=object)
+        states[:] = list(vocabulary)
+
+        return cls(sequences, states, np.asarray(codes, dtype=np.int64), offsets)
+
+    def lookup(self, series: pd.Series) -> np.ndarray:
+        """
+        Sequence number of every transition string, -1 for missing or unknown ones.
+
+        Parameters:
+            series (pd.Series): state transitions.
+        """
+        return self.sequences.get_indexer(series)
+
+    def _per_row(self, values: np.ndarray, series: pd.Series) -> np.ndarray:
+        ids = self.lookup(series)
+        result = np.zeros(len(ids), dtype=values.dtype)
+        known = ids >= 0
+        result[known] = values[ids[known]]
+        return result
+
+    def _max_count(self, sequence: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        """
+        Highest number of occurrences of a single state in every sequence.
+        """
+        keys, counts = np.unique(sequence * len(self.states) + codes, return_counts=True)
+        max_count = np.zeros(len(self), dtype=np.int64)
+        np.maximum.at(max_count, keys // max(len(self.states), 1), counts)
+        return max_count
+
+    def max_state_count(self, series: pd.Series) -> np.ndarray:
+        """
+        Highest number of times any single state occurs in the transitions.
+
+        Parameters:
+            series (pd.Series): state transitions.
+
+        Returns:
+            np.ndarray: count for every item of `series`, 0 for missing items.
+        """
+        if self._max_state_count is None:
+            self._max_state_count = self._max_count(self.sequence, self.codes)
+        return self._per_row(self._max_state_count, series)
+
+    def max_visit_count(self, series: pd.Series) -> np.ndarray:
+        """
+        Highest number of separate visits to any single state in the
+        transitions. Consecutive repeats of a state count as one visit.
+
+        Parameters:
+            series (pd.Series): state transitions.
+
+        Returns:
+            np.ndarray: count for every item of `series`, 0 for missing items.
+        """
+        if self._max_visit_count is None:
+            # first state of every run of repeated states
+            visit = np.ones(len(self.codes), dtype=bool)
+            visit[1:] = (self.codes[1:] != self.codes[:-1]) | (self.sequence[1:] != self.sequence[:-1])
+            self._max_visit_count = self._max_count(self.sequence[visit], self.codes[visit])
+        return self._per_row(self._max_visit_count, series)
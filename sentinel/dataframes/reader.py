@@ -1,16 +1,94 @@
 """
-Input dataframe readers. Currently supports Protobuf and CSVs
+Input dataframe readers. Currently supports CSV, Parquet, Arrow IPC and Protobuf.
 """
-import json
+import importlib
+import mmap
+import os
 from abc import ABC, abstractmethod
-from typing import Dict, Any
+from typing import Callable, Dict, Any, Iterator, List, Optional, Tuple, Type, Union
 
+import numpy as np
 import pandas as pd
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    from google.protobuf import json_format
+    from google.protobuf.message import Message
+except ImportError:
+    json_format = None
+
+import sentinel.dataframes.accessor  # noqa: F401, registers `df.sentinel`
+from sentinel.instrumentation import stage
+
+
+# Number of rows per chunk when a reader streams its input.
+DEFAULT_CHUNKSIZE = 100_000
+
+# Prefix of the hidden columns keeping raw strings of decoded JSON columns.
+RAW_JSON_PREFIX = "_raw_"
+
+# Columns added at read time, not part of the input.
+DERIVED_COLUMNS = ["prediction_score"]
+
+# Bytes read at a time from file-like protobuf inputs.
+PROTOBUF_BLOCKSIZE = 1 << 20
+
+# Row filter operators, see `Reader`.
+FILTER_OPERATORS = {
+    "=": lambda column, value: column == value,
+    "==": lambda column, value: column == value,
+    "!=": lambda column, value: column != value,
+    "<": lambda column, value: column < value,
+    "<=": lambda column, value: column <= value,
+    ">": lambda column, value: column > value,
+    ">=": lambda column, value: column >= value,
+    "in": lambda column, value: column.isin(value),
+    "not in": lambda column, value: ~column.isin(value),
+}
+
 
 class Reader(ABC):
-    def __init__(self, path: str):
+    """
+    Base class for input dataframe readers.
+
+    JSON encoded columns are decoded once at read time so filters never
+    decode (or mutate) them.
+
+    Parameters:
+        path (str): file path or file-like object to read from.
+        chunksize (int): rows per chunk for `read_chunks`.
+        columns (list): only read these columns. Reads all columns if not set.
+        filters (list): only read rows matching all of these
+                        `(column, operator, value)` filters, e.g.
+                        `("date", "=", "2021-09-15")`. Operators: =, ==, !=,
+                        <, <=, >, >=, in, not in.
+        json_columns (list): extra JSON encoded columns to decode, on top of
+                             `alternatives` and `prediction`.
+    """
+
+    # JSON encoded columns decoded at read time
+    json_columns = ["alternatives", "prediction"]
+
+    def __init__(self, path: str, chunksize: Optional[int] = None,
+                 columns: Optional[List[str]] = None,
+                 filters: Optional[List[Tuple[str, str, Any]]] = None,
+                 json_columns: Optional[List[str]] = None):
         self.path = path
+        self.chunksize = chunksize or DEFAULT_CHUNKSIZE
+        self.columns = list(dict.fromkeys(columns)) if columns else None
+        self.filters = [tuple(row_filter) for row_filter in filters] if filters else None
+        self.json_columns = self.json_columns + [
+            column for column in json_columns or [] if column not in self.json_columns]
 
     @abstractmethod
     def read(self):
@@ -22,51 +100,578 @@ class Reader(ABC):
         """
         raise NotImplementedError
 
+    def read_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Read input dataframe as a stream of bounded-size dataframes.
+
+        Readers which can't stream their input yield the whole dataframe as a
+        single chunk.
+
+        Returns:
+            Iterator[pd.DataFrame]: dataframe chunks of at most `chunksize` rows.
+        """
+        yield self.read()
+
+    @staticmethod
+    def _decode_json(series: pd.Series) -> List[Any]:
+        """
+        Decode a column of stringified json. Identical payloads are decoded
+        only once and share the decoded object. Items which are already
+        decoded are kept as they are.
+
+        Parameters:
+            series (pd.Series): stringified json column.
+
+        Returns:
+            list: decoded items, empty list for missing or empty items.
+        """
+        decoded = {}
+        items = []
+        for item in series.values:
+            if not isinstance(item, str):
+                items.append([] if item is None or item is np.nan or
+                             (isinstance(item, float) and np.isnan(item)) else item)
+                continue
+            if not item:
+                items.append([])
+                continue
+
+            value = decoded.get(item)
+            if value is None:
+                value = decoded[item] = json_loads(item)
+            items.append(value)
+
+        return items
+
+    @staticmethod
+    def _get_prediction_score(series: pd.Series) -> pd.Series:
+        """
+        Extract prediction score from decoded predictions.
+
+        Parameters:
+            series (pd.Series): decoded prediction column.
+
+        Returns:
+            pd.Series: float scores, NaN for turns without a score.
+        """
+        return pd.to_numeric(series.str.get("score"), errors="coerce").astype(float)
+
+    def _filter_rows(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Drop rows not matching `filters`, for readers which can't push them
+        down to the storage layer.
+
+        Parameters:
+            df (pd.DataFrame): call dataframe.
+        """
+        if not self.filters:
+            return df
+
+        mask = np.ones(len(df), dtype=bool)
+        for column, operator, value in self.filters:
+            mask &= FILTER_OPERATORS[operator](df[column], value).values
+
+        # a copy, as `_post_read` adds columns
+        return df.loc[mask].copy()
+
+    def _post_read(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Post read transformations.
+
+        Transformations done:
+        - Convert stringified json columns (`json_columns`) to native format.
+          The raw strings are kept in hidden `_raw_<column>` columns so
+          exporters can write them back without encoding them again.
+        - Extract prediction score as a float `prediction_score` column.
+        - Build the flat alternatives arrays (`df.sentinel.alternatives`)
+          shared by the ASR filters.
+        - Build the call index (`df.sentinel.calls`) and parse state
+          transitions (`df.sentinel.state_transitions`) shared by the call
+          level filters.
+
+        Parameters:
+            df (pd.DataFrame): call dataframe.
+        """
+        with stage("reader:post_read", rows_in=len(df)) as record:
+            for column in self.json_columns:
+                if column in df:
+                    raw = df[column]
+                    df[column] = pd.Series(self._decode_json(raw), index=df.index, dtype=object)
+                    if pd.api.types.infer_dtype(raw, skipna=True) == "string":
+                        df[RAW_JSON_PREFIX + column] = raw
+
+            if "prediction" in df:
+                df["prediction_score"] = self._get_prediction_score(df.prediction)
+
+            if "alternatives" in df:
+                df.sentinel.alternatives
+            if "call_uuid" in df:
+                df.sentinel.calls
+            if "state_transitions" in df:
+                df.sentinel.state_transitions
+
+            record.rows_out = len(df)
+
+        return df
+
+
+class ArrowReaderBase(Reader):
+    """
+    Base class for readers of Arrow backed formats. Needs `pyarrow`.
+
+    Columns are projected and rows filtered on the Arrow table, before
+    anything is converted to pandas.
+    """
 
-class ProtobufReader(Reader):
     def __init__(self, *args, **kwargs):
+        if pa is None:
+            raise ImportError(f"{type(self).__name__} needs pyarrow, install the `arrow` extra")
+
         super().__init__(*args, **kwargs)
 
-    def read(self):
-        raise NotImplementedError
+    def _check_columns(self, names: List[str]):
+        """
+        Make sure the projected and filtered columns are in the input.
 
+        Parameters:
+            names (list): column names of the input.
+        """
+        filter_columns = [column for column, _, _ in self.filters or []]
+        missing = [column for column in dict.fromkeys((self.columns or []) + filter_columns)
+                   if column not in names]
+        if missing:
+            raise ValueError(f"Columns not in the input: {', '.join(missing)}")
+
+    def _select(self, table: "pa.Table") -> "pa.Table":
+        """
+        Project `columns` and apply `filters` on an Arrow table.
+        """
+        self._check_columns(table.column_names)
+        if self.filters:
+            table = table.filter(pq.filters_to_expression(self.filters))
+        if self.columns:
+            table = table.select(self.columns)
+
+        return table
+
+    def _to_frame(self, table: "pa.Table", start: int = 0) -> pd.DataFrame:
+        """
+        Convert an Arrow table to a call dataframe.
+
+        Nested JSON columns (list/struct typed) are converted to native lists
+        and dicts, stringified ones are decoded by `_post_read`.
+
+        Parameters:
+            table (pa.Table): Arrow table.
+            start (int): index of the first row, so the index continues across chunks.
+        """
+        df = table.to_pandas()
+        df.index = pd.RangeIndex(start, start + len(df))
+
+        for column in self.json_columns:
+            if column in table.column_names and pa.types.is_nested(table.schema.field(column).type):
+                df[column] = table.column(column).to_pylist()
+
+        return self._post_read(df)
+
+    def _read_chunked(self, batches: Iterator["pa.RecordBatch"]) -> Iterator[pd.DataFrame]:
+        """
+        Convert record batches to dataframe chunks of at most `chunksize` rows.
+        """
+        start = 0
+        for batch in batches:
+            table = self._select(pa.Table.from_batches([batch]))
+            for chunk in table.to_batches(max_chunksize=self.chunksize):
+                yield self._to_frame(pa.Table.from_batches([chunk]), start)
+                start += chunk.num_rows
+
+
+class ParquetReader(ArrowReaderBase):
+    """
+    Parquet reader. Projected columns are the only ones read from the file
+    and row filters are pushed down to skip row groups.
+    """
 
-class CSVReader(Reader):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    @staticmethod
-    def _jsonify(item: str) -> Dict[str, Any]:
+    def read(self) -> pd.DataFrame:
+        self._check_columns(pq.read_schema(self.path).names)
+        table = pq.read_table(self.path, columns=self.columns, filters=self.filters)
+
+        return self._to_frame(table)
+
+    def read_chunks(self) -> Iterator[pd.DataFrame]:
+        with pq.ParquetFile(self.path) as parquet_file:
+            self._check_columns(parquet_file.schema_arrow.names)
+            columns = self.columns
+            if columns:
+                filter_columns = [column for column, _, _ in self.filters or []]
+                columns = list(dict.fromkeys(columns + filter_columns))
+
+            yield from self._read_chunked(
+                parquet_file.iter_batches(batch_size=self.chunksize, columns=columns))
+
+
+class ArrowReader(ArrowReaderBase):
+    """
+    Arrow IPC reader for both the file (Feather v2) and the streaming
+    format. Files on disk are memory mapped.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def _open(self):
+        source = pa.memory_map(self.path) if isinstance(self.path, str) else self.path
+        try:
+            return pa.ipc.open_file(source)
+        except pa.ArrowInvalid:
+            source.seek(0)
+            return pa.ipc.open_stream(source)
+
+    def read(self) -> pd.DataFrame:
+        table = self._select(self._open().read_all())
+
+        return self._to_frame(table)
+
+    def read_chunks(self) -> Iterator[pd.DataFrame]:
+        reader = self._open()
+        if isinstance(reader, pa.ipc.RecordBatchFileReader):
+            batches = (reader.get_batch(idx) for idx in range(reader.num_record_batches))
+        else:
+            batches = iter(reader)
+
+        yield from self._read_chunked(batches)
+
+
+class ProtobufReader(Reader):
+    """
+    Reader for a stream of length-delimited protobuf messages, one message per
+    turn. Every message is prefixed with its size as a varint, as written by
+    `writeDelimitedTo` in Java or `SerializeDelimitedToString` in C++.
+
+    Messages are parsed straight from the file buffer (memory mapped for
+    paths, read in blocks for file-like objects such as S3 bodies) and their
+    fields appended to per-column arrays, without an intermediate dict per
+    row. Nested message fields are converted to native dicts and lists, so
+    `alternatives` and `prediction` may be either JSON strings or messages.
+
+    Parameters:
+        message_type (type or str): generated message class of a turn, or
+                                    its dotted import path, e.g.
+                                    `"calls.turn_pb2.Turn"`.
+    """
+
+    def __init__(self, *args, message_type: Union[Type["Message"], str] = None, **kwargs):
+        if json_format is None:
+            raise ImportError("ProtobufReader needs protobuf, install the `protobuf` extra")
+        if message_type is None:
+            raise ValueError("ProtobufReader needs a `message_type`")
+
+        super().__init__(*args, **kwargs)
+
+        if isinstance(message_type, str):
+            module_name, _, class_name = message_type.rpartition(".")
+            message_type = getattr(importlib.import_module(module_name), class_name)
+        self.message_type = message_type
+
+        fields = message_type.DESCRIPTOR.fields
+        if self.columns:
+            read_columns = set(self.columns) | {column for column, _, _ in self.filters or []}
+            fields = [field for field in fields if field.name in read_columns]
+        converters = {}
+        self._fields = [(field.name, self._get_field_getter(field, converters)) for field in fields]
+
+    @classmethod
+    def _get_field_getter(cls, field, converters: Optional[Dict[str, Callable]] = None) -> Callable[["Message"], Any]:
+        """
+        Get function reading a field of a message as a native python value.
+        Unset fields with presence (messages, `optional` scalars) are None.
+        Nested messages are read field by field into dicts, keeping field
+        names, default values and integer types.
+
+        Parameters:
+            field: field descriptor.
+            converters (dict): message converters by message type name,
+                               shared by the getters of nested fields.
+        """
+        name = field.name
+        is_repeated = getattr(field, "is_repeated", None)
+        if is_repeated is None:
+            is_repeated = field.label == field.LABEL_REPEATED
+        message_type = field.message_type
+        converters = {} if converters is None else converters
+
+        if message_type is not None and message_type.GetOptions().map_entry:
+            value_field = message_type.fields_by_name["value"]
+            if value_field.message_type is None:
+                return lambda message: dict(getattr(message, name))
+            convert = cls._get_message_converter(value_field.message_type, converters)
+            return lambda message: {key: convert(value) for key, value in getattr(message, name).items()}
+        if is_repeated and message_type is not None:
+            convert = cls._get_message_converter(message_type, converters)
+            return lambda message: [convert(value) for value in getattr(message, name)]
+        if is_repeated:
+            return lambda message: list(getattr(message, name))
+        if field.has_presence:
+            if message_type is not None:
+                convert = cls._get_message_converter(message_type, converters)
+                return lambda message: convert(getattr(message, name)) if message.HasField(name) else None
+            return lambda message: getattr(message, name) if message.HasField(name) else None
+
+        return lambda message: getattr(message, name)
+
+    @classmethod
+    def _get_message_converter(cls, descriptor, converters: Dict[str, Callable]) -> Callable[["Message"], Any]:
         """
-        Convert stringified json to native dictionary.
+        Get function converting a nested message to a dict of its fields.
+        Well-known types (`Timestamp`, `Struct` etc.) get their JSON form.
 
         Parameters:
-            item (str): stringified json.
+            descriptor: message descriptor.
+            converters (dict): converters by message type name, so every
+                               type (recursive ones included) is set up once.
         """
-        if isinstance(item, str):
-            return json.loads(item)
+        if descriptor.full_name in converters:
+            return converters[descriptor.full_name]
+
+        if descriptor.file.name.startswith("google/protobuf/"):
+            def convert(message):
+                return json_format.MessageToDict(message, preserving_proto_field_name=True)
         else:
-            return []
+            getters = []
+
+            def convert(message):
+                return {field_name: getter(message) for field_name, getter in getters}
+
+        converters[descriptor.full_name] = convert
+        if not descriptor.file.name.startswith("google/protobuf/"):
+            getters.extend((field.name, cls._get_field_getter(field, converters)) for field in descriptor.fields)
+
+        return convert
 
     @staticmethod
-    def _post_read(df: pd.DataFrame) -> pd.DataFrame:
+    def _read_varint(buffer: memoryview, pos: int) -> Tuple[Optional[int], int]:
         """
-        Post csv read transformations.
+        Read a varint.
 
-        Transformations done:
-        - Convert stringified alternatives to native format.
-        - ...
+        Parameters:
+            buffer (memoryview): buffer to read from.
+            pos (int): position of the varint in the buffer.
+
+        Returns:
+            tuple: value and position right after it, value is None if the
+                   buffer ends in the middle of the varint.
+        """
+        value = shift = 0
+        end = len(buffer)
+        while pos < end:
+            byte = buffer[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if not byte & 0x80:
+                return value, pos
+            shift += 7
+            if shift >= 64:
+                raise ValueError("Malformed varint in protobuf stream")
+
+        return None, pos
+
+    def _parse_buffer(self, buffer: memoryview, message: "Message") -> Iterator[int]:
+        """
+        Parse complete messages of a buffer into `message`, yielding the
+        position right after every parsed message.
+        """
+        pos = 0
+        end = len(buffer)
+        while pos < end:
+            size, start = self._read_varint(buffer, pos)
+            if size is None or start + size > end:
+                return
+
+            message.ParseFromString(buffer[start:start + size])
+            pos = start + size
+            yield pos
+
+    def _iter_messages(self) -> Iterator["Message"]:
+        """
+        Iterate over the messages of the input.
+
+        The same message instance is reused for every message, so its fields
+        must be read before moving on to the next one.
+        """
+        message = self.message_type()
+
+        if isinstance(self.path, str):
+            with open(self.path, "rb") as f:
+                if not os.fstat(f.fileno()).st_size:
+                    return
+
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    buffer = memoryview(mapped)
+                    try:
+                        pos = 0
+                        for pos in self._parse_buffer(buffer, message):
+                            yield message
+                        if pos != len(buffer):
+                            raise ValueError("Truncated message at the end of protobuf stream")
+                    finally:
+                        buffer.release()
+            return
+
+        pending = bytearray()
+        while True:
+            block = self.path.read(PROTOBUF_BLOCKSIZE)
+            pending += block
+
+            buffer = memoryview(pending)
+            try:
+                pos = 0
+                for pos in self._parse_buffer(buffer, message):
+                    yield message
+            finally:
+                buffer.release()
+            del pending[:pos]
+
+            if not block:
+                break
+
+        if pending:
+            raise ValueError("Truncated message at the end of protobuf stream")
+
+    def _iter_batches(self, batch_size: Optional[int] = None) -> Iterator[Dict[str, List[Any]]]:
+        """
+        Iterate over batches of messages as column arrays.
 
         Parameters:
-            df (pd.DataFrame): call dataframe.
+            batch_size (int): messages per batch, all messages in a single batch if not set.
         """
-        df.alternatives = df.alternatives.apply(CSVReader._jsonify)
+        columns = {name: [] for name, _ in self._fields}
+        appends = [(columns[name].append, getter) for name, getter in self._fields]
+        size = 0
 
-        return df
+        for message in self._iter_messages():
+            for append, getter in appends:
+                append(getter(message))
+            size += 1
+
+            if size == batch_size:
+                yield columns
+                columns = {name: [] for name, _ in self._fields}
+                appends = [(columns[name].append, getter) for name, getter in self._fields]
+                size = 0
+
+        if size or batch_size is None:
+            yield columns
+
+    def _to_frame(self, columns: Dict[str, List[Any]], start: int = 0) -> pd.DataFrame:
+        size = len(next(iter(columns.values()), []))
+        df = pd.DataFrame(columns, index=pd.RangeIndex(start, start + size))
+        df = self._filter_rows(df)
+        if self.columns:
+            df = df[[column for column in self.columns if column in df]]
+
+        return self._post_read(df)
 
     def read(self) -> pd.DataFrame:
-        df = pd.read_csv(self.path, encoding="utf-8")
-        df = self._post_read(df)
+        return self._to_frame(next(self._iter_batches()))
+
+    def read_chunks(self) -> Iterator[pd.DataFrame]:
+        start = 0
+        for columns in self._iter_batches(self.chunksize):
+            df = self._to_frame(columns, start)
+            start += len(next(iter(columns.values()), []))
+            yield df
+
+
+class CSVReader(Reader):
+    """
+    CSV reader. Row filters are applied after reading.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def _read_csv(self, **kwargs):
+        usecols = None
+        if self.columns:
+            columns = set(self.columns) | {column for column, _, _ in self.filters or []}
+            usecols = columns.__contains__
+
+        return pd.read_csv(self.path, encoding="utf-8", usecols=usecols, **kwargs)
+
+    def read(self) -> pd.DataFrame:
+        df = self._read_csv()
+        df = self._post_read(self._filter_rows(df))
 
         return df
 
+    def read_chunks(self) -> Iterator[pd.DataFrame]:
+        """
+        Stream the csv in chunks of `chunksize` rows.
+
+        `path` can be a file path or any file-like object with a `read` method
+        (like the S3 `StreamingBody`), so the whole csv is never held in memory.
+        Row index continues across chunks.
+        """
+        with self._read_csv(chunksize=self.chunksize) as chunks:
+            for chunk in chunks:
+                yield self._post_read(self._filter_rows(chunk))
+
+
+class RecordsReader(Reader):
+    """
+    Reader of in-memory records, one dict per turn, e.g. streamed turn
+    events. `path` is the list of records. JSON columns may hold encoded
+    strings or already decoded values.
+
+    Parameters:
+        index (list): row index, a range index if not set.
+    """
+
+    def __init__(self, *args, index: Optional[List] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = index
+
+    def read(self) -> pd.DataFrame:
+        df = pd.DataFrame.from_records(self.path, index=None if self.index is None else pd.Index(self.index))
+        if self.columns:
+            df = df[[column for column in self.columns if column in df]]
+
+        return self._post_read(self._filter_rows(df))
+
+
+# Readers by file extension of the data url
+READERS = {
+    ".csv": CSVReader,
+    ".parquet": ParquetReader,
+    ".pq": ParquetReader,
+    ".arrow": ArrowReader,
+    ".feather": ArrowReader,
+    ".ipc": ArrowReader,
+    ".pb": ProtobufReader,
+    ".protobuf": ProtobufReader,
+}
+
+# Extensions of compressed data urls, decompressed while downloading
+COMPRESSION_EXTENSIONS = {".gz", ".gzip", ".zst", ".zstd"}
+
+
+def get_reader_class(data_url: str) -> Type[Reader]:
+    """
+    Get reader class for a data url from its file extension, ignoring
+    compression suffixes (`.gz`, `.zst`). Defaults to `CSVReader` for unknown
+    extensions.
+
+    Parameters:
+        data_url (str): path or S3 url of the dataframe.
+
+    Returns:
+        Type[Reader]: reader class.
+    """
+    path, extension = os.path.splitext(data_url.lower())
+    if extension in COMPRESSION_EXTENSIONS:
+        _, extension = os.path.splitext(path)
+
+    return READERS.get(extension, CSVReader)
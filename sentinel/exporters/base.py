@@ -1,8 +1,13 @@
-from typing import Optional, List, Callable
+import logging
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, List, Callable, Sequence
 from abc import ABC, abstractmethod
 
 import pandas as pd
+from tabulate import tabulate
 
+from sentinel.instrumentation import stage
 from sentinel.types import T
 
 
@@ -17,6 +22,9 @@ class Exporter(ABC):
         export_report(df: pd.DataFrame, categories): export report for different filters applied.
     """
 
+    # name the exporter is registered with, set by `ExporterFactory.register`
+    name = None
+
     def __init__(self, successor: Optional[T] = None):
         self.successor = successor
 
@@ -28,7 +36,8 @@ class Exporter(ABC):
             df_list (list): list of dataframes.
             filters (list): list of filters applied.
         """
-        self.export_report(df_list, filters)
+        with stage(f"exporter:{self.name}", rows_in=_count_rows(df_list)):
+            self.export_report(df_list, filters)
 
         if self.successor:
             self.successor.handle(df_list, filters)
@@ -50,6 +59,134 @@ class Exporter(ABC):
         pass
 
 
+def _count_rows(df_list: Sequence[pd.DataFrame]) -> Optional[int]:
+    """
+    Total rows of the filter results given to an exporter, None if unknown.
+    """
+    try:
+        return sum(len(df) for df in df_list)
+    except TypeError:
+        return None
+
+
+class ExportError(Exception):
+    """
+    Raised when exporters fail or time out.
+    """
+
+
+class ExportResult(NamedTuple):
+    """
+    Outcome of an exporter run by `ExporterDispatcher`.
+
+    Attributes:
+        name (str): exporter name.
+        seconds (float): wall time of the export, the timeout if it timed out.
+        error (Exception): error raised by the exporter, None if it succeeded.
+        timed_out (bool): whether the exporter didn't finish in time.
+    """
+    name: str
+    seconds: float
+    error: Optional[Exception] = None
+    timed_out: bool = False
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and not self.timed_out
+
+
+class ExporterDispatcher:
+    """
+    Runs exporters concurrently on the same filter results.
+
+    Every exporter runs in its own thread, so a run takes as long as the
+    slowest exporter. An exporter failing or running over its timeout
+    doesn't affect the others. Exporters still running at their timeout are
+    left behind in daemon threads.
+
+    Parameters:
+        exporters (list): exporters to run. Their successors are not run.
+        timeout (float): seconds every exporter may take, unbounded if not set.
+        timeouts (dict): timeout per exporter name, overriding `timeout`.
+    """
+
+    def __init__(self, exporters: List[Exporter], timeout: Optional[float] = None,
+                 timeouts: Optional[Dict[str, float]] = None):
+        self.exporters = exporters
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+
+    def dispatch(self, df_list: Sequence[pd.DataFrame], filters: List[str]) -> List[ExportResult]:
+        """
+        Run all the exporters.
+
+        Parameters:
+            df_list (list): filter results, shared read only by the exporters.
+            filters (list): list of filters applied.
+
+        Returns:
+            list: outcome of every exporter.
+        """
+        if isinstance(df_list, list):
+            df_list = tuple(df_list)
+
+        outcomes = {}
+        threads = []
+        for idx, exporter in enumerate(self.exporters):
+            thread = threading.Thread(target=self._export, args=(idx, exporter, df_list, filters, outcomes),
+                                      name=f"exporter-{exporter.name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        start = time.monotonic()
+        results = []
+        for idx, (exporter, thread) in enumerate(zip(self.exporters, threads)):
+            timeout = self.timeouts.get(exporter.name, self.timeout)
+            thread.join(None if timeout is None else max(start + timeout - time.monotonic(), 0))
+
+            if thread.is_alive():
+                logging.error(f"Exporter {exporter.name} timed out after {timeout}s")
+                results.append(ExportResult(exporter.name, timeout, timed_out=True))
+            else:
+                seconds, error = outcomes[idx]
+                results.append(ExportResult(exporter.name, seconds, error))
+
+        return results
+
+    @staticmethod
+    def _export(idx: int, exporter: Exporter, df_list: Sequence[pd.DataFrame], filters: List[str],
+                outcomes: Dict[int, tuple]):
+        start = time.monotonic()
+        error = None
+        try:
+            with stage(f"exporter:{exporter.name}", rows_in=_count_rows(df_list)):
+                exporter.export_report(df_list, filters)
+        except Exception as e:
+            logging.exception(f"Exporter {exporter.name} failed")
+            error = e
+        outcomes[idx] = (time.monotonic() - start, error)
+
+    @staticmethod
+    def summarize(results: List[ExportResult]) -> str:
+        """
+        Get a table of the exporters' status and timing.
+
+        Parameters:
+            results (list): outcomes from `dispatch`.
+        """
+        table_data = []
+        for result in results:
+            if result.timed_out:
+                status = "timed out"
+            elif result.error is not None:
+                status = f"failed: {result.error!r}"
+            else:
+                status = "ok"
+            table_data.append((result.name, status, f"{result.seconds:.2f}"))
+
+        return tabulate(table_data, ["exporter", "status", "seconds"], tablefmt="grid")
+
+
 class ExporterFactory:
     """
     Factory class for creating executors.
@@ -79,6 +216,7 @@ class ExporterFactory:
         def inner_wrapper(wrapped_class: Exporter) -> Callable:
             if exporter_name in cls.registry:
                 print("Executor {exporter_name} already exists. Replacing it")
+            wrapped_class.name = exporter_name
             cls.registry[exporter_name] = {"class": wrapped_class,
                                            "description": description,
                                            "verbose": wrapped_class.__doc__}
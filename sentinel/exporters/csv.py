@@ -1,10 +1,13 @@
 import io
 import json
-from typing import List, Dict
+from typing import List, Dict, Union
 
+import numpy as np
 import pandas as pd
 
+from sentinel.dataframes.reader import DERIVED_COLUMNS, RAW_JSON_PREFIX, Reader
 from sentinel.exporters.base import Exporter, ExporterFactory
+from sentinel.filters.base import FilterResult
 
 
 @ExporterFactory.register(exporter_name="csv", description="CSV Exporter")
@@ -17,16 +20,19 @@ class CSVExporter(Exporter):
         super().__init__(*args, **kwargs)
 
     @staticmethod
-    def _get_df_for_category(df: pd.DataFrame, category) -> pd.DataFrame:
+    def _get_df_for_category(df: Union[pd.DataFrame, FilterResult], category) -> pd.DataFrame:
         """
         Get non null dataframe rows.
 
         Parameters:
-            df (pd.DataFrame): dataframe.
+            df (pd.DataFrame | FilterResult): dataframe or filter result.
             category (str): filter function name.
         Returns:
             pd.DataFrame: filtered dataframe.
         """
+        if isinstance(df, FilterResult):
+            return df.to_frame()
+
         return df[~df[category].isnull()]
 
     @staticmethod
@@ -34,26 +40,75 @@ class CSVExporter(Exporter):
         """
         Serialize dataframe items post filtering.
 
+        Decoded JSON columns are written back from the raw strings kept at
+        read time, others are encoded. The hidden raw columns and columns
+        derived at read time are dropped, so exports have the input columns.
+
         Parameters:
-            df (pd.DataFrame): dataframe.
+            df (pd.DataFrame): dataframe, not modified.
 
         Returns:
-            pd.DataFrame: updated dataframe.
+            pd.DataFrame: serialized dataframe.
         """
-        df.alternatives = df.alternatives.apply(json.dumps)
-        df.prediction = df.prediction.apply(json.dumps)
+        raw_columns = [column for column in df.columns if str(column).startswith(RAW_JSON_PREFIX)]
+        columns = {column[len(RAW_JSON_PREFIX):]: df[column] for column in raw_columns}
+        for column in Reader.json_columns:
+            if column in df and column not in columns:
+                columns[column] = df[column].map(json.dumps)
 
-        return df
+        derived_columns = [column for column in DERIVED_COLUMNS if column in df]
 
-    def export_report(self, df: pd.DataFrame, categories: List) -> Dict[str, io.StringIO]:
-        file_objects_map = {}
+        return df.drop(columns=raw_columns + derived_columns).assign(**columns)
 
-        for category in categories:
-            buf = io.StringIO()
+    def _get_category_frames(self, df_list: Union[pd.DataFrame, List[Union[pd.DataFrame, FilterResult]]],
+                             categories: List[str]) -> Dict[str, pd.DataFrame]:
+        """
+        Get serialized flagged rows of every category.
+
+        Rows of the dataframe a chain of filters ran on are selected and
+        serialized once for all the categories, so the cost depends on the
+        number of flagged rows rather than categories times dataframe rows.
 
-            filtered_df = self._get_df_for_category(df, category)
-            filtered_df = self._serialize(df)
+        Parameters:
+            df_list (pd.DataFrame | list): filter results, one per category, or
+                                           a dataframe with a column per category.
+            categories (list): list of filters applied on the dataframe.
+
+        Returns:
+            dict: map of category and its flagged rows.
+        """
+        if isinstance(df_list, pd.DataFrame):
+            df_list = [df_list] * len(categories)
+
+        frames = {}
+        # filter results grouped by the dataframe they flag rows of
+        groups = {}
+        for category, result in zip(categories, df_list):
+            if isinstance(result, FilterResult):
+                groups.setdefault(id(result.df), []).append((category, result))
+            else:
+                frames[category] = self._serialize(self._get_df_for_category(result, category))
+
+        for results in groups.values():
+            df = results[0][1].df
+            positions = {category: df.index.get_indexer(result.annotations.index)
+                         for category, result in results}
+            flagged = np.unique(np.concatenate(list(positions.values())))
+            flagged_df = self._serialize(df.take(flagged))
+
+            for category, result in results:
+                frame = flagged_df.take(np.searchsorted(flagged, positions[category]))
+                frame[category] = result.annotations.values
+                frames[category] = frame
+
+        return {category: frames[category] for category in categories}
+
+    def export_report(self, df_list: Union[pd.DataFrame, List[Union[pd.DataFrame, FilterResult]]],
+                      categories: List) -> Dict[str, io.StringIO]:
+        file_objects_map = {}
 
+        for category, filtered_df in self._get_category_frames(df_list, categories).items():
+            buf = io.StringIO()
             filtered_df.to_csv(buf, mode="w", index=False)
             buf.seek(0)
             file_objects_map[category] = buf
@@ -0,0 +1,174 @@
+"""
+Rate limited, concurrent delivery of Slack messages.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import aiohttp
+from slack_sdk.errors import SlackApiError
+from slack_sdk.web.async_client import AsyncWebClient
+
+
+# Seconds to wait before the first retry of a failed request, doubled for
+# every following retry.
+RETRY_BACKOFF = 0.5
+
+
+class SlackThread(NamedTuple):
+    """
+    A message and its replies, posted in order as a thread.
+
+    Attributes:
+        channel (str): channel to post in.
+        text (str): fallback text of the parent message.
+        blocks (list): block kit blocks of the parent message.
+        replies (list): block kit blocks of every reply.
+        reply_text (str): fallback text of the replies.
+    """
+    channel: str
+    text: str
+    blocks: List[Dict[str, Any]]
+    replies: List[List[Dict[str, Any]]]
+    reply_text: str = "Sentinel"
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for asyncio tasks.
+
+    Parameters:
+        rate (float): tokens added per second.
+        capacity (float): maximum tokens, i.e. burst size. Defaults to `rate`, at least 1.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """
+        Wait for a token.
+        """
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """
+        Hand out no tokens for `seconds`, e.g. as asked by a Retry-After header.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+class SlackDelivery:
+    """
+    Posts Slack threads concurrently with slack_sdk's async client.
+
+    Requests to every channel go through a token bucket, as Slack rate limits
+    posting per channel. A rate limited (429) request pauses its channel's
+    bucket for the Retry-After time and is retried, as are server and
+    connection errors. Threads are posted concurrently, replies within a
+    thread in order.
+
+    Parameters:
+        token (str): Slack bot token.
+        rate_limit (float): messages per second per channel.
+        max_concurrency (int): threads posted at the same time.
+        max_attempts (int): attempts for every message.
+        base_url (str): Slack API url, for testing.
+        timeout (int): request timeout in seconds.
+    """
+
+    def __init__(self, token: Optional[str], rate_limit: float = 1.0, max_concurrency: int = 4,
+                 max_attempts: int = 3, base_url: Optional[str] = None, timeout: int = 30):
+        self.token = token
+        self.rate_limit = rate_limit
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def deliver(self, threads: List[SlackThread]) -> List[Optional[Exception]]:
+        """
+        Post threads.
+
+        Parameters:
+            threads (list): threads to post.
+
+        Returns:
+            list: error of every thread, None for threads posted.
+        """
+        return asyncio.run(self.deliver_async(threads))
+
+    async def deliver_async(self, threads: List[SlackThread]) -> List[Optional[Exception]]:
+        client_kwargs = {"token": self.token, "timeout": self.timeout}
+        if self.base_url:
+            client_kwargs["base_url"] = self.base_url
+        client = AsyncWebClient(**client_kwargs)
+
+        buckets = {}
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def deliver_thread(thread: SlackThread):
+            async with semaphore:
+                bucket = buckets.setdefault(thread.channel, TokenBucket(self.rate_limit))
+                response = await self._post(client, bucket, channel=thread.channel,
+                                            text=thread.text, blocks=thread.blocks)
+                for blocks in thread.replies:
+                    await self._post(client, bucket, channel=thread.channel, text=thread.reply_text,
+                                     thread_ts=response.get("ts"), blocks=blocks)
+
+        results = await asyncio.gather(*(deliver_thread(thread) for thread in threads),
+                                       return_exceptions=True)
+
+        return [result if isinstance(result, Exception) else None for result in results]
+
+    async def _post(self, client: AsyncWebClient, bucket: TokenBucket, **kwargs):
+        """
+        Post a message, retrying rate limited and failed requests.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            await bucket.acquire()
+            try:
+                return await client.chat_postMessage(**kwargs)
+            except SlackApiError as e:
+                status_code = e.response.status_code
+                if attempt == self.max_attempts or (status_code != 429 and status_code < 500):
+                    raise
+                if status_code == 429:
+                    retry_after = float(self._get_header(e.response.headers, "Retry-After") or 1)
+                    logging.warning(f"Slack rate limited posting to {kwargs['channel']}, "
+                                    f"retrying in {retry_after}s")
+                    bucket.pause(retry_after)
+                    continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.max_attempts:
+                    raise
+
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+
+    @staticmethod
+    def _get_header(headers: Dict[str, Any], name: str) -> Optional[str]:
+        for key, value in (headers or {}).items():
+            if key.lower() == name.lower():
+                return value[0] if isinstance(value, list) else value
+        return None
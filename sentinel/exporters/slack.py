@@ -1,33 +1,42 @@
+import logging
 import os
 import uuid
 from datetime import datetime, timedelta
+from string import Formatter
 from typing import List, Iterator
 
 import pandas as pd
-from slack_sdk import WebClient
 
 import sentinel.util as util
 from sentinel.exporters.base import ExporterFactory
 from sentinel.exporters.csv import CSVExporter
+from sentinel.exporters.delivery import SlackDelivery, SlackThread
 from sentinel.filters.base import FilterFactory
 
 
+# Max characters of a block kit section text
+SLACK_TEXT_LIMIT = 3000
+
+
 @ExporterFactory.register(exporter_name="slack", description="Slack Exporter")
 class SlackExporter(CSVExporter):
     def __init__(self, config, *args, **kwargs):
         self.config = config
-        self.slack_client = WebClient(
-            token=os.environ.get("SENTINEL_BOT_USER_TOKEN"))
+        slack_config = self.config.get("export", {}).get("slack", {})
+        self.delivery = SlackDelivery(
+            token=os.environ.get("SENTINEL_BOT_USER_TOKEN"),
+            rate_limit=slack_config.get("rate_limit", 1.0),
+            max_concurrency=slack_config.get("max_concurrency", 4),
+            max_attempts=slack_config.get("max_attempts", 3))
         super().__init__(*args, **kwargs)
 
-    def _get_call_reference(self, call_uuid: str, turn_uuid: str) -> str:
+    def _get_call_reference_template(self) -> str:
         """
-        Get call reference url. Skit internal console url or otherwise.
+        Get call reference url template. Skit internal console url or
+        otherwise. Resolved once per export.
 
-        Parameters:
-            call_uid (str): Call uuid.
         Returns:
-            str: URL for a call with `call_uuid`
+            str: URL template with `{call_uuid}` and `{conversation_uuid}` fields.
         """
 
         # If S3 host is set then generate call reference url of the format
@@ -39,12 +48,35 @@ class SlackExporter(CSVExporter):
         if s3_url:
             previous_day = datetime.today() - timedelta(days=1)
             previous_day = previous_day.strftime("%Y-%m-%d")
-            return f"{s3_url}/{previous_day}/{call_uuid}.{file_format}"
+            return f"{self._escape(s3_url)}/{previous_day}/{{call_uuid}}.{self._escape(file_format)}"
 
         # Use console url if S3 host is not set
-        console_host = os.environ.get("SENTINEL_CONSOLE_HOST")
-        client_id = self.config.get("client_id", "")
-        return f"{console_host}{client_id}/call-report/#/call?uuid={call_uuid}&turnuuid={turn_uuid}%INPUT"
+        console_host = self._escape(os.environ.get("SENTINEL_CONSOLE_HOST"))
+        client_id = self._escape(self.config.get("client_id", ""))
+        return f"{console_host}{client_id}/call-report/#/call?uuid={{call_uuid}}&turnuuid={{conversation_uuid}}%INPUT"
+
+    @staticmethod
+    def _escape(value) -> str:
+        return str(value).replace("{", "{{").replace("}", "}}")
+
+    @staticmethod
+    def _get_call_references(df: pd.DataFrame, template: str) -> pd.Series:
+        """
+        Get call reference urls of all the calls of a dataframe.
+
+        Parameters:
+            df (pd.DataFrame): Dataframe.
+            template (str): URL template from `_get_call_reference_template`.
+        Returns:
+            pd.Series: URL for every row.
+        """
+        references = pd.Series("", index=df.index, dtype=object)
+        for literal, field, _, _ in Formatter().parse(template):
+            references = references + literal
+            if field:
+                references = references + df[field].astype(str)
+
+        return references
 
     def _write_block(self, message_blocks: List, text: str) -> List:
         """
@@ -65,25 +97,34 @@ class SlackExporter(CSVExporter):
             }
         })
 
-    def _chunk_call_list(self, df: pd.DataFrame, chunk_size: int) -> Iterator:
+    def _chunk_call_list(self, df: pd.DataFrame, template: str,
+                         max_chars: int = SLACK_TEXT_LIMIT) -> Iterator:
         """
         Chunk text message to so that it doesn't exceed Slack's max limit.
-        Slack allows max 3001 characters.
+        Slack allows max 3000 characters per section.
 
         Parameters:
             df (pd.DataFrame): Dataframe.
-            chunk_size (int): Size of uuid list to chunk into.
+            template (str): Call reference URL template.
+            max_chars (int): Max characters of a chunk joined by newlines.
         """
         # Create list of call urls
-        call_text_list = []
-        for row in df.iterrows():
-            row = row[1]
-            call_reference = self._get_call_reference(
-                    row.call_uuid, row.conversation_uuid)
-            call_text_list.append(f"• <{call_reference}|{row.call_uuid}>")
+        call_uuids = df.call_uuid.astype(str)
+        call_text_list = ("• <" + self._get_call_references(df, template) + "|" + call_uuids + ">").tolist()
+
+        chunk = []
+        chunk_chars = 0
+        for call_text in call_text_list:
+            if chunk and chunk_chars + 1 + len(call_text) > max_chars:
+                yield chunk
+                chunk = []
+                chunk_chars = 0
+
+            chunk_chars += len(call_text) + (1 if chunk else 0)
+            chunk.append(call_text)
 
-        for idx in range(0, len(call_text_list), chunk_size):
-            yield call_text_list[idx: idx + chunk_size]
+        if chunk:
+            yield chunk
 
     def _chunk_blocks(self, blocks: List, chunk_size: int) -> Iterator:
         """
@@ -99,13 +140,14 @@ class SlackExporter(CSVExporter):
         for i in range(0, len(blocks), chunk_size):
             yield blocks[i:i + chunk_size]
 
-    def _message_builder(self, df: pd.DataFrame, category: str):
+    def _message_builder(self, df: pd.DataFrame, category: str, template: str = None):
         """
         Build block kit message
 
         Parameters:
             df (pd.DataFrame): dataframe.
             category (str): filter name.
+            template (str): call reference URL template, resolved if not set.
 
         Returns:
             None
@@ -127,7 +169,7 @@ class SlackExporter(CSVExporter):
         self._write_block(
             message_blocks, f":pencil: *{category_description}. Kwargs: {category_data.get('kwargs')}*")
 
-        call_text_list = self._chunk_call_list(df, 10)
+        call_text_list = self._chunk_call_list(df, template or self._get_call_reference_template())
         for call_text in call_text_list:
             self._write_block(message_blocks, "\n".join(call_text))
 
@@ -143,43 +185,51 @@ class SlackExporter(CSVExporter):
         self._write_block(
             message_blocks, f"*We have found anomalous calls under following categories: {', '.join(categories)}*")
 
+        slack_config = self.config.get("export", {}).get("slack", {})
+        compress = slack_config.get("compress", False)
+        extension = "csv.gz" if compress else "csv"
+
         # For each filter function generate slack message blocks
-        for idx, category in enumerate(categories):
-            filtered_df = self._get_df_for_category(df_list[idx], category)
-            filtered_df = self._serialize(filtered_df)
+        template = self._get_call_reference_template()
+        category_dfs = {}
+        for category, filtered_df in self._get_category_frames(df_list, categories).items():
+            message_blocks.extend(self._message_builder(filtered_df, category, template))
 
-            message_blocks.extend(self._message_builder(filtered_df, category))
+            category_dfs[f"sentinel/{s3_uuid}/{category}.{extension}"] = filtered_df
+            dataframe_message += f"\n<s3://{s3_bucket}/sentinel/{s3_uuid}/{category}.{extension}|{category}.{extension}>"
 
-            util.upload_df_to_s3(filtered_df, s3_bucket,
-                                 f"sentinel/{s3_uuid}/{category}.csv")
-            dataframe_message += f"\n<s3://{s3_bucket}/sentinel/{s3_uuid}/{category}.csv|{category}.csv>"
+        # Upload all categories concurrently
+        util.upload_dfs_to_s3(category_dfs, s3_bucket, compress=compress)
 
         self._write_block(
             message_blocks, f"* :file_cabinet: Exported dataframes at:* {dataframe_message}")
 
-        # For each block chunk send a new message
-        blocks_chunk = self._chunk_blocks(message_blocks, 50)
-        channel_name = self.config.get("export", {}).get(
-            "slack", {}).get("channel_name")
+        # Post a thread to every channel, each block chunk as a new reply
+        channel_names = slack_config.get("channel_name")
+        if isinstance(channel_names, str):
+            channel_names = [channel_names]
         language_code = self.config.get("language_code", "unknown_language")
         publish_message = f"Sentinel thread: {datetime.today().date()} ({language_code})"
 
-        message_response = self.slack_client.chat_postMessage(
+        replies = list(self._chunk_blocks(message_blocks, 50))
+        threads = [SlackThread(
             channel=channel_name,
             text=publish_message,
             blocks=[{
                 "type": "section",
-                        "text": {
-                            "type": "mrkdwn",
-                            "text": publish_message,
-                        }
-            }]
-        )
-
-        for blocks in blocks_chunk:
-            self.slack_client.chat_postMessage(
-                channel=channel_name,
-                text="Sentinel",
-                thread_ts=message_response.get("ts"),
-                blocks=blocks,
-            )
+                "text": {
+                    "type": "mrkdwn",
+                    "text": publish_message,
+                }
+            }],
+            replies=replies,
+        ) for channel_name in channel_names or []]
+
+        errors = self.delivery.deliver(threads)
+        for thread, error in zip(threads, errors):
+            if error is not None:
+                logging.error(f"Failed to post report to {thread.channel}", exc_info=error)
+
+        failed = [error for error in errors if error is not None]
+        if failed:
+            raise failed[0]
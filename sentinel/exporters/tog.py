@@ -1,3 +1,6 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 import pandas as pd
@@ -8,14 +11,79 @@ from sentinel.exporters.base import ExporterFactory
 from sentinel.exporters.csv import CSVExporter
 
 
+class TogPushBackend:
+    """
+    Pushes dataframes to a Tog job with `togpush`.
+
+    Parameters:
+        client_id (int): client id to get the access token for.
+    """
+
+    def __init__(self, client_id: int = 1):
+        self.access_token = Connection(client_id).access_token
+
+    def push(self, job_id: str, df: pd.DataFrame):
+        tog.push_df2tog(job_id, df, self.access_token)
+
+
+class DryRunBackend:
+    """
+    Records pushed dataframes instead of pushing them, to try out or
+    benchmark exports offline.
+
+    Parameters:
+        latency (float): seconds every push takes, to simulate Tog.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.pushes = []
+
+    def push(self, job_id: str, df: pd.DataFrame):
+        if self.latency:
+            time.sleep(self.latency)
+        self.pushes.append((job_id, df))
+
+
 @ExporterFactory.register(exporter_name="tog", description="Tog Exporter")
 class TogExporter(CSVExporter):
+    """
+    Pushes flagged rows to a Tog job.
+
+    Flagged rows of all the categories are merged (a row flagged by many
+    filters is pushed once, with all its annotations) and pushed in batches
+    of `batch_size` rows, `max_workers` batches at a time.
+    """
+
     def __init__(self, config, *args, **kwargs):
         self.config = config
-        self.access_token = Connection(self.config.get("client_id", 1)).access_token
+        tog_config = self.config.get("export", {}).get("tog", {})
+        self.job_id = tog_config.get("job_id", "")
+        self.batch_size = tog_config.get("batch_size", 500)
+        self.max_workers = tog_config.get("max_workers", 4)
+
+        if tog_config.get("dry_run"):
+            self.backend = DryRunBackend(tog_config.get("dry_run_latency", 0.0))
+        else:
+            self.backend = TogPushBackend(self.config.get("client_id", 1))
 
         super().__init__(*args, **kwargs)
 
+    def _get_export_df(self, df_list: List[pd.DataFrame], categories: List) -> pd.DataFrame:
+        """
+        Get flagged rows of all the categories, at most `limit` per category.
+        """
+        frames = []
+        for category, df in self._get_category_frames(df_list, categories).items():
+            category_data = self.config.get("filters", {}).get(category, {})
+            frames.append(df[:category_data.get("limit", 50)])
+
+        if not frames:
+            return pd.DataFrame()
+
+        df = pd.concat(frames)
+        return df.groupby(level=0, sort=False).first()
+
     def export_report(self, df_list: List[pd.DataFrame], categories: List):
         """
         Export a list of dataframes to Tog.
@@ -24,12 +92,16 @@ class TogExporter(CSVExporter):
         :param categories: List of categories to export
         :return:
         """
-        job_id = self.config.get("export", {}).get("tog", {}).get("job_id", "")
+        df = self._get_export_df(df_list, categories)
+        batches = [df[idx:idx + self.batch_size] for idx in range(0, len(df), self.batch_size)]
+        if not batches:
+            return
 
-        for idx, category in enumerate(categories):
-            category_data = self.config.get("filters", {}).get(category, {})
-            limit = category_data.get("limit", 50)
-            df = df_list[idx][:limit]
-            df = self._serialize(df)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(batches))) as pool:
+            futures = [pool.submit(self.backend.push, self.job_id, batch) for batch in batches]
 
-            tog.push_df2tog(job_id, df, self.access_token)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        for error in errors:
+            logging.error(f"Failed to push to tog job {self.job_id}", exc_info=error)
+        if errors:
+            raise errors[0]
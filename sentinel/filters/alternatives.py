@@ -1,11 +1,13 @@
 """
 Filters to flag out turns with no alternatives.
 """
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
 from sentinel.filters.base import FilterBase, FilterFactory
+from sentinel.filters.matcher import WordMatcher
 
 
 @FilterFactory.register(name="no_alternatives", description="Turns with no alternatives")
@@ -16,6 +18,8 @@ class AlternativesFilter(FilterBase):
     In most of the cases, these are turns where users are unresponsive.
     """
 
+    columns = ["alternatives"]
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -24,7 +28,8 @@ class AlternativesFilter(FilterBase):
 
     def process(self, df: pd.DataFrame) -> pd.DataFrame:
         df = self.annotate(df, df.alternatives,
-                           self._get_none_alternatives, "no_alternatives")
+                           self._get_none_alternatives, "no_alternatives",
+                           batch_func=self._get_none_alternatives_batch)
 
         return df
 
@@ -41,6 +46,18 @@ class AlternativesFilter(FilterBase):
         if not item:
             return {"no_alternatives": True}
 
+    def _get_none_alternatives_batch(self, df: pd.DataFrame) -> Tuple[np.ndarray, Dict[str, bool]]:
+        """
+        Flag turns which don't have alternatives.
+
+        Parameters:
+            df (pd.DataFrame): serving sample dataframe.
+
+        Returns:
+            Mask of flagged turns and their metadata.
+        """
+        return df.sentinel.alternatives.is_empty(), {"no_alternatives": True}
+
 
 @FilterFactory.register(name="filter_words", description="Turns with certain words")
 class WordFilter(FilterBase):
@@ -50,10 +67,17 @@ class WordFilter(FilterBase):
     Use the below keyword arguments in the config to specify configurable attributes.
     kwargs:
         word_list (list): List of words to be flagged out.
+        word_boundary (bool): Only match whole words. Defaults to false.
+        case_sensitive (bool): Match case of the words. Defaults to true.
     """
 
+    columns = ["alternatives"]
+
     def __init__(self, *args, **kwargs):
         self.word_list = kwargs.get("word_list", [])
+        self.matcher = WordMatcher(self.word_list,
+                                   word_boundary=kwargs.get("word_boundary", False),
+                                   case_sensitive=kwargs.get("case_sensitive", True))
 
         super().__init__(*args, **kwargs)
 
@@ -62,7 +86,8 @@ class WordFilter(FilterBase):
 
     def process(self, df: pd.DataFrame) -> pd.DataFrame:
         df = self.annotate(df, df.alternatives,
-                           self._get_filtered_transcripts, "filter_words")
+                           self._get_filtered_transcripts, "filter_words",
+                           batch_func=self._get_filtered_transcripts_batch)
 
         return df
 
@@ -76,12 +101,32 @@ class WordFilter(FilterBase):
         Returns:
             Metadata dict with annotation.
         """
-        if not item:
+        if not item or not item[0]:
             return None
 
         item = item[0]
         item = sorted(item, key=lambda x: x["confidence"], reverse=True)
 
-        if any(word in item[0]["transcript"] for word in self.word_list):
-            return {"word_match": self.word_list}
+        word_match = self.matcher.find(item[0]["transcript"])
+        if word_match:
+            return {"word_match": word_match}
         return None
+
+    def _get_filtered_transcripts_batch(self, df: pd.DataFrame) -> Tuple[np.ndarray, Dict[str, List]]:
+        """
+        Flag turns whose best alternative has any of the words mentioned in the config.
+
+        Parameters:
+            df (pd.DataFrame): serving sample dataframe.
+
+        Returns:
+            Mask of flagged turns and their metadata.
+        """
+        transcripts = pd.Series(df.sentinel.alternatives.best_transcript(), dtype=object)
+        flagged = self.matcher.contains(transcripts)
+
+        word_match = np.full(len(transcripts), None, dtype=object)
+        for idx in np.flatnonzero(flagged):
+            word_match[idx] = self.matcher.find(transcripts.values[idx])
+
+        return flagged, {"word_match": word_match}
@@ -1,8 +1,22 @@
-from typing import Callable, List
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Any
 from abc import ABC, abstractmethod
 
+import numpy as np
 import pandas as pd
 
+import sentinel.dataframes.accessor  # noqa: F401, registers `df.sentinel`
+from sentinel.instrumentation import instrumentation, stage
+from sentinel.profiling import profile_scope
+
+
+# Vectorised annotation function: dataframe -> (flagged mask, metadata)
+BatchAnnotation = Callable[[pd.DataFrame], Tuple[np.ndarray, Optional[Dict[str, Any]]]]
+
+# Dataframe shared with worker processes forked by `FilterBase.handle_parallel`
+_shared_df = None
+
 
 class FilterBase(ABC):
     """
@@ -14,27 +28,178 @@ class FilterBase(ABC):
 
     Methods:
         handle(df: pd.DataFrame): Calls filter functions chained as its successor.
+        handle_chunks(chunks: Iterable[pd.DataFrame]): Calls filter functions
+                                                       chained as its successor over a stream of dataframes.
+        handle_parallel(df: pd.DataFrame): Calls filter functions chained as its
+                                           successor concurrently in a process pool.
         preprocess(df: pd.DataFrame): :TODO:
         process(df: pd.DataFrame): Process serving sample (untagged call/turn dataframe).
     """
 
+    # name the filter is registered with, set by `FilterFactory.register`
+    name = None
+
+    # input columns the filter reads, None if it may read any column
+    columns = None
+
     def __init__(self, successor: "FilterBase" = None, **kwargs):
         self.successor = successor
+        self._chunk_results = []
 
     def handle(self, df: pd.DataFrame, df_list: List[pd.DataFrame]):
         """
         Calls filter functions chained as its successor.
 
         Parameters:
-            df (pd.DataFrame): dataframe.
-            df_list (list): list of dataframes.
+            df (pd.DataFrame): dataframe, not modified by the filters.
+            df_list (list): list of filter results.
         """
-        df_list.append(self.process(df))
+        df_list.append(self.run(df))
 
         if self.successor:
             self.successor.handle(df, df_list)
         return df_list
 
+    def handle_chunks(self, chunks: Iterable[pd.DataFrame]) -> List["FilterResult"]:
+        """
+        Calls filter functions chained as its successor over a stream of
+        dataframe chunks.
+
+        Every chunk is passed through the whole chain before the next one is
+        read so only one chunk (plus the flagged rows) is in memory at a time.
+
+        Parameters:
+            chunks (Iterable[pd.DataFrame]): dataframe chunks.
+
+        Returns:
+            list: one result per filter in the chain.
+        """
+        filters = self._get_chain()
+
+        for chunk in chunks:
+            for chunk_filter in filters:
+                chunk_filter.process_chunk(chunk)
+
+        return [chunk_filter.merge_chunks() for chunk_filter in filters]
+
+    def handle_parallel(self, df: pd.DataFrame, max_workers: Optional[int] = None) -> List["FilterResult"]:
+        """
+        Calls filter functions chained as its successor concurrently, each in
+        its own worker process.
+
+        Workers are forked after `df` is published in this module, so they
+        share its memory with the parent (copy-on-write) instead of receiving a
+        pickled copy. Only the annotations of flagged rows are sent back.
+        Falls back to `handle` on platforms which can't fork.
+
+        Parameters:
+            df (pd.DataFrame): dataframe.
+            max_workers (int): number of worker processes, defaults to one per filter.
+
+        Returns:
+            list: one result per filter, in chain order.
+        """
+        global _shared_df
+
+        if "fork" not in multiprocessing.get_all_start_methods():
+            return self.handle(df, [])
+
+        filters = self._get_chain()
+        _shared_df = df
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers or len(filters),
+                                     mp_context=multiprocessing.get_context("fork")) as executor:
+                outcomes = list(executor.map(_process_shared_df, filters))
+        finally:
+            _shared_df = None
+
+        annotations = []
+        for filter_annotations, stages in outcomes:
+            annotations.append(filter_annotations)
+            instrumentation.merge(stages)
+
+        return [FilterResult(df, filter.name, filter_annotations)
+                for filter, filter_annotations in zip(filters, annotations)]
+
+    def _get_chain(self) -> List["FilterBase"]:
+        """
+        Get this filter and all its successors in order.
+        """
+        filters = []
+        current_filter = self
+        while current_filter:
+            filters.append(current_filter)
+            current_filter = current_filter.successor
+
+        return filters
+
+    def get_columns(self) -> Optional[List[str]]:
+        """
+        Get input columns read by this filter and all its successors, so
+        readers can skip the rest.
+
+        Returns:
+            list: column names, None if any filter may read any column.
+        """
+        columns = []
+        for chain_filter in self._get_chain():
+            if chain_filter.columns is None:
+                return None
+            columns.extend(chain_filter.columns)
+
+        return list(dict.fromkeys(columns))
+
+    def _get_flagged(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Get rows annotated by this filter.
+
+        Parameters:
+            df (pd.DataFrame): processed dataframe.
+        """
+        return df[~df[self.name].isnull()]
+
+    def run(self, df: pd.DataFrame) -> "FilterResult":
+        """
+        Process serving sample without modifying it.
+
+        The filter works on a shallow copy of `df`, so its annotation column
+        never shows up in `df` (or in the input of other filters).
+
+        Parameters:
+            df (pd.DataFrame): serving sample dataframe.
+
+        Returns:
+            FilterResult: rows flagged by this filter.
+        """
+        with stage(f"filter:{self.name}", rows_in=len(df)) as record, profile_scope(type(self).__name__):
+            processed_df = self.process(df.sentinel.view())
+            result = FilterResult(df, self.name, self._get_flagged(processed_df)[self.name])
+            record.rows_out = len(result)
+
+        return result
+
+    def process_chunk(self, df: pd.DataFrame):
+        """
+        Process a chunk of the serving sample. Only the flagged rows are kept
+        around till the chunks are merged.
+
+        Parameters:
+            df (pd.DataFrame): dataframe chunk.
+        """
+        self._chunk_results.append(self.run(df).to_frame())
+
+    def merge_chunks(self) -> "FilterResult":
+        """
+        Merge results of all the processed chunks.
+
+        Returns:
+            FilterResult: flagged rows across all chunks.
+        """
+        result = FilterResult.from_frames(self._chunk_results, self.name)
+        self._chunk_results = []
+
+        return result
+
     @abstractmethod
     def preprocess(self, df: pd.DataFrame):
         pass
@@ -51,24 +216,193 @@ class FilterBase(ABC):
 
     def annotate(self, df: pd.DataFrame,
                  df_series: pd.Series,
-                 func: Callable, annotation: str) -> pd.DataFrame:
+                 func: Callable, annotation: str,
+                 batch_func: Optional[BatchAnnotation] = None) -> pd.DataFrame:
         """
         Annotate dataframe elements by running it through an annotation function.
 
+        If `batch_func` is given it is preferred over `func`. It is called once
+        with the whole dataframe and returns a boolean mask of the flagged rows
+        along with their metadata as `{key: array or constant}` (or None to
+        annotate flagged rows with `True`). Metadata dicts are only built for
+        the flagged rows.
+
         Parameters:
             df (pd.DataFrame): serving sample dataframe.
             df_series (pd.Series): source column to derive annotations from.
             func (Callable): the annotation function.
             annotation (str): name of the annotation column in the dataframe.
+            batch_func (Callable): vectorised version of the annotation function.
 
         Returns:
             pd.DataFrame: annotated dataframe
         """
-        df[annotation] = df_series.apply(func)
+        if batch_func is None:
+            df[annotation] = df_series.apply(func)
+            return df
+
+        mask, metadata = batch_func(df)
+        mask = np.asarray(mask, dtype=bool)
+
+        annotations = np.full(len(df), None, dtype=object)
+        if metadata is None:
+            annotations[mask] = True
+        else:
+            n_flagged = int(mask.sum())
+            columns = {
+                key: np.asarray(value)[mask].tolist()
+                if isinstance(value, (np.ndarray, pd.Series)) else [value] * n_flagged
+                for key, value in metadata.items()
+            }
+            annotations[mask] = [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+        df[annotation] = annotations
 
         return df
 
 
+class FilterResult:
+    """
+    Rows flagged by a filter.
+
+    Holds only the annotations of flagged rows along with a reference to the
+    dataframe the filter ran on, which is shared by all the filters of a chain.
+    Rows are materialised only when asked for.
+
+    Attributes:
+        df (pd.DataFrame): dataframe the filter ran on.
+        category (str): name of the filter and its annotation column.
+        annotations (pd.Series): annotations of flagged rows, indexed like `df`.
+
+    Methods:
+        to_frame(): Flagged rows along with the annotation column.
+    """
+
+    def __init__(self, df: pd.DataFrame, category: str, annotations: pd.Series):
+        self.df = df
+        self.category = category
+        self.annotations = annotations
+
+    def __len__(self) -> int:
+        return len(self.annotations)
+
+    @property
+    def index(self) -> pd.Index:
+        return self.annotations.index
+
+    @classmethod
+    def from_frames(cls, frames: List[pd.DataFrame], category: str,
+                    columns: Optional[Iterable[str]] = None) -> "FilterResult":
+        """
+        Build a result from already materialised dataframes of flagged rows.
+
+        Parameters:
+            frames (list): dataframes of flagged rows with the annotation column.
+            category (str): name of the filter and its annotation column.
+            columns (Iterable): columns of the dataframe the filter ran on,
+                                so a result without frames still has them.
+        """
+        if not frames:
+            columns = [column for column in (columns if columns is not None else []) if column != category]
+            df = pd.DataFrame(columns=columns + [category])
+            return cls(df, category, df[category])
+
+        df = pd.concat(frames)
+        return cls(df, category, df[category])
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Materialise flagged rows.
+
+        Returns:
+            pd.DataFrame: flagged rows along with the annotation column.
+        """
+        df = self.df.take(self.df.index.get_indexer(self.annotations.index))
+        df[self.category] = self.annotations
+
+        return df
+
+
+def _process_shared_df(filter: FilterBase) -> Tuple[pd.Series, list]:
+    """
+    Run a filter on the dataframe shared by `FilterBase.handle_parallel`.
+    Runs in a forked worker process, so the stage metrics it records are
+    sent back along with the annotations.
+    """
+    instrumentation.reset()
+    annotations = filter.run(_shared_df).annotations
+
+    return annotations, instrumentation.get_metrics()
+
+
+class CallFilterBase(FilterBase):
+    """
+    Base class for filters working on the call level, i.e. on the last turn
+    of every call.
+
+    While processing chunks, every chunk is evaluated on the last turn of
+    every call in it and only the flagged last turns are carried over. A
+    call's turns in a later chunk supersede what was found for it before, so
+    calls spanning chunk boundaries are evaluated on their actual last turn,
+    while the carried state is bounded by the number of flagged calls.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._call_state = None
+
+        super().__init__(*args, **kwargs)
+
+    def process_chunk(self, df: pd.DataFrame):
+        flagged = self.run(df).to_frame()
+
+        if self._call_state is not None:
+            superseded = self._call_state.call_uuid.isin(df.sentinel.calls.calls).values
+            flagged = pd.concat([self._call_state[~superseded], flagged])
+
+        self._call_state = flagged
+
+    def merge_chunks(self) -> "FilterResult":
+        frames = [] if self._call_state is None else [self._call_state]
+        self._call_state = None
+
+        return FilterResult.from_frames(frames, self.name)
+
+    def settle(self, call_uuids: Iterable) -> "FilterResult":
+        """
+        Report the flagged calls among calls which won't get more turns and
+        drop them from the carried over state. The other calls are kept for
+        later chunks.
+
+        Parameters:
+            call_uuids (Iterable): uuids of the settled calls.
+
+        Returns:
+            FilterResult: flagged calls among the settled ones.
+        """
+        if self._call_state is None:
+            return FilterResult.from_frames([], self.name)
+
+        settled = self._call_state.call_uuid.isin(call_uuids).values
+        result = FilterResult.from_frames([self._call_state[settled]], self.name)
+        self._call_state = self._call_state[~settled]
+
+        return result
+
+    def _filter_last_turn(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Get the last turn of every call using the call index of the dataframe.
+
+        Parameters:
+            df (pd.DataFrame): serving sample dataframe.
+
+        Returns:
+            pd.DataFrame: dataframe with one row per call.
+        """
+        filtered_df = df.take(df.sentinel.calls.last_turns())
+
+        return filtered_df
+
+
 class FilterFactory:
     """
     Factory class for creating executors.
@@ -98,6 +432,7 @@ class FilterFactory:
         def inner_wrapper(wrapped_class: FilterBase) -> Callable:
             if name in cls.registry:
                 print("Executor {name} already exists. Replacing it")
+            wrapped_class.name = name
             cls.registry[name] = {"class": wrapped_class,
                                   "description": description,
                                   "verbose": wrapped_class.__doc__}
@@ -1,8 +1,9 @@
 """
 Filters to flag out ASR low confidence calls.
 """
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
 from sentinel.filters.base import FilterBase, FilterFactory
@@ -19,6 +20,8 @@ class ASRConfidenceFilter(FilterBase):
         confidence_threshold (int): Confidence threshold.
     """
 
+    columns = ["alternatives"]
+
     def __init__(self, *args, **kwargs):
         self.confidence_threshold = kwargs.get("confidence_threshold", 95)
 
@@ -29,7 +32,8 @@ class ASRConfidenceFilter(FilterBase):
 
     def process(self, df: pd.DataFrame) -> pd.DataFrame:
         df = self.annotate(df, df.alternatives,
-                           self._get_low_confidence, "low_asr_confidence")
+                           self._get_low_confidence, "low_asr_confidence",
+                           batch_func=self._get_low_confidence_batch)
 
         return df
 
@@ -43,7 +47,7 @@ class ASRConfidenceFilter(FilterBase):
         Returns:
             Metadata dict with annotation.
         """
-        if not item:
+        if not item or not item[0]:
             return None
 
         item = item[0]
@@ -51,3 +55,17 @@ class ASRConfidenceFilter(FilterBase):
         if item[0]["confidence"] < self.confidence_threshold:
             return {"score": item[0]["confidence"]}
         return None
+
+    def _get_low_confidence_batch(self, df: pd.DataFrame) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Flag turns whose best alternative has confidence less than some threshold.
+
+        Parameters:
+            df (pd.DataFrame): serving sample dataframe.
+
+        Returns:
+            Mask of flagged turns and their metadata columns.
+        """
+        confidence = df.sentinel.alternatives.best_confidence()
+
+        return confidence < float(self.confidence_threshold), {"score": confidence}
@@ -0,0 +1,75 @@
+"""
+Multi-word matching over transcripts.
+"""
+import re
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+
+class WordMatcher:
+    """
+    Matches a list of words against text with a single compiled regex, so
+    every text is scanned once no matter how many words there are.
+
+    Longer words are tried first, so the longest word starting at a position
+    is the one reported for it.
+
+    Parameters:
+        words (list): words (or phrases) to look for.
+        word_boundary (bool): only match whole words.
+        case_sensitive (bool): match case of the words.
+    """
+
+    def __init__(self, words: List[str], word_boundary: bool = False,
+                 case_sensitive: bool = True):
+        self.words = list(dict.fromkeys(words))
+        self.word_boundary = word_boundary
+        self.case_sensitive = case_sensitive
+
+        # matched text -> configured word
+        self._words = {self._normalize(word): word for word in self.words}
+
+        self.regex = None
+        self._find_regex = None
+        if self.words:
+            flags = 0 if self.case_sensitive else re.IGNORECASE
+            pattern = "|".join(re.escape(word) for word in sorted(self.words, key=len, reverse=True))
+            if self.word_boundary:
+                pattern = rf"\b(?:{pattern})\b"
+
+            self.regex = re.compile(pattern, flags)
+            # lookahead so words starting inside an earlier match are found too
+            self._find_regex = re.compile(f"(?=({pattern}))", flags)
+
+    def _normalize(self, word: str) -> str:
+        return word if self.case_sensitive else word.casefold()
+
+    def find(self, text: str) -> List[str]:
+        """
+        Words found in a text.
+
+        Parameters:
+            text (str): text to search.
+
+        Returns:
+            list: configured words found in the text, in order of first occurrence.
+        """
+        if self.regex is None or not isinstance(text, str):
+            return []
+
+        matches = (self._words.get(self._normalize(match)) for match in self._find_regex.findall(text))
+        return list(dict.fromkeys(match for match in matches if match is not None))
+
+    def contains(self, series: pd.Series) -> np.ndarray:
+        """
+        Mask of texts containing any of the words.
+
+        Parameters:
+            series (pd.Series): texts, missing items never match.
+        """
+        if self.regex is None:
+            return np.zeros(len(series), dtype=bool)
+
+        return series.str.contains(self.regex, na=False).values.astype(bool)
@@ -1,11 +1,12 @@
 """
 Filters to flag out low prediction confidence calls.
 """
-import json
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
 
+import numpy as np
 import pandas as pd
 
+from sentinel.dataframes.reader import Reader
 from sentinel.filters.base import FilterBase, FilterFactory
 
 
@@ -14,12 +15,16 @@ class PredictionConfidenceFilter(FilterBase):
     """
     This filter flags turns with SLU prediction confidence less than some threshold.
 
+    Expects the `prediction` column to be decoded by the reader.
+
     Use the below keyword arguments in the config to specify configurable
     attributes.
     kwargs:
         confidence_threshold (float): Confidence threshold.
     """
 
+    columns = ["prediction"]
+
     def __init__(self, *args, **kwargs):
         self.confidence_threshold = kwargs.get("confidence_threshold", 0.95)
 
@@ -29,10 +34,9 @@ class PredictionConfidenceFilter(FilterBase):
         raise NotImplementedError
 
     def process(self, df: pd.DataFrame) -> pd.DataFrame:
-        df.prediction = df.prediction.apply(
-            lambda x: json.loads(x) if isinstance(x, str) else json.loads("[]"))
         df = self.annotate(df, df.prediction,
-                           self._get_low_confidence, "prediction_low_confidence")
+                           self._get_low_confidence, "prediction_low_confidence",
+                           batch_func=self._get_low_confidence_batch)
 
         return df
 
@@ -52,3 +56,20 @@ class PredictionConfidenceFilter(FilterBase):
         if float(item["score"]) < float(self.confidence_threshold):
             return {"score": item["score"]}
         return None
+
+    def _get_low_confidence_batch(self, df: pd.DataFrame) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Flag turns with prediction score less than some threshold.
+
+        Parameters:
+            df (pd.DataFrame): serving sample dataframe.
+
+        Returns:
+            Mask of flagged turns and their metadata columns.
+        """
+        if "prediction_score" in df:
+            score = df.prediction_score.values
+        else:
+            score = Reader._get_prediction_score(df.prediction).values
+
+        return score < float(self.confidence_threshold), {"score": score}
@@ -1,18 +1,23 @@
 """
 Filters to flag out calls with a particular end state.
 """
+from functools import partial
+from typing import Dict, Tuple
+
+import numpy as np
 import pandas as pd
 from itertools import groupby
 from collections import Counter
 
-from sentinel.filters.base import FilterBase, FilterFactory
+from sentinel.dataframes.columnar import StateTransitions
+from sentinel.filters.base import CallFilterBase, FilterFactory
 
 
 @FilterFactory.register(name="call_end_state", description="Calls with a particular end state")
-class EndStateFilter(FilterBase):
+class EndStateFilter(CallFilterBase):
     """
-    This filter flags out calls with a particular end state.
-
+    This filter flags out calls with a particular end state, i.e. the state
+    of their last turn.
 
     Use the below keyword arguments in the config to specify configurable
     attributes.
@@ -20,6 +25,8 @@ class EndStateFilter(FilterBase):
         end_state: list of strings of the end state(s) to filter out.
     """
 
+    columns = ["call_uuid", "state"]
+
     def __init__(self, *args, **kwargs):
         self.end_state = kwargs.get("end_state", ["COF"])
 
@@ -34,7 +41,8 @@ class EndStateFilter(FilterBase):
             filtered_df,
             filtered_df.state,
             self._filter_state,
-            "call_end_state")
+            "call_end_state",
+            batch_func=self._filter_state_batch)
 
         return filtered_df
 
@@ -42,17 +50,12 @@ class EndStateFilter(FilterBase):
         if item in self.end_state:
             return True
 
-    def _filter_last_turn(self, df: pd.DataFrame) -> pd.DataFrame:
-        filtered_df = df.groupby(
-            ["call_uuid", "state"], as_index=False).first()
-        filtered_df = filtered_df.drop_duplicates(
-            subset=["call_uuid"], keep="last")
-
-        return filtered_df
+    def _filter_state_batch(self, df: pd.DataFrame) -> Tuple[np.ndarray, None]:
+        return df.state.isin(self.end_state).values, None
 
 
 @FilterFactory.register(name="state_stuck", description="Calls which are stuck in particular state")
-class RepeatedCallState(FilterBase):
+class RepeatedCallState(CallFilterBase):
     """
     This filter flags out calls which are stuck in a particular state.
 
@@ -64,6 +67,8 @@ class RepeatedCallState(FilterBase):
     value must be 5.
     """
 
+    columns = ["call_uuid", "state_transitions"]
+
     def __init__(self, *args, **kwargs):
         self.max_state_count = kwargs.get("max_state_count", 4)
 
@@ -75,8 +80,10 @@ class RepeatedCallState(FilterBase):
     def process(self, df: pd.DataFrame) -> pd.DataFrame:
         filtered_df = self._filter_last_turn(df)
 
-        filtered_df = self.annotate(filtered_df, df.state_transitions,
-                                    self._get_repeated_state, "state_stuck")
+        filtered_df = self.annotate(filtered_df, filtered_df.state_transitions,
+                                    self._get_repeated_state, "state_stuck",
+                                    batch_func=partial(self._get_repeated_state_batch,
+                                                       df.sentinel.state_transitions))
 
         return filtered_df
 
@@ -89,14 +96,25 @@ class RepeatedCallState(FilterBase):
             return {"state_stuck": self.max_state_count}
         return None
 
-    def _filter_last_turn(self, df: pd.DataFrame) -> pd.DataFrame:
-        filtered_df = df.drop_duplicates(subset=["call_uuid"], keep="last")
+    def _get_repeated_state_batch(self, state_transitions: StateTransitions,
+                                  df: pd.DataFrame) -> Tuple[np.ndarray, Dict[str, int]]:
+        """
+        Flag calls where any state occurs at least `max_state_count` times.
 
-        return filtered_df
+        Parameters:
+            state_transitions (StateTransitions): parsed state transitions of the input dataframe.
+            df (pd.DataFrame): last turn of every call.
+
+        Returns:
+            Mask of flagged calls and their metadata.
+        """
+        state_count = state_transitions.max_state_count(df.state_transitions)
+
+        return state_count >= self.max_state_count, {"state_stuck": self.max_state_count}
 
 
 @FilterFactory.register(name="state_loop", description="Calls which come back to already visited state")
-class LoopCallState(FilterBase):
+class LoopCallState(CallFilterBase):
     """
     This filter flags out calls where the call comes back to an already visited state.
 
@@ -105,6 +123,8 @@ class LoopCallState(FilterBase):
     them.
     """
 
+    columns = ["call_uuid", "state_transitions"]
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -112,11 +132,13 @@ class LoopCallState(FilterBase):
         raise NotImplementedError
 
     def process(self, df: pd.DataFrame) -> pd.DataFrame:
-        df = self._filter_last_turn(df)
-        df = self.annotate(df, df.state_transitions,
-                           self._get_loop, "state_loop")
+        filtered_df = self._filter_last_turn(df)
+        filtered_df = self.annotate(filtered_df, filtered_df.state_transitions,
+                                    self._get_loop, "state_loop",
+                                    batch_func=partial(self._get_loop_batch,
+                                                       df.sentinel.state_transitions))
 
-        return df
+        return filtered_df
 
     def _get_loop(self, item: str):
         state_transitions = list(map(lambda x: x.strip(), item.split("->")))
@@ -131,7 +153,18 @@ class LoopCallState(FilterBase):
             return {"state_loop": True}
         return None
 
-    def _filter_last_turn(self, df: pd.DataFrame) -> pd.DataFrame:
-        filtered_df = df.drop_duplicates(subset=["call_uuid"], keep="last")
+    def _get_loop_batch(self, state_transitions: StateTransitions,
+                        df: pd.DataFrame) -> Tuple[np.ndarray, Dict[str, bool]]:
+        """
+        Flag calls which come back to a state they already left.
 
-        return filtered_df
+        Parameters:
+            state_transitions (StateTransitions): parsed state transitions of the input dataframe.
+            df (pd.DataFrame): last turn of every call.
+
+        Returns:
+            Mask of flagged calls and their metadata.
+        """
+        visit_count = state_transitions.max_visit_count(df.state_transitions)
+
+        return visit_count >= 2, {"state_loop": True}
@@ -0,0 +1,250 @@
+"""
+Incremental runs over append-only, partitioned data.
+
+Partitions are the directories under a `data_url` prefix, e.g.
+`s3://bucket/calls/date=2021-01-01/hour=00/`. A checkpoint records the
+objects already processed along with the state the call level filters
+carry between runs, so every run only reads new objects. Checkpoints are
+JSON documents, the carried rows are embedded as CSV, so loading one never
+runs code from the storage.
+
+Calls may span partitions, so a call is only evaluated by the call level
+filters once it has gone without new turns for `settle_partitions`
+partitions. Till then its last turn is kept in the checkpoint if the
+filters flag it, and re-evaluated if the call gets new turns.
+"""
+import io
+import json
+import logging
+import os
+import posixpath
+import tempfile
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import ClientError
+
+import sentinel.util as util
+from sentinel.dataframes.reader import CSVReader
+from sentinel.exporters.csv import CSVExporter
+from sentinel.filters.base import CallFilterBase, FilterBase, FilterResult
+
+DEFAULT_SETTLE_PARTITIONS = 1
+
+# Objects under a partitioned prefix which don't hold data, e.g. `_SUCCESS`
+IGNORED_PREFIXES = ("_", ".")
+
+# Column keeping the row ids of the carried call state
+ROW_ID_COLUMN = "_row_id"
+
+
+class Checkpoint:
+    """
+    Progress of incremental runs of a config.
+
+    Attributes:
+        path (str): local or S3 path the checkpoint is stored at.
+        objects (set): S3 paths of the processed objects.
+        sequence (int): number of partitions processed so far.
+        rows (int): number of rows processed so far, the index of the next row.
+        last_seen (pd.Series): sequence number of the last partition every
+                               unsettled call had turns in, indexed by call uuid.
+        call_state (dict): flagged last turns of the unsettled calls, per call level filter name.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.objects = set()
+        self.sequence = 0
+        self.rows = 0
+        self.last_seen = pd.Series(dtype=np.int64)
+        self.call_state: Dict[str, Optional[pd.DataFrame]] = {}
+
+    @classmethod
+    def load(cls, path: str) -> "Checkpoint":
+        """
+        Load a checkpoint, an empty one if there is none at `path` yet.
+
+        Parameters:
+            path (str): local or S3 path.
+        """
+        checkpoint = cls(path)
+        try:
+            if path.startswith("s3://"):
+                fileobj = util.download_fileobj(path, decompress=False)
+            else:
+                fileobj = open(path, "rb")
+        except FileNotFoundError:
+            return checkpoint
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return checkpoint
+            raise
+
+        with fileobj:
+            data = json.load(fileobj)
+
+        checkpoint.objects = set(data["objects"])
+        checkpoint.sequence = data["sequence"]
+        checkpoint.rows = data["rows"]
+        checkpoint.last_seen = pd.Series(data["last_seen"], dtype=np.int64)
+        checkpoint.call_state = {name: cls._decode_call_state(name, state)
+                                 for name, state in data["call_state"].items()}
+
+        return checkpoint
+
+    def save(self):
+        """
+        Store the checkpoint, replacing the previous one atomically.
+        """
+        data = json.dumps({
+            "objects": sorted(self.objects),
+            "sequence": self.sequence,
+            "rows": self.rows,
+            "last_seen": {str(call_uuid): int(sequence) for call_uuid, sequence in self.last_seen.items()},
+            "call_state": {name: self._encode_call_state(name, state)
+                           for name, state in self.call_state.items() if state is not None},
+        }).encode("utf-8")
+
+        if self.path.startswith("s3://"):
+            bucket, object_name = util.split_s3_path(self.path)
+            with util.S3MultipartWriter(bucket, object_name) as writer:
+                writer.write(data)
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _encode_call_state(name: str, state: pd.DataFrame) -> str:
+        """
+        Encode the carried rows of a call level filter as CSV, the way they
+        are exported, with the filter's annotations as a JSON column.
+        """
+        state = CSVExporter._serialize(state).assign(**{name: state[name].map(json.dumps)})
+
+        return state.to_csv(index_label=ROW_ID_COLUMN)
+
+    @staticmethod
+    def _decode_call_state(name: str, state: str) -> pd.DataFrame:
+        """
+        Decode the carried rows of a call level filter, see `_encode_call_state`.
+        """
+        df = CSVReader(io.StringIO(state), json_columns=[name]).read()
+
+        return df.set_index(ROW_ID_COLUMN).rename_axis(None)
+
+
+def list_partitions(data_url: str, checkpoint: Checkpoint) -> List[List[str]]:
+    """
+    Get the objects under a partitioned prefix not processed yet, grouped
+    by partition. Partitions and objects are in key order, so zero padded
+    `date=.../hour=...` partitions come in time order.
+
+    Parameters:
+        data_url (str): S3 prefix of the partitions.
+        checkpoint (Checkpoint): checkpoint of the previous runs.
+
+    Returns:
+        list: S3 paths of the new objects of every partition.
+    """
+    bucket, _ = util.split_s3_path(data_url)
+
+    partitions = {}
+    for item in util.list_objects(data_url):
+        key = item["Key"]
+        if key.endswith("/") or posixpath.basename(key).startswith(IGNORED_PREFIXES):
+            continue
+
+        s3_path = f"s3://{bucket}/{key}"
+        if s3_path not in checkpoint.objects:
+            partitions.setdefault(posixpath.dirname(key), []).append(s3_path)
+
+    return [partitions[partition] for partition in sorted(partitions)]
+
+
+def run_incremental(filter: FilterBase, partitions: List[List[str]],
+                    read_partition: Callable[[str], Iterable[pd.DataFrame]],
+                    checkpoint: Checkpoint,
+                    settle_partitions: int = DEFAULT_SETTLE_PARTITIONS) -> List[FilterResult]:
+    """
+    Run a filter chain over new partitions, picking up the state of the
+    previous runs from the checkpoint. The checkpoint is updated in place,
+    but not saved.
+
+    Turn level filters run on the new rows only. Call level filters carry
+    the flagged last turns over, and report calls once they have had no
+    new turns for `settle_partitions` partitions.
+
+    Parameters:
+        filter (FilterBase): first filter of the chain.
+        partitions (list): S3 paths of the new objects of every partition, see `list_partitions`.
+        read_partition (Callable): reads an object as a stream of dataframe chunks.
+        checkpoint (Checkpoint): checkpoint of the previous runs.
+        settle_partitions (int): partitions without new turns after which a
+                                 call is evaluated. 0 evaluates every call
+                                 on the last turn seen so far, so calls
+                                 spanning runs may be reported again.
+
+    Returns:
+        list: one result per filter in the chain.
+    """
+    filters = filter._get_chain()
+    call_filters = [chain_filter for chain_filter in filters if isinstance(chain_filter, CallFilterBase)]
+    for call_filter in call_filters:
+        call_filter._call_state = checkpoint.call_state.get(call_filter.name)
+
+    last_seen = [checkpoint.last_seen]
+    for objects in partitions:
+        checkpoint.sequence += 1
+        for s3_path in objects:
+            for chunk in read_partition(s3_path):
+                # row ids unique across partitions and runs
+                chunk.index = pd.RangeIndex(checkpoint.rows, checkpoint.rows + len(chunk))
+                checkpoint.rows += len(chunk)
+
+                for chain_filter in filters:
+                    chain_filter.process_chunk(chunk)
+
+                if call_filters and "call_uuid" in chunk:
+                    calls = pd.unique(chunk.call_uuid.dropna())
+                    last_seen.append(pd.Series(checkpoint.sequence, index=calls, dtype=np.int64))
+
+            checkpoint.objects.add(s3_path)
+        logging.info(f"Processed partition {checkpoint.sequence}: {len(objects)} objects")
+
+    last_seen = pd.concat(last_seen)
+    last_seen = last_seen[~last_seen.index.duplicated(keep="last")]
+
+    settled = last_seen.index[checkpoint.sequence - last_seen.values >= settle_partitions]
+    checkpoint.last_seen = last_seen.drop(settled)
+
+    results = []
+    for chain_filter in filters:
+        if isinstance(chain_filter, CallFilterBase):
+            results.append(chain_filter.settle(settled))
+            checkpoint.call_state[chain_filter.name] = chain_filter._call_state
+            chain_filter._call_state = None
+        else:
+            results.append(chain_filter.merge_chunks())
+
+    return results
+
+
+def get_incremental_options(config: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Get the `incremental` options of a config with their defaults.
+
+    Parameters:
+        config (dict): sentinel config.
+    """
+    options = {"settle_partitions": DEFAULT_SETTLE_PARTITIONS, **(config.get("incremental") or {})}
+    if not options.get("checkpoint"):
+        raise ValueError("incremental runs need a `checkpoint` path")
+
+    return options
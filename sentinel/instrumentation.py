@@ -0,0 +1,234 @@
+"""
+Per-stage timing and memory instrumentation of sentinel runs.
+
+Stages (download, read, every filter, every exporter etc.) are recorded
+with `stage`. Metrics of a stage run many times (e.g. a filter over
+chunks) are summed up.
+"""
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from tabulate import tabulate
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class StageMetrics:
+    """
+    Metrics of a stage.
+
+    Attributes:
+        name (str): stage name, e.g. `filter:no_alternatives`.
+        calls (int): number of times the stage ran.
+        wall_seconds (float): wall time.
+        cpu_seconds (float): CPU time of the process while the stage ran.
+                             Includes other threads running at the same time.
+        peak_rss_mb (float): peak resident memory of the process by the end of the stage.
+        rows_in (int): rows the stage got, None if not applicable.
+        rows_out (int): rows the stage produced, None if not applicable.
+        bytes (int): bytes transferred, None if not applicable.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_mb = None
+        self.rows_in = None
+        self.rows_out = None
+        self.bytes = None
+
+    def to_dict(self) -> Dict:
+        return dict(vars(self))
+
+
+class StageRecord:
+    """
+    Counts of a single run of a stage, set by the instrumented code.
+    """
+
+    def __init__(self, rows_in: Optional[int] = None):
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.bytes = None
+
+
+def _add(total: Optional[int], value: Optional[int]) -> Optional[int]:
+    if value is None:
+        return total
+    return (total or 0) + value
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    """
+    Peak resident memory of the process in megabytes, None if unknown.
+    """
+    if resource is None:
+        return None
+
+    # kilobytes on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (2 ** 20 if os.uname().sysname == "Darwin" else 2 ** 10)
+
+
+class Instrumentation:
+    """
+    Collects stage metrics of a run. Safe to use from many threads.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, StageMetrics] = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+
+    @contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None) -> Iterator[StageRecord]:
+        """
+        Record a stage.
+
+        Parameters:
+            name (str): stage name.
+            rows_in (int): rows the stage gets.
+
+        Yields:
+            StageRecord: record to set `rows_out` and `bytes` of the stage on.
+        """
+        record = StageRecord(rows_in)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            wall_seconds = time.perf_counter() - wall_start
+            cpu_seconds = time.process_time() - cpu_start
+            peak_rss_mb = get_peak_rss_mb()
+            metrics = StageMetrics(name)
+            metrics.calls = 1
+            metrics.wall_seconds = wall_seconds
+            metrics.cpu_seconds = cpu_seconds
+            metrics.peak_rss_mb = peak_rss_mb
+            metrics.rows_in = record.rows_in
+            metrics.rows_out = record.rows_out
+            metrics.bytes = record.bytes
+            self.merge([metrics])
+
+    def merge(self, stages: List[StageMetrics]):
+        """
+        Add metrics recorded elsewhere, e.g. in a worker process.
+
+        Parameters:
+            stages (list): stage metrics.
+        """
+        with self._lock:
+            for other in stages:
+                metrics = self.stages.setdefault(other.name, StageMetrics(other.name))
+                metrics.calls += other.calls
+                metrics.wall_seconds += other.wall_seconds
+                metrics.cpu_seconds += other.cpu_seconds
+                if other.peak_rss_mb is not None:
+                    metrics.peak_rss_mb = max(metrics.peak_rss_mb or 0, other.peak_rss_mb)
+                metrics.rows_in = _add(metrics.rows_in, other.rows_in)
+                metrics.rows_out = _add(metrics.rows_out, other.rows_out)
+                metrics.bytes = _add(metrics.bytes, other.bytes)
+
+    def get_metrics(self) -> List[StageMetrics]:
+        """
+        Metrics of every stage, in the order the stages first ran.
+        """
+        with self._lock:
+            return list(self.stages.values())
+
+    def summary(self) -> str:
+        """
+        Get a table of the stage metrics.
+        """
+        headers = ["stage", "calls", "wall (s)", "cpu (s)", "peak rss (MB)", "rows in", "rows out", "bytes"]
+        table_data = [(metrics.name, metrics.calls, f"{metrics.wall_seconds:.3f}",
+                       f"{metrics.cpu_seconds:.3f}",
+                       "" if metrics.peak_rss_mb is None else f"{metrics.peak_rss_mb:.1f}",
+                       metrics.rows_in, metrics.rows_out, metrics.bytes)
+                      for metrics in self.get_metrics()]
+
+        return tabulate(table_data, headers, tablefmt="grid")
+
+    def write_json(self, path: str):
+        """
+        Write stage metrics as JSON.
+
+        Parameters:
+            path (str): file path.
+        """
+        payload = {"stages": [metrics.to_dict() for metrics in self.get_metrics()]}
+        _write_atomic(path, json.dumps(payload, indent=2))
+
+    def write_prometheus(self, path: str, labels: Optional[Dict[str, str]] = None):
+        """
+        Write stage metrics in the Prometheus text format, for the node
+        exporter's textfile collector.
+
+        Parameters:
+            path (str): file path, should end with `.prom`.
+            labels (dict): extra labels of all the metrics, e.g. the config name.
+        """
+        gauges = [
+            ("wall_seconds", "Wall time of a sentinel run stage in seconds."),
+            ("cpu_seconds", "Process CPU time during a sentinel run stage in seconds."),
+            ("peak_rss_mb", "Peak resident memory by the end of a sentinel run stage in megabytes."),
+            ("rows_in", "Rows going into a sentinel run stage."),
+            ("rows_out", "Rows coming out of a sentinel run stage."),
+            ("bytes", "Bytes transferred by a sentinel run stage."),
+        ]
+
+        lines = []
+        for field, description in gauges:
+            metric = f"sentinel_stage_{field}"
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} gauge")
+            for metrics in self.get_metrics():
+                value = getattr(metrics, field)
+                if value is None:
+                    continue
+                metric_labels = {**(labels or {}), "stage": metrics.name}
+                label_text = ",".join(f'{key}="{_escape_label(value)}"'
+                                      for key, value in metric_labels.items())
+                lines.append(f"{metric}{{{label_text}}} {value}")
+
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _write_atomic(path: str, text: str):
+    """
+    Write a file atomically, so collectors never read a partial file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Instrumentation of the current process
+instrumentation = Instrumentation()
+
+
+def stage(name: str, rows_in: Optional[int] = None):
+    """
+    Record a stage with the process' instrumentation, see `Instrumentation.stage`.
+    """
+    return instrumentation.stage(name, rows_in)
@@ -0,0 +1,356 @@
+"""
+Profiling of sentinel runs.
+
+A profiler covers the whole run. Filters run inside a scope named after
+their class, so hotspots can be reported per filter class.
+"""
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Iterator, List, Optional, Tuple, Type
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+import sentinel.dataframes.accessor  # noqa: F401, registers `df.sentinel`
+
+# Hotspot: (function, own seconds, cumulative seconds)
+Hotspot = Tuple[str, float, float]
+
+DEFAULT_SAMPLING_INTERVAL = 0.005
+
+# Profiler of the current run, set by `profile`
+_active_profiler = None
+
+
+class Profiler(ABC):
+    """
+    Base class for profilers.
+
+    Parameters:
+        output (str): path to write the profile to.
+    """
+
+    # output file written if none is given
+    default_output = None
+
+    def __init__(self, output: Optional[str] = None):
+        self.output = output or self.default_output
+
+    @abstractmethod
+    def start(self):
+        pass
+
+    @abstractmethod
+    def stop(self):
+        pass
+
+    @abstractmethod
+    def scope(self, name: str):
+        """
+        Context manager attributing the code run inside it to scope `name`.
+        """
+        pass
+
+    @abstractmethod
+    def write(self):
+        """
+        Write the profile to `output`.
+        """
+        pass
+
+    @abstractmethod
+    def hotspots(self, limit: int = 10) -> Dict[str, List[Hotspot]]:
+        """
+        Get the functions with the highest own time of every scope.
+
+        Parameters:
+            limit (int): functions per scope.
+
+        Returns:
+            dict: map of scope name and its hotspots.
+        """
+        pass
+
+    def report(self, limit: int = 10) -> str:
+        """
+        Get a table of the hotspots of every scope.
+
+        Parameters:
+            limit (int): functions per scope.
+        """
+        headers = ["scope", "function", "own (s)", "cumulative (s)"]
+        table_data = [(name, function, f"{own:.3f}", f"{cumulative:.3f}")
+                      for name, hotspots in self.hotspots(limit).items()
+                      for function, own, cumulative in hotspots]
+
+        return tabulate(table_data, headers, tablefmt="grid")
+
+
+def _get_function_name(filename: str, line: int, name: str) -> str:
+    if filename == "~":
+        # builtins
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+class CProfileProfiler(Profiler):
+    """
+    Deterministic profiler based on `cProfile`. Writes a pstats file, which
+    can be opened with `pstats`, snakeviz or speedscope.
+
+    Only the thread starting the profiler is profiled, so exporters (which
+    run in their own threads) aren't covered.
+    """
+
+    default_output = "sentinel.prof"
+
+    def __init__(self, output: Optional[str] = None):
+        super().__init__(output)
+        self._profile = cProfile.Profile()
+        self._scopes: Dict[str, cProfile.Profile] = {}
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+
+    @contextmanager
+    def scope(self, name: str) -> Iterator[None]:
+        # only one profile can be active at a time, so the run's profile is
+        # paused while the scope's one records
+        scope_profile = self._scopes.setdefault(name, cProfile.Profile())
+        self._profile.disable()
+        scope_profile.enable()
+        try:
+            yield
+        finally:
+            scope_profile.disable()
+            self._profile.enable()
+
+    def get_stats(self) -> pstats.Stats:
+        """
+        Get the stats of the whole run, scopes included.
+        """
+        stats = pstats.Stats(self._profile)
+        for scope_profile in self._scopes.values():
+            stats.add(scope_profile)
+
+        return stats
+
+    def write(self):
+        self.get_stats().dump_stats(self.output)
+
+    def hotspots(self, limit: int = 10) -> Dict[str, List[Hotspot]]:
+        hotspots = {}
+        for name, scope_profile in self._scopes.items():
+            stats = pstats.Stats(scope_profile).stats
+            functions = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+            hotspots[name] = [(_get_function_name(*function), own, cumulative)
+                              for function, (_, _, own, cumulative, _) in functions]
+
+        return hotspots
+
+
+class SamplingProfiler(Profiler):
+    """
+    Statistical profiler sampling the stacks of all threads at a fixed
+    interval. Cheap enough to leave the run's timing mostly untouched.
+    Writes a speedscope file with a profile per thread.
+
+    Parameters:
+        output (str): path to write the profile to.
+        interval (float): seconds between samples.
+    """
+
+    default_output = "sentinel.speedscope.json"
+
+    def __init__(self, output: Optional[str] = None, interval: float = DEFAULT_SAMPLING_INTERVAL):
+        super().__init__(output)
+        self.interval = interval
+
+        # frame key (function, file, line) -> frame id
+        self._frames: Dict[Tuple[str, str, int], int] = {}
+        # thread name -> (stacks of frame ids, root first, weights, scopes)
+        self._samples: Dict[str, Tuple[List[List[int]], List[float], List[Optional[str]]]] = {}
+        # thread id -> current scope
+        self._scope_names: Dict[int, str] = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="sentinel-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    @contextmanager
+    def scope(self, name: str) -> Iterator[None]:
+        thread_id = threading.get_ident()
+        previous = self._scope_names.get(thread_id)
+        self._scope_names[thread_id] = name
+        try:
+            yield
+        finally:
+            if previous is None:
+                self._scope_names.pop(thread_id, None)
+            else:
+                self._scope_names[thread_id] = previous
+
+    def _get_frame_id(self, frame) -> int:
+        code = frame.f_code
+        return self._frames.setdefault((code.co_name, code.co_filename, code.co_firstlineno), len(self._frames))
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            now = time.perf_counter()
+            weight, last = now - last, now
+
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(self._get_frame_id(frame))
+                    frame = frame.f_back
+                stack.reverse()
+
+                stacks, weights, scopes = self._samples.setdefault(
+                    thread_names.get(thread_id, str(thread_id)), ([], [], []))
+                stacks.append(stack)
+                weights.append(weight)
+                scopes.append(self._scope_names.get(thread_id))
+
+    def write(self):
+        frames = [{"name": name, "file": filename, "line": line} for name, filename, line in self._frames]
+        profiles = [{
+            "type": "sampled",
+            "name": thread_name,
+            "unit": "seconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": stacks,
+            "weights": weights,
+        } for thread_name, (stacks, weights, _) in self._samples.items()]
+
+        with open(self.output, "w") as f:
+            json.dump({
+                "$schema": "https://www.speedscope.app/file-format-schema.json",
+                "name": "sentinel",
+                "exporter": "sentinel",
+                "shared": {"frames": frames},
+                "profiles": profiles,
+            }, f)
+
+    def hotspots(self, limit: int = 10) -> Dict[str, List[Hotspot]]:
+        frame_names = [_get_function_name(filename, line, name) for name, filename, line in self._frames]
+
+        # scope -> frame id -> [own, cumulative]
+        times: Dict[str, Dict[int, List[float]]] = {}
+        for stacks, weights, scopes in self._samples.values():
+            for stack, weight, scope in zip(stacks, weights, scopes):
+                if scope is None or not stack:
+                    continue
+                scope_times = times.setdefault(scope, {})
+                scope_times.setdefault(stack[-1], [0.0, 0.0])[0] += weight
+                for frame_id in set(stack):
+                    scope_times.setdefault(frame_id, [0.0, 0.0])[1] += weight
+
+        hotspots = {}
+        for scope, scope_times in times.items():
+            functions = sorted(scope_times.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+            hotspots[scope] = [(frame_names[frame_id], own, cumulative)
+                               for frame_id, (own, cumulative) in functions if own > 0]
+
+        return hotspots
+
+
+PROFILERS: Dict[str, Type[Profiler]] = {
+    "cprofile": CProfileProfiler,
+    "sampling": SamplingProfiler,
+}
+
+
+@contextmanager
+def profile(profiler_name: str = "cprofile", output: Optional[str] = None, **kwargs) -> Iterator[Profiler]:
+    """
+    Profile the code run inside the context and write the profile on exit.
+
+    Parameters:
+        profiler_name (str): `cprofile` or `sampling`.
+        output (str): path to write the profile to, the profiler's default if not set.
+        kwargs: profiler options, e.g. `interval` of the sampling profiler.
+
+    Yields:
+        Profiler: the running profiler.
+    """
+    global _active_profiler
+
+    if profiler_name not in PROFILERS:
+        raise ValueError(f"Unknown profiler {profiler_name}, use one of {', '.join(PROFILERS)}")
+
+    profiler = PROFILERS[profiler_name](output, **kwargs)
+    _active_profiler = profiler
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        _active_profiler = None
+        profiler.write()
+
+
+def profile_scope(name: str):
+    """
+    Attribute the code run inside the context to scope `name` of the active
+    profiler. Does nothing if nothing is being profiled.
+
+    Parameters:
+        name (str): scope name, e.g. a filter class.
+    """
+    if _active_profiler is None:
+        return nullcontext()
+    return _active_profiler.scope(name)
+
+
+def sample_calls(df: pd.DataFrame, rows: int) -> pd.DataFrame:
+    """
+    Get a deterministic subset of whole calls with at most `rows` turns.
+
+    Calls are picked in order of a hash of their uuid, so the same calls are
+    picked on every run no matter how the rows are ordered. Dataframes
+    without a `call_uuid` column are cut to their first `rows` rows.
+
+    Parameters:
+        df (pd.DataFrame): call/turn dataframe.
+        rows (int): maximum number of rows.
+
+    Returns:
+        pd.DataFrame: rows of the picked calls, in their original order.
+    """
+    if len(df) <= rows:
+        return df
+    if "call_uuid" not in df:
+        return df.iloc[:rows]
+
+    calls = df.sentinel.calls
+    hashes = pd.util.hash_array(np.asarray(calls.calls, dtype=str).astype(object))
+    order = np.argsort(hashes, kind="stable")
+    picked = order[np.cumsum(calls.lengths[order]) <= rows]
+
+    return df[np.isin(calls.codes, picked)]
@@ -0,0 +1,451 @@
+"""
+Near real time monitoring of streamed turn events.
+
+Turn events (one JSON object per turn, with the columns of a call/turn
+dataframe) are read from a source in small batches. Turn level filters run
+on every batch as it comes in. Call level filters run on the last turn of
+every call, which is kept in memory till the call ends or goes idle for
+`ttl` seconds. Flagged rows are sent to the exporters right away.
+
+A call ends with an event `{"call_uuid": ..., "call_end": true}`, or with
+`"call_end": true` on its last turn.
+"""
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+from sentinel.dataframes.reader import RecordsReader
+from sentinel.exporters.base import Exporter, ExporterDispatcher
+from sentinel.filters.base import CallFilterBase, FilterBase, FilterResult
+from sentinel.instrumentation import stage
+
+# Turn event: column name -> value
+Event = Dict[str, Any]
+
+DEFAULT_BATCH_INTERVAL = 0.2
+DEFAULT_MAX_BATCH = 1000
+DEFAULT_TTL = 600.0
+FILE_POLL_INTERVAL = 0.1
+
+EVALUATE_TURN = "turn"
+EVALUATE_CALL_END = "call_end"
+
+# Keys of an event which only marks the end of a call
+CALL_END_KEYS = {"call_uuid", "call_end"}
+
+
+class Source(ABC):
+    """
+    Base class for turn event sources.
+    """
+
+    @abstractmethod
+    def poll(self, timeout: float, max_events: int = DEFAULT_MAX_BATCH) -> Optional[List[Event]]:
+        """
+        Get the events available within `timeout` seconds.
+
+        Parameters:
+            timeout (float): seconds to wait for the first event.
+            max_events (int): most events to return.
+
+        Returns:
+            list: events, possibly none. None once the source is exhausted.
+        """
+        pass
+
+    def close(self):
+        """
+        Stop reading events.
+        """
+        pass
+
+
+class QueueSource(Source):
+    """
+    Events put on a queue. Putting `None` ends the stream. Sources reading
+    in background threads build on it.
+
+    Parameters:
+        events (queue.Queue): event queue, a new one if not set.
+    """
+
+    def __init__(self, events: Optional[queue.Queue] = None):
+        self.events = events if events is not None else queue.Queue()
+        self._exhausted = False
+
+    def put(self, event: Optional[Event]):
+        self.events.put(event)
+
+    def poll(self, timeout: float, max_events: int = DEFAULT_MAX_BATCH) -> Optional[List[Event]]:
+        if self._exhausted:
+            return None
+
+        events = []
+        try:
+            event = self.events.get(timeout=timeout)
+            while True:
+                if event is None:
+                    self._exhausted = True
+                    break
+                events.append(event)
+                if len(events) >= max_events:
+                    break
+                event = self.events.get_nowait()
+        except queue.Empty:
+            pass
+
+        return events
+
+    def _put_line(self, line: bytes):
+        """
+        Decode a line of JSON and queue it, skipping malformed lines.
+        """
+        line = line.strip()
+        if not line:
+            return
+        try:
+            event = json_loads(line)
+        except ValueError:
+            logging.warning(f"Skipping malformed event: {line[:200]!r}")
+            return
+        if isinstance(event, dict):
+            self.put(event)
+
+
+class FileTailSource(QueueSource):
+    """
+    Events appended to a JSON lines file, like `tail -F`. The file is
+    reopened if it is rotated or truncated.
+
+    Parameters:
+        path (str): file path, waited for if it doesn't exist yet.
+        from_start (bool): read the events already in the file too.
+        poll_interval (float): seconds between checks for new lines.
+    """
+
+    def __init__(self, path: str, from_start: bool = False,
+                 poll_interval: float = FILE_POLL_INTERVAL):
+        super().__init__()
+        self.path = path
+        self.from_start = from_start
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        # events written from now on are read even before the thread starts
+        self._file = self._try_open(seek_end=not from_start)
+        self._thread = threading.Thread(target=self._tail, name="sentinel-file-source", daemon=True)
+        self._thread.start()
+
+    def _try_open(self, seek_end: bool):
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        if seek_end:
+            f.seek(0, os.SEEK_END)
+        return f
+
+    def _open(self, seek_end: bool):
+        while not self._stop.is_set():
+            f = self._try_open(seek_end)
+            if f is not None:
+                return f
+            self._stop.wait(self.poll_interval)
+        return None
+
+    def _tail(self):
+        # a file created later is read from its start
+        f = self._file or self._open(seek_end=False)
+        partial = b""
+        while f is not None and not self._stop.is_set():
+            line = f.readline()
+            if line:
+                if line.endswith(b"\n"):
+                    self._put_line(partial + line)
+                    partial = b""
+                else:
+                    partial += line
+                continue
+
+            try:
+                stat = os.stat(self.path)
+                rotated = stat.st_ino != os.fstat(f.fileno()).st_ino or stat.st_size < f.tell()
+            except FileNotFoundError:
+                rotated = False
+
+            if rotated:
+                f.close()
+                f = self._open(seek_end=False)
+                partial = b""
+            else:
+                self._stop.wait(self.poll_interval)
+
+        if f is not None:
+            f.close()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class UnixSocketSource(QueueSource):
+    """
+    Events sent as JSON lines to a Unix domain socket. Any number of
+    producers can connect at the same time.
+
+    Parameters:
+        path (str): socket path, replaced if it exists.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._accept, name="sentinel-socket-source", daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while not self._stop.is_set():
+            try:
+                connection, _ = self._server.accept()
+            except OSError:
+                # closed
+                return
+            threading.Thread(target=self._read, args=(connection,), daemon=True).start()
+
+    def _read(self, connection: socket.socket):
+        with connection, connection.makefile("rb") as lines:
+            for line in lines:
+                self._put_line(line)
+
+    def close(self):
+        self._stop.set()
+        try:
+            # wakes up the blocked `accept`
+            self._server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._server.close()
+        self._thread.join()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+# Event sources by name, see `stream.source` in the config spec
+SOURCES = {
+    "file": FileTailSource,
+    "socket": UnixSocketSource,
+    "queue": QueueSource,
+}
+
+
+def _is_call_end(event: Event) -> bool:
+    """
+    Whether an event only marks the end of a call, without a turn.
+    """
+    return bool(event.get("call_end")) and event.keys() <= CALL_END_KEYS
+
+
+class CallState:
+    """
+    Rolling state of an ongoing call.
+
+    Attributes:
+        row_id (int): row id of the last turn.
+        last_turn (dict): event of the last turn.
+        last_seen (float): time the last event of the call came in.
+        alerted (set): names of the filters which already flagged the call.
+    """
+
+    def __init__(self, row_id: int, last_turn: Event, last_seen: float):
+        self.row_id = row_id
+        self.last_turn = last_turn
+        self.last_seen = last_seen
+        self.alerted = set()
+
+
+class StreamProcessor:
+    """
+    Runs a filter chain over batches of streamed turn events and sends the
+    flagged rows to the exporters.
+
+    Every turn gets a row id unique within the stream, so a turn flagged by
+    turn and call level filters is the same row for the exporters.
+
+    Parameters:
+        filter (FilterBase): first filter of the chain.
+        exporters (list): exporters the flagged rows are sent to.
+        evaluate (str): when call level filters run. `turn` runs them on
+                        every new turn of a call and flags a call at most
+                        once per filter. `call_end` runs them once, when the
+                        call ends or goes idle for `ttl` seconds.
+        ttl (float): seconds without events after which a call is dropped.
+        export_timeout (float): seconds every exporter may take per batch.
+        json_columns (list): extra JSON encoded event fields to decode.
+        clock (Callable): current time in seconds.
+    """
+
+    def __init__(self, filter: FilterBase, exporters: List[Exporter],
+                 evaluate: str = EVALUATE_TURN, ttl: float = DEFAULT_TTL,
+                 export_timeout: Optional[float] = None,
+                 json_columns: Optional[List[str]] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        if evaluate not in (EVALUATE_TURN, EVALUATE_CALL_END):
+            raise ValueError(f"Unknown evaluate mode {evaluate}, use {EVALUATE_TURN} or {EVALUATE_CALL_END}")
+
+        self.filters = filter._get_chain()
+        self.dispatcher = ExporterDispatcher(exporters, timeout=export_timeout)
+        self.evaluate = evaluate
+        self.ttl = ttl
+        self.json_columns = json_columns
+        self.clock = clock
+
+        # ongoing calls, least recently active first
+        self.calls: "OrderedDict[str, CallState]" = OrderedDict()
+        self._next_row_id = 0
+
+    def _read(self, events: List[Event], index: List[int]) -> pd.DataFrame:
+        return RecordsReader(events, index=index, json_columns=self.json_columns).read()
+
+    def process(self, events: List[Event]) -> List[FilterResult]:
+        """
+        Process a batch of events and export the flagged rows, if any.
+        Calls idle for `ttl` seconds are dropped even if there are no events.
+
+        Parameters:
+            events (list): turn and call end events, in order.
+
+        Returns:
+            list: one result per filter in the chain.
+        """
+        with stage("stream:batch", rows_in=len(events)) as record:
+            results = self._process(events)
+            record.rows_out = sum(len(result) for result in results)
+
+        if any(len(result) for result in results):
+            export_results = self.dispatcher.dispatch(results, [result.category for result in results])
+            for export_result in export_results:
+                if not export_result.ok:
+                    logging.error(f"Exporter {export_result.name} failed to send alerts")
+
+        return results
+
+    def _process(self, events: List[Event]) -> List[FilterResult]:
+        now = self.clock()
+
+        turns = [event for event in events if not _is_call_end(event)]
+        row_ids = list(range(self._next_row_id, self._next_row_id + len(turns)))
+        self._next_row_id += len(turns)
+
+        updated = set()
+        ended = set()
+        turn_ids = iter(row_ids)
+        for event in events:
+            call_uuid = event.get("call_uuid")
+            is_turn = not _is_call_end(event)
+            row_id = next(turn_ids) if is_turn else None
+            if call_uuid is None:
+                continue
+
+            call = self.calls.pop(call_uuid, None)
+            if is_turn:
+                if call is None:
+                    call = CallState(row_id, event, now)
+                else:
+                    call.row_id, call.last_turn = row_id, event
+                updated.add(call_uuid)
+            if call is not None:
+                call.last_seen = now
+                self.calls[call_uuid] = call
+            if event.get("call_end"):
+                ended.add(call_uuid)
+
+        expired = set()
+        for call_uuid, call in self.calls.items():
+            if now - call.last_seen < self.ttl:
+                break
+            expired.add(call_uuid)
+
+        if self.evaluate == EVALUATE_TURN:
+            evaluated = [call_uuid for call_uuid in self.calls if call_uuid in updated]
+        else:
+            evaluated = [call_uuid for call_uuid in self.calls if call_uuid in ended or call_uuid in expired]
+
+        turns_df = self._read(turns, row_ids) if turns else None
+        calls_df = None
+        if evaluated:
+            calls_df = self._read([self.calls[call_uuid].last_turn for call_uuid in evaluated],
+                                  [self.calls[call_uuid].row_id for call_uuid in evaluated])
+
+        # results of filters with nothing to run on keep the columns of the
+        # batch, as exporters read them
+        columns = next((df.columns for df in (turns_df, calls_df) if df is not None), None)
+
+        results = []
+        for chain_filter in self.filters:
+            is_call_filter = isinstance(chain_filter, CallFilterBase)
+            if is_call_filter and calls_df is not None:
+                results.append(self._run_call_filter(chain_filter, calls_df))
+            elif not is_call_filter and turns_df is not None:
+                results.append(chain_filter.run(turns_df))
+            else:
+                results.append(FilterResult.from_frames([], chain_filter.name, columns=columns))
+
+        for call_uuid in ended | expired:
+            self.calls.pop(call_uuid, None)
+
+        return results
+
+    def _run_call_filter(self, call_filter: CallFilterBase, calls_df: pd.DataFrame) -> FilterResult:
+        """
+        Run a call level filter on the last turns of the evaluated calls,
+        skipping calls it already flagged.
+        """
+        result = call_filter.run(calls_df)
+        call_uuids = calls_df.call_uuid.loc[result.index].values
+
+        new = np.array([call_filter.name not in self.calls[call_uuid].alerted
+                        for call_uuid in call_uuids], dtype=bool)
+        for call_uuid in call_uuids[new]:
+            self.calls[call_uuid].alerted.add(call_filter.name)
+
+        return FilterResult(result.df, result.category, result.annotations[new])
+
+    def run(self, source: Source, stop: Optional[threading.Event] = None,
+            batch_interval: float = DEFAULT_BATCH_INTERVAL, max_batch: int = DEFAULT_MAX_BATCH):
+        """
+        Process events from a source till it is exhausted or `stop` is set.
+
+        Parameters:
+            source (Source): event source.
+            stop (threading.Event): set to stop processing.
+            batch_interval (float): seconds to wait for events before
+                                    processing a batch. Bounds the alert latency.
+            max_batch (int): most events per batch.
+        """
+        while stop is None or not stop.is_set():
+            events = source.poll(batch_interval, max_batch)
+            if events is None:
+                break
+            self.process(events)
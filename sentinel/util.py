@@ -1,58 +1,399 @@
+import gzip
 import io
 import logging
+import mmap
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 
 import boto3
 import pandas as pd
-from botocore.exceptions import ClientError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 
+from sentinel.instrumentation import stage
 
-def upload_df_to_s3(df: pd.DataFrame, bucket: str, object_name: str) -> bool:
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Connections kept open by the shared S3 client, also the default number of
+# concurrent range requests.
+S3_MAX_POOL_CONNECTIONS = 16
+
+# Bytes fetched by every range request of `download_fileobj`.
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+# Attempts for every range request before giving up.
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Bytes per part of multipart uploads. S3 needs all parts but the last
+# to be at least 5MB.
+DEFAULT_UPLOAD_PART_SIZE = 8 * 1024 * 1024
+MIN_UPLOAD_PART_SIZE = 5 * 1024 * 1024
+
+# Rows encoded at a time while streaming a CSV upload.
+CSV_UPLOAD_CHUNKSIZE = 10_000
+
+# Errors which won't go away by retrying a range request.
+FATAL_S3_ERRORS = {"AccessDenied", "NoSuchBucket", "NoSuchKey", "PreconditionFailed"}
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+_s3_clients = {}
+
+
+def get_s3_client(max_pool_connections: int = S3_MAX_POOL_CONNECTIONS):
+    """
+    Get S3 client shared by all callers, keeping its connections alive
+    across requests. boto3 clients are safe to share between threads.
+
+    Parameters:
+        max_pool_connections (int): size of the client's connection pool.
+    """
+    if max_pool_connections not in _s3_clients:
+        _s3_clients[max_pool_connections] = boto3.client(
+            "s3", config=Config(max_pool_connections=max_pool_connections,
+                                retries={"mode": "standard"}))
+    return _s3_clients[max_pool_connections]
+
+
+def reset_s3_clients():
+    """
+    Drop the shared S3 clients, so the next `get_s3_client` creates a new
+    one. boto3 clients aren't fork safe, forked worker processes call this
+    before any S3 request.
+    """
+    _s3_clients.clear()
+
+
+def split_s3_path(s3_path: str) -> Tuple[str, str]:
+    """
+    Split S3 path to bucket and object name.
+
+    Parameters:
+        s3_path (str): S3 path, `s3://bucket/object/name`.
+    """
+    s3_path_split = s3_path.split("/")
+    return s3_path_split[2], "/".join(s3_path_split[3:])
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Binary file-like object streaming writes into an S3 multipart upload.
+
+    Written data is buffered until a part is full and then uploaded, so at
+    most one part is held in memory. Objects smaller than a part are
+    uploaded with a single `put_object` on close. If the writer is used as a
+    context manager and an exception is raised, the upload is aborted.
+
+    Parameters:
+        bucket (str): Bucket to upload to.
+        object_name (str): S3 object name.
+        part_size (int): Bytes per uploaded part, at least `MIN_UPLOAD_PART_SIZE`.
+        s3_client: S3 client, the shared one if not set.
+
+    Attributes:
+        bytes_written (int): bytes written so far.
+    """
+
+    def __init__(self, bucket: str, object_name: str,
+                 part_size: int = DEFAULT_UPLOAD_PART_SIZE, s3_client=None):
+        super().__init__()
+        self.bucket = bucket
+        self.object_name = object_name
+        self.part_size = max(part_size, MIN_UPLOAD_PART_SIZE)
+        self.s3_client = s3_client or get_s3_client()
+
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+
+        return len(data)
+
+    def _upload_part(self, data: bytes):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.object_name)
+            self._upload_id = response["UploadId"]
+
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.object_name,
+                                              UploadId=self._upload_id, PartNumber=part_number,
+                                              Body=bytes(data))
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """
+        Upload buffered data and complete the upload.
+        """
+        if self.closed:
+            return
+
+        try:
+            if self._upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.object_name,
+                                          Body=bytes(self._buffer))
+            else:
+                if self._buffer:
+                    self._upload_part(self._buffer)
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket, Key=self.object_name, UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            super().close()
+
+    def abort(self):
+        """
+        Abort the upload, dropping uploaded parts.
+        """
+        if self._upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_name,
+                                                      UploadId=self._upload_id)
+            except (BotoCoreError, ClientError) as e:
+                logging.error(e)
+            self._upload_id = None
+
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+def upload_df_to_s3(df: pd.DataFrame, bucket: str, object_name: str,
+                    compress: bool = False, part_size: int = DEFAULT_UPLOAD_PART_SIZE,
+                    s3_client=None) -> bool:
     """
-    Upload a file to an S3 bucket.
+    Upload a dataframe as CSV to an S3 bucket.
+
+    The CSV is encoded in chunks of rows straight into a multipart upload,
+    without rendering the whole file in memory.
 
     Parameters:
-        fp: File to upload.
+        df (pd.DataFrame): Dataframe to upload.
         bucket (str): Bucket to upload to.
         object_name (str): S3 object name.
+        compress (bool): gzip the CSV.
+        part_size (int): Bytes per uploaded part.
+        s3_client: S3 client, the shared one if not set.
 
     Returns:
         True if file was uploaded, else False.
     """
-
-    # Upload the file
-    s3_client = boto3.client('s3')
     try:
-        fp = io.StringIO()
-        df.to_csv(fp, mode="w", index=False)
-
-        s3_client.put_object(
-            Bucket=bucket,
-            Body=fp.getvalue(),
-            Key=object_name,
-        )
-    except ClientError as e:
+        with stage("s3:upload", rows_in=len(df)) as record, \
+                S3MultipartWriter(bucket, object_name, part_size, s3_client) as writer:
+            fileobj = gzip.GzipFile(fileobj=writer, mode="wb") if compress else writer
+            fp = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+            df.to_csv(fp, mode="w", index=False, chunksize=CSV_UPLOAD_CHUNKSIZE)
+            fp.flush()
+            # keep `writer` open, it completes the upload on exit
+            fp.detach()
+            if compress:
+                fileobj.close()
+            record.bytes = writer.bytes_written
+    except (BotoCoreError, ClientError) as e:
         logging.error(e)
         return False
     return True
 
 
-def download_file(s3_path: str) -> None:
+def upload_dfs_to_s3(dfs: Dict[str, pd.DataFrame], bucket: str, compress: bool = False,
+                     max_workers: int = S3_MAX_POOL_CONNECTIONS) -> Dict[str, bool]:
     """
-    Download file from S3 bucket.
+    Upload many dataframes as CSVs to an S3 bucket concurrently, over the
+    shared S3 client.
 
     Parameters:
-        s3_path (str): S3 object name
+        dfs (dict): map of S3 object name and dataframe.
+        bucket (str): Bucket to upload to.
+        compress (bool): gzip the CSVs.
+        max_workers (int): concurrent uploads.
+
+    Returns:
+        dict: map of S3 object name and whether it was uploaded.
     """
-    s3_path_split = s3_path.split("/")
-    bucket = s3_path_split[2]
-    object_name = "/".join(s3_path_split[3:])
+    if not dfs:
+        return {}
 
-    s3_client = boto3.client('s3')
-    try:
-        s3_response_object = s3_client.get_object(
-            Bucket=bucket,
-            Key=object_name
-        )
-        return s3_response_object
-    except ClientError as e:
-        logging.error(e)
+    s3_client = get_s3_client(max(max_workers, S3_MAX_POOL_CONNECTIONS))
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(dfs))) as pool:
+        futures = {object_name: pool.submit(upload_df_to_s3, df, bucket, object_name,
+                                            compress, s3_client=s3_client)
+                   for object_name, df in dfs.items()}
+
+    return {object_name: future.result() for object_name, future in futures.items()}
+
+
+def head_object(s3_path: str) -> Dict[str, Any]:
+    """
+    Get metadata (size, ETag etc.) of an S3 object.
+
+    Parameters:
+        s3_path (str): S3 object name.
+    """
+    bucket, object_name = split_s3_path(s3_path)
+
+    return get_s3_client().head_object(Bucket=bucket, Key=object_name)
+
+
+def list_objects(s3_path: str) -> List[Dict[str, Any]]:
+    """
+    List all the objects under an S3 prefix.
+
+    Parameters:
+        s3_path (str): S3 prefix, e.g. `s3://bucket/calls/`.
+
+    Returns:
+        list: object metadata (`Key`, `ETag`, `Size` etc.) in key order.
+    """
+    bucket, prefix = split_s3_path(s3_path)
+
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    return [item for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for item in page.get("Contents", [])]
+
+
+def _download_range(s3_client, bucket: str, object_name: str, etag: str,
+                    buffer: mmap.mmap, start: int, end: int, max_attempts: int):
+    """
+    Download the byte range `start`-`end` (inclusive) of an object into the
+    same range of `buffer`, retrying failed requests.
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            response = s3_client.get_object(Bucket=bucket, Key=object_name, IfMatch=etag,
+                                            Range=f"bytes={start}-{end}")
+            data = response["Body"].read()
+            if len(data) != end - start + 1:
+                raise IOError(f"Short read of bytes {start}-{end} of s3://{bucket}/{object_name}")
+
+            buffer[start:end + 1] = data
+            return
+        except (BotoCoreError, ClientError, IOError) as e:
+            error_code = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if error_code in FATAL_S3_ERRORS or attempt == max_attempts:
+                raise
+            logging.warning(f"Retrying bytes {start}-{end} of s3://{bucket}/{object_name}: {e}")
+            time.sleep(0.1 * 2 ** attempt)
+
+
+def _decompress(fileobj: BinaryIO, spool: bool, spool_dir: Optional[str]) -> BinaryIO:
+    """
+    Transparently decompress gzip or zstd compressed data, detected from its
+    magic bytes. Decompressed data is spooled to a new memory mapped temp
+    file if `spool` is set, else it is read from a stream.
+    """
+    magic = fileobj.read(4)
+    fileobj.seek(0)
+
+    if magic.startswith(GZIP_MAGIC):
+        stream = gzip.GzipFile(fileobj=fileobj, mode="rb")
+    elif magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise ImportError("Reading zstd compressed objects needs zstandard, install the `zstd` extra")
+        stream = zstandard.ZstdDecompressor().stream_reader(fileobj)
+    else:
+        return fileobj
+
+    if not spool:
+        return stream
+
+    with tempfile.TemporaryFile(dir=spool_dir) as f:
+        while True:
+            block = stream.read(DEFAULT_PART_SIZE)
+            if not block:
+                break
+            f.write(block)
+        f.flush()
+        fileobj.close()
+        if not f.tell():
+            return io.BytesIO()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def download_fileobj(s3_path: str, part_size: int = DEFAULT_PART_SIZE,
+                     max_workers: int = S3_MAX_POOL_CONNECTIONS,
+                     max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                     spool: bool = False, spool_dir: Optional[str] = None,
+                     decompress: bool = True,
+                     head: Optional[Dict[str, Any]] = None) -> BinaryIO:
+    """
+    Download file from S3 bucket with concurrent byte range requests over
+    a pooled client.
+
+    Parameters:
+        s3_path (str): S3 object name.
+        part_size (int): bytes fetched by every range request.
+        max_workers (int): concurrent range requests.
+        max_attempts (int): attempts for every range request.
+        spool (bool): download to a temp file instead of memory. Either way
+                      the data is memory mapped.
+        spool_dir (str): directory for the temp file, system default if not set.
+        decompress (bool): transparently decompress gzip and zstd (needs
+                           `zstandard`) compressed objects.
+        head (dict): `head_object` response of the object, if already fetched.
+
+    Returns:
+        file-like object with the object's content. Compressed objects are
+        read from a stream unless spooled.
+    """
+    bucket, object_name = split_s3_path(s3_path)
+    s3_client = get_s3_client(max(max_workers, S3_MAX_POOL_CONNECTIONS))
+
+    head = head or s3_client.head_object(Bucket=bucket, Key=object_name)
+    size = head["ContentLength"]
+    if not size:
+        return io.BytesIO()
+
+    if spool:
+        with tempfile.TemporaryFile(dir=spool_dir) as f:
+            f.truncate(size)
+            buffer = mmap.mmap(f.fileno(), size)
+    else:
+        buffer = mmap.mmap(-1, size)
+
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    with stage("s3:download") as record, \
+            ThreadPoolExecutor(max_workers=min(max_workers, len(ranges))) as pool:
+        futures = [pool.submit(_download_range, s3_client, bucket, object_name, head["ETag"],
+                               buffer, start, end, max_attempts)
+                   for start, end in ranges]
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+        record.bytes = size
+
+    if decompress:
+        return _decompress(buffer, spool, spool_dir)
+    return buffer
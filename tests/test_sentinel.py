@@ -1,12 +1,21 @@
+import gzip
+import io
 import os
 import pandas as pd
+import pytest
 
 from sentinel import __version__
+from sentinel import util
+from sentinel.cache import DataFrameCache
 from sentinel.filters.confidence import ASRConfidenceFilter
 from sentinel.filters.alternatives import AlternativesFilter, WordFilter
 from sentinel.filters.prediction import PredictionConfidenceFilter
+from sentinel.filters.matcher import WordMatcher
 from sentinel.filters.state import EndStateFilter, RepeatedCallState, LoopCallState
-from sentinel.dataframes.reader import CSVReader
+import sentinel.dataframes.reader as reader_module
+from sentinel.dataframes.reader import (CSVReader, ParquetReader, ArrowReader, ProtobufReader,
+                                       get_reader_class)
+from sentinel.dataframes.columnar import CallIndex, StateTransitions
 from sentinel.exporters.csv import CSVExporter
 
 
@@ -163,3 +172,983 @@ def test_state_loop_filter():
 
     pd.testing.assert_series_equal(
         df_processed.call_uuid, df_expected.call_uuid, check_index=False)
+
+
+@pytest.mark.parametrize("chunksize", [1, 4])
+def test_chunked_filter_chain(chunksize):
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv")
+    df = csv_reader.read()
+
+    confidence_filter = ASRConfidenceFilter(**{"confidence_threshold": 0.95})
+    confidence_filter.successor = LoopCallState()
+    df_list = confidence_filter.handle(df, [])
+
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv", chunksize=chunksize)
+    confidence_filter = ASRConfidenceFilter(**{"confidence_threshold": 0.95})
+    confidence_filter.successor = LoopCallState()
+    chunked_df_list = confidence_filter.handle_chunks(csv_reader.read_chunks())
+
+    csv_exporter = CSVExporter()
+    for category, df_processed, df_chunked in zip(
+            ["low_asr_confidence", "state_loop"], df_list, chunked_df_list):
+        df_processed = csv_exporter._get_df_for_category(df_processed, category)
+        df_chunked = csv_exporter._get_df_for_category(df_chunked, category)
+
+        pd.testing.assert_series_equal(
+            df_processed.call_uuid, df_chunked.call_uuid, check_index=False)
+
+
+def test_alternatives_array():
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv")
+    df = csv_reader.read()
+
+    expected = []
+    for item in df.alternatives:
+        if not item:
+            expected.append((None, None))
+            continue
+        best = sorted(item[0], key=lambda x: x["confidence"], reverse=True)[0]
+        expected.append((best["confidence"], best["transcript"]))
+
+    alternatives = df.sentinel.alternatives
+    assert alternatives is df.sentinel.alternatives
+    assert list(alternatives.is_empty()) == [item is None for item, _ in expected]
+    assert list(alternatives.best_transcript()) == [transcript for _, transcript in expected]
+    assert [None if pd.isnull(x) else x for x in alternatives.best_confidence()] == \
+        [confidence for confidence, _ in expected]
+
+
+def test_batch_annotation_matches_row_annotation():
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv")
+    df = csv_reader.read()
+    # empty utterance, which isn't the same as no alternatives
+    df = pd.concat([df, df.iloc[[0]].assign(alternatives=[[[]]])], ignore_index=True)
+
+    for filter_function, method, category in [
+            (ASRConfidenceFilter(**{"confidence_threshold": 0.95}), "_get_low_confidence", "low_asr_confidence"),
+            (AlternativesFilter(), "_get_none_alternatives", "no_alternatives"),
+            (WordFilter(**{"word_list": ["customer"]}), "_get_filtered_transcripts", "filter_words")]:
+        expected = df.alternatives.apply(getattr(filter_function, method))
+        df_processed = filter_function.process(df)
+
+        assert list(df_processed[category]) == list(expected)
+
+
+def test_prediction_decoded_once():
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv")
+    df = csv_reader.read()
+    prediction = df.prediction.copy()
+
+    assert df.prediction_score.dtype == float
+
+    low_confidence_filter = PredictionConfidenceFilter(**{"confidence_threshold": 0.95})
+    strict_filter = PredictionConfidenceFilter(**{"confidence_threshold": 0.99})
+    df_low = low_confidence_filter.process(df)["prediction_low_confidence"].copy()
+    df_strict = strict_filter.process(df)["prediction_low_confidence"]
+
+    pd.testing.assert_series_equal(df.prediction, prediction)
+    assert df_low.notnull().sum() <= df_strict.notnull().sum()
+
+
+def test_parallel_filter_chain():
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv")
+    df = csv_reader.read()
+
+    categories = ["low_asr_confidence", "no_alternatives", "state_loop"]
+    filter_function = ASRConfidenceFilter(**{"confidence_threshold": 0.95})
+    filter_function.successor = AlternativesFilter()
+    filter_function.successor.successor = LoopCallState()
+
+    df_list = filter_function.handle(df, [])
+    parallel_df_list = filter_function.handle_parallel(df, max_workers=2)
+
+    csv_exporter = CSVExporter()
+    for category, df_processed, df_parallel in zip(categories, df_list, parallel_df_list):
+        df_processed = csv_exporter._get_df_for_category(df_processed, category)
+        df_parallel = csv_exporter._get_df_for_category(df_parallel, category)
+
+        pd.testing.assert_series_equal(
+            df_processed.call_uuid, df_parallel.call_uuid, check_index=False)
+        assert category not in df
+
+
+def test_filter_chain_does_not_modify_input():
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv")
+    df = csv_reader.read()
+    columns = list(df.columns)
+
+    filter_function = AlternativesFilter()
+    filter_function.successor = EndStateFilter(**{"end_state": ["FOLLOW_UP"]})
+    df_list = filter_function.handle(df, [])
+
+    assert list(df.columns) == columns
+    assert [len(result) for result in df_list] == [9, 1]
+    assert all(result.df is df for result in df_list)
+
+    df_processed = df_list[1].to_frame()
+    assert list(df_processed.call_uuid) == ["077E68A8-3040-471B-968C-FCAF00091500"]
+    assert list(df_processed.call_end_state) == [True]
+
+
+def test_call_index():
+    call_index = CallIndex.from_series(pd.Series(["a", "b", "a", None, "c", "b", "a"]))
+
+    assert list(call_index.calls) == ["a", "b", "c"]
+    assert list(call_index.lengths) == [3, 2, 1]
+    assert list(call_index.turns(0)) == [0, 2, 6]
+    assert list(call_index.first) == [0, 1, 4]
+    assert list(call_index.last) == [6, 5, 4]
+    assert list(call_index.last_turns()) == [4, 5, 6]
+
+
+def test_state_transitions():
+    series = pd.Series(["A -> A -> B -> A", "A -> B -> B -> C", None, "A -> A -> B -> A"])
+    state_transitions = StateTransitions.from_series(series)
+
+    assert len(state_transitions) == 2
+    assert list(state_transitions.states) == ["A", "B", "C"]
+    assert list(state_transitions.max_state_count(series)) == [3, 2, 0, 3]
+    assert list(state_transitions.max_visit_count(series)) == [2, 1, 0, 2]
+
+    csv_reader = CSVReader(f"{package_dir}/resources/records.csv")
+    df = csv_reader.read()
+
+    for filter_function, method, category in [
+            (RepeatedCallState(**{"max_state_count": 4}), "_get_repeated_state", "state_stuck"),
+            (LoopCallState(), "_get_loop", "state_loop")]:
+        expected = df.state_transitions.apply(getattr(filter_function, method))
+        df_processed = filter_function.process(df)
+
+        assert list(df_processed[category]) == list(expected)
+
+
+def test_word_matcher():
+    transcripts = pd.Series(["bicara Customer service", "customers", None, "agent please"])
+
+    matcher = WordMatcher(["customer", "customer service", "agent"])
+    assert list(matcher.contains(transcripts)) == [False, True, False, True]
+    assert matcher.find(transcripts[1]) == ["customer"]
+
+    matcher = WordMatcher(["customer", "customer service", "agent"],
+                          word_boundary=True, case_sensitive=False)
+    assert list(matcher.contains(transcripts)) == [True, False, False, True]
+    assert matcher.find(transcripts[0]) == ["customer service"]
+
+    assert not WordMatcher([]).contains(transcripts).any()
+
+
+def test_columnar_readers(tmp_path):
+    import warnings
+
+    pq = pytest.importorskip("pyarrow.parquet")
+    feather = pytest.importorskip("pyarrow.feather")
+    raw_df = pd.read_csv(f"{package_dir}/resources/records.csv")
+    pq.write_table(pytest.importorskip("pyarrow").Table.from_pandas(raw_df),
+                   tmp_path / "records.parquet", row_group_size=5)
+    feather.write_feather(raw_df, str(tmp_path / "records.arrow"), chunksize=5)
+
+    assert get_reader_class("s3://bucket/records.parquet") is ParquetReader
+    assert get_reader_class("s3://bucket/records.arrow") is ArrowReader
+    assert get_reader_class("s3://bucket/records.csv") is CSVReader
+
+    csv_df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    columns = ["call_uuid", "alternatives", "prediction"]
+    filters = [("state", "=", "COF")]
+    expected = CSVReader(f"{package_dir}/resources/records.csv",
+                         columns=columns, filters=filters).read()
+    assert set(expected.columns) == {"call_uuid", "alternatives", "prediction", "state",
+                                     "prediction_score", "_raw_alternatives", "_raw_prediction"}
+    assert len(expected) == (csv_df.state == "COF").sum()
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", pd.errors.SettingWithCopyWarning)
+        chunks = list(CSVReader(f"{package_dir}/resources/records.csv", chunksize=5, filters=filters).read_chunks())
+    assert sum(len(chunk) for chunk in chunks) == len(expected)
+
+    for reader_class, path in [(ParquetReader, "records.parquet"), (ArrowReader, "records.arrow")]:
+        df = reader_class(str(tmp_path / path)).read()
+        pd.testing.assert_series_equal(df.alternatives, csv_df.alternatives)
+        pd.testing.assert_series_equal(df.prediction_score, csv_df.prediction_score)
+
+        reader = reader_class(str(tmp_path / path), chunksize=4, columns=columns, filters=filters)
+        df = reader.read()
+        assert list(df.columns) == columns + ["_raw_alternatives", "_raw_prediction", "prediction_score"]
+        assert list(df.call_uuid) == list(expected.call_uuid)
+
+        chunks = list(reader.read_chunks())
+        assert all(len(chunk) <= 4 for chunk in chunks)
+        pd.testing.assert_frame_equal(pd.concat(chunks), df)
+
+        reader = reader_class(str(tmp_path / path), columns=columns + ["missing"],
+                              filters=[("other", "=", 1)])
+        for read in [reader.read, lambda: list(reader.read_chunks())]:
+            with pytest.raises(ValueError, match="missing, other"):
+                read()
+
+
+def _get_turn_message_type():
+    descriptor_pb2 = pytest.importorskip("google.protobuf.descriptor_pb2")
+    from google.protobuf import descriptor_pool, message_factory
+
+    field = descriptor_pb2.FieldDescriptorProto
+    file_proto = descriptor_pb2.FileDescriptorProto(name="turn.proto", package="sentinel_test", syntax="proto3")
+    alternative = file_proto.message_type.add(name="Alternative")
+    alternative.field.add(name="transcript", number=1, type=field.TYPE_STRING, label=field.LABEL_OPTIONAL)
+    alternative.field.add(name="confidence", number=2, type=field.TYPE_DOUBLE, label=field.LABEL_OPTIONAL)
+    alternative.field.add(name="am_score", number=3, type=field.TYPE_INT64, label=field.LABEL_OPTIONAL)
+
+    turn = file_proto.message_type.add(name="Turn")
+    for number, name in enumerate(["call_uuid", "conversation_uuid", "alternatives",
+                                   "prediction", "state", "state_transitions"], 1):
+        turn.field.add(name=name, number=number, type=field.TYPE_STRING, label=field.LABEL_OPTIONAL)
+    turn.field.add(name="call_duration", number=7, type=field.TYPE_DOUBLE, label=field.LABEL_OPTIONAL)
+    turn.field.add(name="n_best", number=8, type=field.TYPE_MESSAGE, label=field.LABEL_REPEATED,
+                   type_name=".sentinel_test.Alternative")
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    return message_factory.GetMessageClass(pool.FindMessageTypeByName("sentinel_test.Turn"))
+
+
+def _write_delimited(messages) -> bytes:
+    data = bytearray()
+    for message in messages:
+        payload = message.SerializeToString()
+        size = len(payload)
+        while size > 0x7F:
+            data.append(size & 0x7F | 0x80)
+            size >>= 7
+        data.append(size)
+        data += payload
+    return bytes(data)
+
+
+def test_protobuf_reader(tmp_path, monkeypatch):
+    turn = _get_turn_message_type()
+    columns = ["call_uuid", "conversation_uuid", "alternatives", "prediction",
+               "state", "state_transitions", "call_duration"]
+    raw_df = pd.read_csv(f"{package_dir}/resources/records.csv")[columns]
+    data = _write_delimited(
+        turn(**{column: value for column, value in row.items() if not pd.isnull(value)})
+        for row in raw_df.to_dict("records"))
+    (tmp_path / "records.pb").write_bytes(data)
+
+    assert get_reader_class("s3://bucket/records.pb") is ProtobufReader
+
+    csv_df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    df = ProtobufReader(str(tmp_path / "records.pb"), message_type=turn).read()
+    assert list(df.call_uuid) == list(csv_df.call_uuid)
+    pd.testing.assert_series_equal(df.alternatives, csv_df.alternatives)
+    pd.testing.assert_series_equal(df.prediction_score, csv_df.prediction_score)
+
+    # file-like input read in blocks smaller than a message
+    monkeypatch.setattr(reader_module, "PROTOBUF_BLOCKSIZE", 7)
+    reader = ProtobufReader(io.BytesIO(data), message_type=turn, chunksize=4,
+                            columns=["call_uuid", "alternatives"], filters=[("state", "=", "COF")])
+    chunks = list(reader.read_chunks())
+    assert all(len(chunk) <= 4 for chunk in chunks)
+    df = pd.concat(chunks)
+    assert list(df.columns) == ["call_uuid", "alternatives", "_raw_alternatives"]
+    assert list(df.call_uuid) == list(csv_df.call_uuid[csv_df.state == "COF"])
+
+    with pytest.raises(ValueError):
+        ProtobufReader(io.BytesIO(data[:-1]), message_type=turn).read()
+
+    # nested messages keep field names, zero values and integer types
+    message = turn(call_uuid="a")
+    message.n_best.add(transcript="hi", confidence=0.0, am_score=5)
+    df = ProtobufReader(io.BytesIO(_write_delimited([message])), message_type=turn,
+                        columns=["call_uuid", "n_best"]).read()
+    assert df.n_best[0] == [{"transcript": "hi", "confidence": 0.0, "am_score": 5}]
+
+
+def test_ranged_download(monkeypatch):
+    import boto3
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+
+    data = open(f"{package_dir}/resources/records.csv", "rb").read()
+    compressed = gzip.compress(data)
+    part_size = len(compressed) // 3 + 1
+
+    s3_client = boto3.client("s3", region_name="us-east-1",
+                             aws_access_key_id="key", aws_secret_access_key="secret")
+    monkeypatch.setattr(util, "get_s3_client", lambda *args: s3_client)
+
+    with Stubber(s3_client) as stubber:
+        stubber.add_response("head_object", {"ContentLength": len(compressed), "ETag": '"etag"'},
+                             {"Bucket": "bucket", "Key": "path/records.csv.gz"})
+        # first range fails once and is retried
+        stubber.add_client_error("get_object", service_error_code="InternalError", http_status_code=500)
+        for start in range(0, len(compressed), part_size):
+            end = min(start + part_size, len(compressed)) - 1
+            part = compressed[start:end + 1]
+            stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(part), len(part))},
+                                 {"Bucket": "bucket", "Key": "path/records.csv.gz", "IfMatch": '"etag"',
+                                  "Range": f"bytes={start}-{end}"})
+
+        fileobj = util.download_fileobj("s3://bucket/path/records.csv.gz", part_size=part_size,
+                                        max_workers=1, spool=True)
+        stubber.assert_no_pending_responses()
+
+    assert fileobj.read() == data
+    fileobj.seek(0)
+    df = get_reader_class("s3://bucket/path/records.csv.gz")(fileobj).read()
+    assert len(df) == len(pd.read_csv(io.BytesIO(data)))
+
+
+def test_dataframe_cache(tmp_path):
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    cache = DataFrameCache(str(tmp_path), max_size_mb=1)
+
+    key = cache.get_key("s3://bucket/records.csv", '"etag"', columns=None)
+    assert key != cache.get_key("s3://bucket/records.csv", '"etag2"', columns=None)
+    assert key != cache.get_key("s3://bucket/records.csv", '"etag"', columns=["call_uuid"])
+    assert cache.get(key) is None
+
+    cache.put(key, df)
+    cached_df = cache.get(key)
+    pd.testing.assert_frame_equal(cached_df, df)
+    assert "alternatives" in cached_df.sentinel._cache
+    assert list(cached_df.sentinel.calls.last_turns()) == list(df.sentinel.calls.last_turns())
+
+    # least recently used entry is evicted first
+    entry_size = os.path.getsize(tmp_path / f"{key}.pkl")
+    cache.max_size = entry_size * 2
+    other_key = cache.get_key("s3://bucket/other.csv", '"etag"')
+    os.utime(tmp_path / f"{key}.pkl", (0, 0))
+    cache.put(other_key, df)
+    assert cache.get(key) is not None
+    cache.put(cache.get_key("s3://bucket/third.csv", '"etag"'), df)
+    assert cache.get(other_key) is None
+    assert cache.get(key) is not None
+
+
+def test_load_dataframe_single_head(tmp_path, monkeypatch):
+    from sentinel import cli
+
+    data = open(f"{package_dir}/resources/records.csv", "rb").read()
+    heads, downloads = [], []
+
+    def head_object(s3_path):
+        heads.append(s3_path)
+        return {"ETag": '"v1"', "ContentLength": len(data)}
+
+    def download_fileobj(s3_path, head=None, **kwargs):
+        downloads.append(head)
+        return io.BytesIO(data)
+
+    monkeypatch.setattr(util, "head_object", head_object)
+    monkeypatch.setattr(util, "download_fileobj", download_fileobj)
+
+    config = {"data_url": "s3://bucket/records.csv", "cache": {"directory": str(tmp_path)}}
+    reader_kwargs = cli.get_reader_kwargs(config, None)
+    for _ in range(2):
+        df = cli.load_dataframe(config, reader_kwargs)
+        assert len(df) == 21
+
+    # one HEAD per run, and the download is pinned to it
+    assert len(heads) == 2
+    assert downloads == [{"ETag": '"v1"', "ContentLength": len(data)}]
+
+
+def test_run_batch(tmp_path, monkeypatch):
+    import yaml
+    import sentinel.cli as cli
+
+    loaded = []
+    parent_pid = os.getpid()
+
+    def load_dataframe(config, reader_kwargs, use_cache=True):
+        loaded.append(config["data_url"])
+        # reading from S3 leaves a client in the parent
+        monkeypatch.setitem(util._s3_clients, util.S3_MAX_POOL_CONNECTIONS, object())
+        return CSVReader(f"{package_dir}/resources/records.csv", **reader_kwargs).read()
+
+    class FileExporter(cli.Exporter):
+        def __init__(self, config):
+            super().__init__()
+            self.config = config
+
+        def export_report(self, df_list, categories):
+            # forked workers don't reuse the parent's clients
+            assert os.getpid() == parent_pid or not util._s3_clients
+            flagged = [len(result.annotations) for result in df_list]
+            (tmp_path / f"{self.config['name']}.out").write_text(",".join(map(str, flagged)))
+
+    monkeypatch.setattr(cli, "load_dataframe", load_dataframe)
+    monkeypatch.setattr(cli, "build_exporters", lambda config: [FileExporter(config)])
+
+    config_files = []
+    for name, data_url, filters in [
+            ("asr", "s3://bucket/a.csv", {"low_asr_confidence": {"kwargs": {"confidence_threshold": 0.95}}}),
+            ("loop", "s3://bucket/a.csv", {"state_loop": {}, "no_alternatives": {}}),
+            ("other", "s3://bucket/b.csv", {"no_alternatives": {}})]:
+        config_file = tmp_path / f"{name}.yml"
+        config_file.write_text(yaml.dump({"name": name, "data_url": data_url, "filters": filters},
+                                         sort_keys=False))
+        config_files.append(str(config_file))
+
+    assert cli.run_batch(config_files, max_workers=2) == []
+    assert sorted(loaded) == ["s3://bucket/a.csv", "s3://bucket/b.csv"]
+
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    expected = {
+        "asr": [ASRConfidenceFilter(confidence_threshold=0.95)],
+        "loop": [LoopCallState(), AlternativesFilter()],
+        "other": [AlternativesFilter()],
+    }
+    for name, filters in expected.items():
+        flagged = [len(filter.run(df).annotations) for filter in filters]
+        assert (tmp_path / f"{name}.out").read_text() == ",".join(map(str, flagged))
+
+
+class _FakeS3Client:
+    """
+    Records multipart uploads in memory.
+    """
+
+    def __init__(self, fail_part: int = None):
+        self.fail_part = fail_part
+        self.objects = {}
+        self.parts = {}
+        self.aborted = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key):
+        self.parts[Key] = []
+        return {"UploadId": Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise IOError("upload failed")
+        self.parts[UploadId].append(Body)
+        return {"ETag": str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        assert [part["PartNumber"] for part in MultipartUpload["Parts"]] == list(
+            range(1, len(self.parts[UploadId]) + 1))
+        self.objects[Key] = b"".join(self.parts.pop(UploadId))
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(Key)
+
+
+def test_multipart_upload(monkeypatch):
+    monkeypatch.setattr(util, "MIN_UPLOAD_PART_SIZE", 256)
+    df = pd.read_csv(f"{package_dir}/resources/records.csv")
+    expected = df.to_csv(index=False).encode("utf-8")
+
+    s3_client = _FakeS3Client()
+    assert util.upload_df_to_s3(df, "bucket", "small.csv", s3_client=s3_client)
+    assert util.upload_df_to_s3(df, "bucket", "large.csv", part_size=256, s3_client=s3_client)
+    assert util.upload_df_to_s3(df, "bucket", "large.csv.gz", compress=True,
+                                part_size=256, s3_client=s3_client)
+    assert s3_client.objects["small.csv"] == expected
+    assert s3_client.objects["large.csv"] == expected
+    assert gzip.decompress(s3_client.objects["large.csv.gz"]) == expected
+    assert not s3_client.parts
+
+    s3_client = _FakeS3Client(fail_part=2)
+    with pytest.raises(IOError):
+        util.upload_df_to_s3(df, "bucket", "failed.csv", part_size=256, s3_client=s3_client)
+    assert s3_client.aborted == ["failed.csv"]
+    assert "failed.csv" not in s3_client.objects
+
+
+def test_slack_delivery():
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from sentinel.exporters.delivery import SlackDelivery, SlackThread
+
+    posted = []
+    rate_limited = set()
+
+    class SlackStub(BaseHTTPRequestHandler):
+        def do_POST(self):
+            message = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+            # rate limit the first reply of every channel once
+            key = message["channel"]
+            if message.get("thread_ts") and key not in rate_limited:
+                rate_limited.add(key)
+                self._respond(429, {"ok": False, "error": "ratelimited"}, {"Retry-After": "0.1"})
+                return
+
+            posted.append(message)
+            self._respond(200, {"ok": True, "channel": message["channel"],
+                                "ts": f"{message['channel']}.{len(posted)}"})
+
+        def _respond(self, status, payload, headers={}):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlackStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        delivery = SlackDelivery("token", rate_limit=50, max_concurrency=2,
+                                 base_url=f"http://127.0.0.1:{server.server_port}/api/")
+        replies = [[{"type": "section", "text": {"type": "mrkdwn", "text": str(idx)}}] for idx in range(3)]
+        threads = [SlackThread(channel, "report", [], replies) for channel in ["a", "b", "c"]]
+        assert delivery.deliver(threads) == [None, None, None]
+    finally:
+        server.shutdown()
+
+    assert rate_limited == {"a", "b", "c"}
+    for channel in ["a", "b", "c"]:
+        messages = [message for message in posted if message["channel"] == channel]
+        assert "thread_ts" not in messages[0]
+        parent_ts = f"{channel}.{posted.index(messages[0]) + 1}"
+        assert [message["thread_ts"] for message in messages[1:]] == [parent_ts] * 3
+        assert [message["blocks"][0]["text"]["text"] for message in messages[1:]] == ["0", "1", "2"]
+
+
+def test_slack_call_list(monkeypatch):
+    from sentinel.exporters.slack import SlackExporter, SLACK_TEXT_LIMIT
+
+    monkeypatch.delenv("SENTINEL_S3_HOST", raising=False)
+    monkeypatch.setenv("SENTINEL_CONSOLE_HOST", "https://console/")
+    exporter = SlackExporter(config={"client_id": 7})
+
+    df = pd.DataFrame({"call_uuid": [f"call-{idx}" for idx in range(100)],
+                       "conversation_uuid": [f"turn-{idx}" for idx in range(100)]})
+    template = exporter._get_call_reference_template()
+    references = exporter._get_call_references(df, template)
+    assert references[3] == "https://console/7/call-report/#/call?uuid=call-3&turnuuid=turn-3%INPUT"
+
+    chunks = list(exporter._chunk_call_list(df, template))
+    assert len(chunks) > 1
+    assert all(len("\n".join(chunk)) <= SLACK_TEXT_LIMIT for chunk in chunks)
+    assert [line for chunk in chunks for line in chunk] == [
+        f"• <{reference}|{call_uuid}>" for reference, call_uuid in zip(references, df.call_uuid)]
+
+    monkeypatch.setenv("SENTINEL_S3_HOST", "https://s3")
+    assert exporter._get_call_references(df[:1], exporter._get_call_reference_template())[0].endswith(
+        "/call-0.mp3")
+
+
+def test_slack_export_empty_result(monkeypatch):
+    from sentinel.exporters.slack import SlackExporter
+    from sentinel.filters.base import FilterResult
+
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    results = [EndStateFilter(end_state=["COF"]).run(df),
+               FilterResult.from_frames([], "low_asr_confidence", columns=df.columns)]
+    assert list(results[1].to_frame().columns) == list(df.columns) + ["low_asr_confidence"]
+
+    uploaded = {}
+    monkeypatch.setattr(util, "upload_dfs_to_s3", lambda dfs, bucket, compress: uploaded.update(dfs))
+    exporter = SlackExporter(config={"export": {"slack": {"channel_name": "alerts"}}})
+    threads = []
+    monkeypatch.setattr(exporter.delivery, "deliver", lambda items: threads.extend(items) or [None] * len(items))
+    exporter.export_report(results, [result.category for result in results])
+
+    assert [len(frame) for frame in uploaded.values()] == [len(results[0]), 0]
+    assert len(threads) == 1
+
+
+def test_csv_export_report():
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    raw_df = pd.read_csv(f"{package_dir}/resources/records.csv")
+    columns = list(df.columns)
+    alternatives = df.alternatives.copy()
+
+    categories = ["no_alternatives", "call_end_state"]
+    filter_function = AlternativesFilter()
+    filter_function.successor = EndStateFilter(**{"end_state": ["FOLLOW_UP", "COF"]})
+    df_list = filter_function.handle(df, [])
+
+    reports = CSVExporter().export_report(df_list, categories)
+
+    assert list(df.columns) == columns
+    pd.testing.assert_series_equal(df.alternatives, alternatives)
+    for category, result in zip(categories, df_list):
+        report = pd.read_csv(reports[category])
+        assert len(report) == len(result)
+        # input columns and the annotation only
+        assert list(report.columns) == list(raw_df.columns) + [category]
+        expected = raw_df.loc[result.index]
+        assert list(report.call_uuid) == list(expected.call_uuid)
+        # raw JSON is written back as read
+        for column in ["alternatives", "prediction"]:
+            assert list(report[column].fillna("")) == list(expected[column].fillna(""))
+
+
+def test_tog_export_dry_run():
+    from sentinel.exporters.tog import TogExporter
+
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    categories = ["no_alternatives", "call_end_state"]
+    filter_function = AlternativesFilter()
+    filter_function.successor = EndStateFilter(**{"end_state": ["FOLLOW_UP", "COF"]})
+    df_list = filter_function.handle(df, [])
+
+    config = {"export": {"tog": {"job_id": "job", "batch_size": 4, "dry_run": True}},
+              "filters": {"no_alternatives": {"limit": 5}, "call_end_state": {}}}
+    exporter = TogExporter(config=config)
+    exporter.export_report(df_list, categories)
+
+    pushed = pd.concat([batch for _, batch in exporter.backend.pushes])
+    assert all(job_id == "job" for job_id, _ in exporter.backend.pushes)
+    assert all(len(batch) <= 4 for _, batch in exporter.backend.pushes)
+
+    flagged = [list(result.index[:5]) if category == "no_alternatives" else list(result.index)
+               for category, result in zip(categories, df_list)]
+    assert sorted(pushed.index) == sorted(set(flagged[0]) | set(flagged[1]))
+    for category, index in zip(categories, flagged):
+        assert pushed.loc[index, category].notnull().all()
+    assert not any(column.startswith("_raw_") for column in pushed.columns)
+
+
+def test_exporter_dispatcher():
+    import time
+    from sentinel.exporters.base import Exporter, ExporterDispatcher
+
+    class RecordingExporter(Exporter):
+        def __init__(self, name, delay=0.0, error=None):
+            super().__init__()
+            self.name = name
+            self.delay = delay
+            self.error = error
+            self.exported = None
+
+        def export_report(self, df_list, categories):
+            time.sleep(self.delay)
+            if self.error:
+                raise self.error
+            self.exported = (df_list, categories)
+
+    exporters = [RecordingExporter("slow", delay=0.3), RecordingExporter("other", delay=0.3),
+                 RecordingExporter("broken", error=ValueError("boom")),
+                 RecordingExporter("stuck", delay=5)]
+    dispatcher = ExporterDispatcher(exporters, timeouts={"stuck": 0.5})
+
+    start = time.monotonic()
+    results = dispatcher.dispatch([1, 2], ["a", "b"])
+    assert time.monotonic() - start < 1.5
+
+    assert [result.name for result in results] == ["slow", "other", "broken", "stuck"]
+    assert [result.ok for result in results] == [True, True, False, False]
+    assert isinstance(results[2].error, ValueError)
+    assert results[3].timed_out
+    assert exporters[0].exported == exporters[1].exported == ((1, 2), ["a", "b"])
+    assert "timed out" in dispatcher.summarize(results)
+
+
+def test_instrumentation(tmp_path):
+    import json
+    from sentinel.instrumentation import instrumentation
+
+    instrumentation.reset()
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    chain = ASRConfidenceFilter(**{"confidence_threshold": 0.95})
+    chain.successor = LoopCallState()
+    results = chain.handle(df, [])
+
+    stages = {metrics.name: metrics for metrics in instrumentation.get_metrics()}
+    assert stages["reader:post_read"].rows_out == len(df)
+    for result in results:
+        metrics = stages[f"filter:{result.category}"]
+        assert metrics.calls == 1
+        assert (metrics.rows_in, metrics.rows_out) == (len(df), len(result))
+        assert metrics.wall_seconds >= 0 and metrics.cpu_seconds >= 0
+
+    chain.handle_chunks([df.iloc[:2], df.iloc[2:]])
+    stages = {metrics.name: metrics for metrics in instrumentation.get_metrics()}
+    assert stages[f"filter:{chain.name}"].calls == 3
+    assert stages[f"filter:{chain.name}"].rows_in == 2 * len(df)
+    assert f"filter:{chain.successor.name}" in instrumentation.summary()
+
+    instrumentation.write_json(tmp_path / "metrics.json")
+    payload = json.loads((tmp_path / "metrics.json").read_text())
+    assert [item["name"] for item in payload["stages"]] == list(stages)
+
+    instrumentation.write_prometheus(tmp_path / "metrics.prom", {"config": "test"})
+    text = (tmp_path / "metrics.prom").read_text()
+    assert "# TYPE sentinel_stage_wall_seconds gauge" in text
+    assert f'sentinel_stage_rows_out{{config="test",stage="filter:{chain.name}"}}' in text
+
+
+@pytest.mark.parametrize("profiler_name", ["cprofile", "sampling"])
+def test_profiling(tmp_path, profiler_name):
+    import json
+    import pstats
+    from sentinel.profiling import profile, sample_calls
+
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    sample = sample_calls(df, 6)
+    assert 0 < len(sample) <= 6
+    # whole calls only, picked the same way whatever the row order
+    assert set(sample.call_uuid) == set(sample_calls(df.iloc[::-1], 6).call_uuid)
+    assert (df.call_uuid.isin(sample.call_uuid).sum()) == len(sample)
+
+    output = str(tmp_path / "profile.out")
+    options = {"interval": 0.0005} if profiler_name == "sampling" else {}
+    with profile(profiler_name, output, **options) as profiler:
+        chain = ASRConfidenceFilter(**{"confidence_threshold": 0.95})
+        chain.successor = LoopCallState()
+        for _ in range(50):
+            chain.handle(df, [])
+
+    hotspots = profiler.hotspots(limit=3)
+    assert "ASRConfidenceFilter" in hotspots and "LoopCallState" in hotspots
+    assert all(0 < len(functions) <= 3 for functions in hotspots.values())
+    assert "LoopCallState" in profiler.report()
+
+    if profiler_name == "cprofile":
+        assert pstats.Stats(output).total_calls > 0
+    else:
+        with open(output) as f:
+            speedscope = json.load(f)
+        assert speedscope["profiles"][0]["type"] == "sampled"
+        assert len(speedscope["profiles"][0]["samples"]) == len(speedscope["profiles"][0]["weights"])
+
+
+def test_incremental_run(tmp_path, monkeypatch):
+    import json
+    from sentinel import cli
+    from sentinel.incremental import Checkpoint, list_partitions, run_incremental
+
+    df = CSVReader(f"{package_dir}/resources/records.csv").read()
+    # the first call goes on in the next partition and doesn't end in COF
+    follow_up = df.iloc[[0]].assign(state="FOLLOW_UP")
+    frames = {
+        "s3://bucket/calls/hour=00/part-0.csv": df.iloc[:7],
+        "s3://bucket/calls/hour=01/part-0.csv": pd.concat([follow_up, df.iloc[7:14]]),
+        "s3://bucket/calls/hour=02/part-0.csv": df.iloc[14:],
+    }
+    listed = [{"Key": "calls/hour=00/_SUCCESS"}]
+
+    def build_chain():
+        chain = EndStateFilter(end_state=["COF"])
+        chain.successor = ASRConfidenceFilter(**{"confidence_threshold": 0.95})
+        return chain
+
+    checkpoint_path = str(tmp_path / "checkpoint.json")
+    flagged = {"call_end_state": [], "low_asr_confidence": []}
+    for s3_path in frames:
+        listed.append({"Key": s3_path[len("s3://bucket/"):]})
+        monkeypatch.setattr(util, "list_objects", lambda data_url: list(listed))
+
+        checkpoint = Checkpoint.load(checkpoint_path)
+        partitions = list_partitions("s3://bucket/calls/", checkpoint)
+        assert partitions == [[s3_path]]
+
+        results = run_incremental(build_chain(), partitions, lambda path: [frames[path].copy()], checkpoint)
+        checkpoint.save()
+        for result in results:
+            flagged[result.category].extend(result.to_frame().call_uuid)
+
+    full_df = pd.concat(frames.values(), ignore_index=True)
+    full_results = build_chain().handle(full_df, [])
+
+    # turn level results are complete right away
+    assert sorted(flagged["low_asr_confidence"]) == sorted(full_results[1].to_frame().call_uuid)
+    # calls of the last partition haven't settled yet
+    checkpoint = Checkpoint.load(checkpoint_path)
+    last_calls = set(df.iloc[14:].call_uuid)
+    assert set(checkpoint.last_seen.index) == last_calls
+    assert set(flagged["call_end_state"]) == set(full_results[0].to_frame().call_uuid) - last_calls
+    assert df.call_uuid[0] not in flagged["call_end_state"]
+    assert checkpoint.rows == len(full_df)
+    # carried rows come back the way they were read
+    with open(checkpoint_path) as f:
+        assert set(json.load(f)) == {"objects", "sequence", "rows", "last_seen", "call_state"}
+    for state in checkpoint.call_state.values():
+        assert set(state.call_uuid) <= last_calls
+        assert isinstance(state.alternatives.iloc[0], list)
+
+    # runs without new data export nothing and keep the checkpoint as it is
+    config = {"data_url": "s3://bucket/calls/", "incremental": {"checkpoint": checkpoint_path},
+              "filters": {"call_end_state": {"kwargs": {"end_state": ["COF"]}},
+                          "low_asr_confidence": {"kwargs": {"confidence_threshold": 0.95}}}}
+    exported = []
+    monkeypatch.setattr(cli, "export", lambda config, df_list: exported.append(df_list))
+    monkeypatch.setattr(cli, "read_partition", lambda config, columns, path: [frames[path].copy()])
+    with open(checkpoint_path) as f:
+        saved = f.read()
+    cli.run_config(config)
+    assert not exported
+    with open(checkpoint_path) as f:
+        assert f.read() == saved
+
+    frames["s3://bucket/calls/hour=03/part-0.csv"] = df.iloc[:2]
+    listed.append({"Key": "calls/hour=03/part-0.csv"})
+    cli.run_config(config)
+    assert len(exported) == 1
+    assert Checkpoint.load(checkpoint_path).sequence == checkpoint.sequence + 1
+
+    # call states without pending calls come back with their columns, so
+    # exporters can report them next to other results
+    from sentinel.exporters.slack import SlackExporter
+
+    checkpoint = Checkpoint.load(checkpoint_path)
+    checkpoint.call_state["call_end_state"] = checkpoint.call_state["call_end_state"].iloc[:0]
+    checkpoint.save()
+    call_filter = EndStateFilter(end_state=["COF"])
+    call_filter._call_state = Checkpoint.load(checkpoint_path).call_state["call_end_state"]
+    results = [call_filter.settle(last_calls), ASRConfidenceFilter(**{"confidence_threshold": 0.95}).run(df)]
+    assert "call_uuid" in results[0].to_frame()
+
+    monkeypatch.setattr(util, "upload_dfs_to_s3", lambda dfs, bucket, compress: None)
+    exporter = SlackExporter(config={})
+    monkeypatch.setattr(exporter.delivery, "deliver", lambda threads: [None] * len(threads))
+    exporter.export_report(results, [result.category for result in results])
+
+
+def test_stream_processor():
+    import threading
+    import time
+    from sentinel.exporters.base import Exporter
+    from sentinel.stream import QueueSource, StreamProcessor
+
+    class AlertExporter(Exporter):
+        name = "alerts"
+
+        def __init__(self):
+            super().__init__()
+            self.alerts = []
+            self.received = threading.Event()
+
+        def export_report(self, df_list, categories):
+            for result in df_list:
+                self.alerts.extend((result.category, call_uuid) for call_uuid in result.to_frame().call_uuid)
+            self.received.set()
+
+    events = pd.read_csv(f"{package_dir}/resources/records.csv").to_dict("records")
+    ongoing, ending = events[0], events[1]
+    # ends in another state than its first turn
+    last_turn = {**ending, "state": "FOLLOW_UP", "alternatives": "[]", "call_end": True}
+
+    def record_dispatches(processor):
+        dispatched = []
+        dispatch = processor.dispatcher.dispatch
+
+        def record(*args):
+            export_results = dispatch(*args)
+            dispatched.extend(export_results)
+            return export_results
+
+        processor.dispatcher.dispatch = record
+        return dispatched
+
+    now = [0.0]
+    exporter = AlertExporter()
+    chain = EndStateFilter(end_state=["COF"])
+    chain.successor = ASRConfidenceFilter(**{"confidence_threshold": 0.95})
+    processor = StreamProcessor(chain, [exporter], evaluate="call_end", ttl=60, clock=lambda: now[0])
+    dispatched = record_dispatches(processor)
+
+    results = processor.process([ongoing, ending, last_turn])
+    assert len(results[0]) == 0
+    # turns are flagged right away, with row ids unique within the stream
+    assert ongoing["call_uuid"] in set(results[1].to_frame().call_uuid)
+    assert set(results[1].index) <= {0, 1, 2}
+    assert list(processor.calls) == [ongoing["call_uuid"]]
+
+    # idle calls are evaluated and dropped
+    now[0] = 61.0
+    results = processor.process([])
+    assert list(results[0].to_frame().call_uuid) == [ongoing["call_uuid"]]
+    assert not processor.calls
+    assert ("call_end_state", ongoing["call_uuid"]) in exporter.alerts
+    assert len(dispatched) == 2 and all(export_result.ok for export_result in dispatched)
+
+    # per turn, calls are flagged once by every call level filter
+    chain = EndStateFilter(end_state=["COF"])
+    exporter = AlertExporter()
+    processor = StreamProcessor(chain, [exporter], evaluate="turn")
+    dispatched = record_dispatches(processor)
+    source = QueueSource()
+    thread = threading.Thread(target=processor.run, args=(source,), kwargs={"batch_interval": 0.05})
+    thread.start()
+
+    start = time.monotonic()
+    source.put(ongoing)
+    assert exporter.received.wait(1)
+    assert time.monotonic() - start < 1
+
+    source.put(ongoing)
+    source.put(None)
+    thread.join(5)
+    assert not thread.is_alive()
+    assert exporter.alerts == [("call_end_state", ongoing["call_uuid"])]
+    assert dispatched and all(export_result.ok for export_result in dispatched)
+
+
+def test_stream_sources(tmp_path):
+    import json
+    import socket
+    from sentinel.stream import FileTailSource, UnixSocketSource
+
+    def poll_all(source, count):
+        events = []
+        for _ in range(50):
+            events.extend(source.poll(0.05))
+            if len(events) >= count:
+                break
+        return events
+
+    path = tmp_path / "turns.jsonl"
+    path.write_text(json.dumps({"call_uuid": "old"}) + "\n")
+    source = FileTailSource(str(path), poll_interval=0.01)
+    try:
+        with open(path, "a") as f:
+            f.write(json.dumps({"call_uuid": "a"}) + "\nnot json\n" + '{"call_uuid": ')
+            f.flush()
+            f.write('"b"}\n')
+        assert poll_all(source, 2) == [{"call_uuid": "a"}, {"call_uuid": "b"}]
+    finally:
+        source.close()
+
+    socket_path = str(tmp_path / "turns.sock")
+    source = UnixSocketSource(socket_path)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(b'{"call_uuid": "c"}\n{"call_uuid": "d", "call_end": true}\n')
+        assert poll_all(source, 2) == [{"call_uuid": "c"}, {"call_uuid": "d", "call_end": True}]
+    finally:
+        source.close()
+    assert not os.path.exists(socket_path)
+
+
+@pytest.mark.parametrize("profile_args, profiler_name", [
+    (["--profile"], "cprofile"),
+    (["--profile", "--no-cache"], "cprofile"),
+    (["--profile", "sampling"], "sampling"),
+    (["--profile=sampling"], "sampling"),
+])
+def test_cli_profile_option(tmp_path, monkeypatch, profile_args, profiler_name):
+    import sys
+    from sentinel import cli
+
+    profilers = []
+    monkeypatch.setattr(cli, "load_config", lambda config_file: {})
+    monkeypatch.setattr(cli, "run_config", lambda config, executor, **kwargs: None)
+
+    real_profile = cli.profile
+
+    def profile(name, output):
+        profilers.append(name)
+        return real_profile(name, output)
+
+    monkeypatch.setattr(cli, "profile", profile)
+    monkeypatch.setattr(sys, "argv", ["sentinel", "run", "--config-yml=c.yml", *profile_args,
+                                      f"--profile-output={tmp_path / 'profile.out'}"])
+    cli.main()
+
+    assert profilers == [profiler_name]
+    assert (tmp_path / "profile.out").exists()